@@ -0,0 +1,309 @@
+"""
+This module benchmarks the training paths of the Q-learning code.
+
+It measures episodes per second of Trainer, BatchTrainer and ParallelTrainer, the solve time of the
+BackwardInductionSolver, the time per step of every phase of the scalar training loop,
+the cost of a scalar random draw, the memory of the Q-table and the auxiliary
+structures, and how these scale with the wealth grid, ACTION_STEP and T. Results are
+written as JSON and can be compared against a stored baseline, failing with exit code 1
+on regressions.
+
+Example:
+    python benchmark.py --profile trainer.prof
+    python benchmark.py --save-baseline bench_baseline.json
+    python benchmark.py --out bench.json --baseline bench_baseline.json --tolerance 0.2
+"""
+
+import argparse  # Import argparse for the command line interface
+import contextlib  # Import contextlib to silence the training log
+import io  # Import io for the silenced training log
+import json  # Import json to write the results
+import os  # Import os for the number of cores
+import platform  # Import platform to describe the machine
+import random  # Import random as the reference of the scalar random draws
+import sys  # Import sys for the exit code
+import time  # Import time for the timers
+import timeit  # Import timeit for the scalar random draws
+import tracemalloc  # Import tracemalloc to measure peak memory
+
+import numpy as np  # Import numpy for numerical operations
+
+from msbd6000m_assignment1 import (
+    Environment, Agent, Trainer, BatchTrainer, ParallelTrainer, BackwardInductionSolver, RandomStream,
+    profile_training
+)
+
+# Grid of the assignment, used as the reference configuration
+DEFAULT_CONFIG = {
+    "T": 10, "p": 0.8, "a_ret": 0.6, "b_ret": -0.3, "riskless_ret": 0.02, "alpha": 0.001,
+    "W_MAX": 10000, "W_STEP": 50, "ACTION_STEP": 50,
+}
+
+# Agent hyperparameters of the assignment
+AGENT_PARAMS = {
+    "alpha": 0.001, "gamma": 1.0, "epsilon_start": 0.2, "epsilon_end": 0.0001,
+    "decay_rate": 0.005, "INITIAL_WEALTH": 1000,
+}
+
+# Configurations of the scaling curves, as overrides of DEFAULT_CONFIG
+SCALING = {
+    "W_MAX": [{"W_MAX": w} for w in (2500, 5000, 10000, 20000)],
+    "W_STEP": [{"W_STEP": s, "ACTION_STEP": s} for s in (100, 50, 25)],
+    "ACTION_STEP": [{"ACTION_STEP": s} for s in (200, 100, 50)],
+    "T": [{"T": t} for t in (5, 10, 20)],
+}
+
+
+def make_agent(overrides=None, seed=0, **agent_kwargs):
+    """
+    Create an agent for a benchmark configuration.
+
+    Args:
+        overrides (dict): Environment parameters overriding DEFAULT_CONFIG.
+        seed (int): Seed of the random stream.
+        **agent_kwargs: Extra Agent arguments, e.g. q_layout.
+
+    Returns:
+        Agent: The agent.
+    """
+    env = Environment(**{**DEFAULT_CONFIG, **(overrides or {})}, rng=seed)
+    return Agent(env, **AGENT_PARAMS, **agent_kwargs)
+
+
+def metric(value, unit, better):
+    """
+    Create a result entry.
+
+    Args:
+        value (float): Measured value.
+        unit (str): Unit of the value.
+        better (str): "higher" or "lower", the direction of an improvement.
+
+    Returns:
+        dict: Result entry.
+    """
+    return {"value": float(value), "unit": unit, "better": better}
+
+
+def time_training(trainer):
+    """
+    Train with the progress log silenced and return the wall-clock time.
+
+    Args:
+        trainer (Trainer): Trainer to run.
+
+    Returns:
+        float: Elapsed seconds.
+    """
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        trainer.train()
+    return time.perf_counter() - start
+
+
+def bench_throughput(overrides, episodes, batch_episodes):
+    """
+    Measure the throughput of all training paths for one configuration.
+
+    Args:
+        overrides (dict): Environment parameters overriding DEFAULT_CONFIG.
+        episodes (int): Number of episodes for the scalar Trainer.
+        batch_episodes (int): Number of episodes for the BatchTrainer.
+
+    Returns:
+        dict: Result entries.
+    """
+    results = {}
+    elapsed = time_training(Trainer(make_agent(overrides), num_episodes=episodes))
+    results["trainer.episodes_per_sec"] = metric(episodes / elapsed, "episodes/s", "higher")
+
+    elapsed = time_training(Trainer(make_agent(overrides), num_episodes=episodes, update_mode="expected"))
+    results["trainer_expected.episodes_per_sec"] = metric(episodes / elapsed, "episodes/s", "higher")
+
+    elapsed = time_training(BatchTrainer(make_agent(overrides), num_episodes=batch_episodes))
+    results["batch_trainer.episodes_per_sec"] = metric(batch_episodes / elapsed, "episodes/s", "higher")
+
+    # One worker per core; compare with trainer.episodes_per_sec for the scaling
+    elapsed = time_training(ParallelTrainer(make_agent(overrides), num_episodes=episodes * os.cpu_count()))
+    results["parallel_trainer.episodes_per_sec"] = metric(episodes * os.cpu_count() / elapsed, "episodes/s", "higher")
+
+    solver = BackwardInductionSolver(make_agent(overrides).env)
+    start = time.perf_counter()
+    solver.solve()
+    results["solver.seconds"] = metric(time.perf_counter() - start, "s", "lower")
+    return results
+
+
+def bench_phases(overrides, episodes):
+    """
+    Measure the time per step of every phase of the scalar training loop.
+
+    Uses the instrumentation of Trainer (instrument=True) with the logger disabled.
+
+    Args:
+        overrides (dict): Environment parameters overriding DEFAULT_CONFIG.
+        episodes (int): Number of episodes.
+
+    Returns:
+        dict: Result entries in nanoseconds per call.
+    """
+    trainer = Trainer(make_agent(overrides), num_episodes=episodes, callbacks=[], instrument=True)
+    trainer.train()
+    return {f"phase.{phase}.ns_per_call": metric(stats["ns_per_call"], "ns", "lower")
+            for phase, stats in trainer.timers.summary().items()}
+
+
+def bench_random(draws):
+    """
+    Measure the cost of a scalar draw of RandomStream.random against random.random.
+
+    Both are called through the same timeit loop, so the ratio compares the draws only.
+
+    Args:
+        draws (int): Number of draws per measurement.
+
+    Returns:
+        dict: Result entries.
+    """
+    stream_ns = min(timeit.repeat(RandomStream(0).random, number=draws, repeat=5)) / draws * 1e9
+    python_ns = min(timeit.repeat(random.Random(0).random, number=draws, repeat=5)) / draws * 1e9
+    return {
+        "random.stream.ns_per_draw": metric(stream_ns, "ns", "lower"),
+        "random.stream_vs_python.ratio": metric(stream_ns / python_ns, "x", "lower"),
+    }
+
+
+def bench_memory(overrides):
+    """
+    Measure the memory of the Q-table layouts and the auxiliary structures.
+
+    Args:
+        overrides (dict): Environment parameters overriding DEFAULT_CONFIG.
+
+    Returns:
+        dict: Result entries in bytes.
+    """
+    results = {}
+    for layout in ("dense", "packed"):
+        tracemalloc.start()
+        agent = make_agent(overrides, q_layout=layout)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results[f"memory.{layout}.q_table_bytes"] = metric(agent.q_table.nbytes, "bytes", "lower")
+        results[f"memory.{layout}.construction_peak_bytes"] = metric(peak, "bytes", "lower")
+
+    # The sparse table only holds the rows reached by training
+    agent = make_agent(overrides, q_layout="sparse")
+    Trainer(agent, num_episodes=300, callbacks=[]).train()
+    results["memory.sparse.q_table_bytes_after_300_episodes"] = metric(agent.q_table.nbytes, "bytes", "lower")
+
+    env = agent.env
+    tables = (env.action_counts, env.action_offsets, env.next_index_up, env.next_index_down, env.utility_table)
+    results["memory.env_tables_bytes"] = metric(sum(a.nbytes for a in tables), "bytes", "lower")
+    return results
+
+
+def run_suite(quick=False):
+    """
+    Run the whole benchmark suite.
+
+    Args:
+        quick (bool): Use fewer episodes and skip the scaling curves.
+
+    Returns:
+        dict: Machine description and flat result entries keyed by "<case>/<metric>".
+    """
+    episodes, batch_episodes, phase_episodes = (300, 20000, 200) if quick else (3000, 300000, 2000)
+    random_draws = 100_000 if quick else 1_000_000
+    results = {}
+    cases = {"default": {}}
+    if not quick:
+        cases.update({f"scaling.{axis}={list(o.values())[0]}": o for axis, configs in SCALING.items() for o in configs})
+
+    for name, overrides in cases.items():
+        entries = bench_throughput(overrides, episodes, batch_episodes)
+        entries.update(bench_memory(overrides))
+        if name == "default":
+            entries.update(bench_phases(overrides, phase_episodes))
+            entries.update(bench_random(random_draws))
+        results.update({f"{name}/{key}": value for key, value in entries.items()})
+
+    return {
+        "machine": {"python": platform.python_version(), "numpy": np.__version__,
+                    "platform": platform.platform(), "processor": platform.processor()},
+        "quick": quick,
+        "results": results,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare results against a baseline.
+
+    Args:
+        results (dict): Output of run_suite.
+        baseline (dict): Earlier output of run_suite.
+        tolerance (float): Allowed relative change in the worse direction, e.g. 0.2.
+
+    Returns:
+        list: Descriptions of the regressions.
+    """
+    regressions = []
+    for key, entry in results["results"].items():
+        base = baseline["results"].get(key)
+        if base is None or base["value"] == 0:
+            continue
+        ratio = entry["value"] / base["value"]
+        worse = ratio < 1 - tolerance if entry["better"] == "higher" else ratio > 1 + tolerance
+        if worse:
+            regressions.append(f"{key}: {entry['value']:.4g} vs baseline {base['value']:.4g} {entry['unit']} "
+                               f"({(ratio - 1) * 100:+.1f}%)")
+    return regressions
+
+
+def main(argv=None):
+    """
+    Command line entry point of the benchmark suite.
+
+    Args:
+        argv (list): Command line arguments; sys.argv[1:] if None.
+
+    Returns:
+        int: Exit code, 1 if regressions were found.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the Q-learning training paths.")
+    parser.add_argument("--out", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against this JSON file")
+    parser.add_argument("--save-baseline", help="write the results as a new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    parser.add_argument("--quick", action="store_true", help="short run without scaling curves")
+    parser.add_argument("--profile", help="only write a cProfile of Trainer on the default config to this file")
+    parser.add_argument("--profile-episodes", type=int, default=2000, help="episodes of the profiled run")
+    args = parser.parse_args(argv)
+
+    if args.profile:
+        trainer = Trainer(make_agent(), num_episodes=args.profile_episodes, callbacks=[])
+        profile_training(trainer, args.profile).sort_stats("cumulative").print_stats(15)
+        return 0
+
+    results = run_suite(quick=args.quick)
+    for key, entry in results["results"].items():
+        print(f"{key:60s} {entry['value']:14.4g} {entry['unit']}")
+    for path in (args.out, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+        print("No regressions against the baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
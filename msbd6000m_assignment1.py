@@ -9,341 +9,3753 @@ Original file is located at
 
 """
 This module provides an implementation of Q-learning for financial applications.
-It includes classes for the environment, agent, and trainer.
+It includes classes for the environment, agent, trainers, an exact solver and a policy evaluator.
 """
 
+import multiprocessing  # Import multiprocessing for the parallel trainer
+from multiprocessing import shared_memory  # Import shared_memory for the Q-table shared by the workers
+import functools  # Import functools to cache the binomial tables
+import itertools  # Import itertools to chain the blocks of random numbers
+import operator  # Import operator for the remaining length of a block
+import os  # Import os for checkpoint files
+from collections.abc import Mapping  # Import Mapping for the lazy wealth mappings
+import pickle  # Import pickle to store the random generator state
+import shutil  # Import shutil to replace checkpoint directories
+import statistics  # Import statistics for normal quantiles of confidence intervals
+import time  # Import time for the instrumentation timers
 import numpy as np  # Import numpy for numerical operations
-import matplotlib.pyplot as plt  # Import matplotlib for plotting
-import random  # Import random for random number generation
+# matplotlib is imported lazily in Trainer.plot_results, so headless training does not load it
+
+class RandomStream:
+    """
+    The RandomStream class provides seeded uniform random numbers from a NumPy Generator.
+
+    Uniform variates are drawn in blocks of block_size and handed out one at a time by
+    random(), which avoids the overhead of a Generator call per scalar draw: a draw costs
+    about 1.5 times a random.random() call, mostly for creating the floats of the block,
+    and about 8 times less than Generator.random() (see bench_random in benchmark.py).
+    Streams are reproducible from their seed, and spawn() derives independent child
+    streams for parallel runs.
+
+    Attributes:
+        seed_seq (np.random.SeedSequence): Seed of the stream.
+        block_size (int): Number of variates drawn per block.
+        generator (np.random.Generator): Underlying generator, also used for array draws.
+    """
+
+    def __init__(self, seed=None, block_size=65536):
+        """
+        Initialize the stream.
+
+        Args:
+            seed (int or np.random.SeedSequence): Seed; fresh OS entropy if None.
+            block_size (int): Number of variates drawn per block.
+        """
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        self.seed_seq = seed  # Set the seed
+        self.block_size = block_size  # Set the block size
+        self.generator = np.random.Generator(np.random.PCG64(seed))  # Create the generator
+        self._block_state = None  # Generator state before the current block was drawn
+        self._start([], 0)
+
+    def _start(self, block, position):
+        """
+        Start handing out variates from block at position, followed by fresh blocks.
+
+        Args:
+            block (list): Current block.
+            position (int): Number of variates of the block already handed out.
+        """
+        self._block_len = len(block)
+        self._block_iter = iter(block[position:])
+        # random() is the __next__ of a C-level chain over the block iterators, so a scalar
+        # draw runs no Python code except once per block
+        self.random = itertools.chain.from_iterable(self._blocks()).__next__
+
+    def _blocks(self):
+        """
+        Yield the iterator over the rest of the current block and then over fresh blocks.
+
+        The current iterator is kept in _block_iter, so get_state can find its position.
+
+        Yields:
+            iterator: List iterator over the variates of a block.
+        """
+        yield self._block_iter
+        while True:
+            self._block_state = self.generator.bit_generator.state
+            block = self.generator.random(self.block_size).tolist()
+            self._block_len = len(block)
+            self._block_iter = iter(block)
+            yield self._block_iter
+
+    def random_array(self, size):
+        """
+        Draw an array of uniform variates directly from the generator.
+
+        Args:
+            size (int or tuple): Output shape.
+
+        Returns:
+            np.ndarray: Uniform variates in [0, 1).
+        """
+        return self.generator.random(size)
+
+    def spawn(self, n):
+        """
+        Create independent child streams, e.g. one per parallel worker.
+
+        Args:
+            n (int): Number of child streams.
+
+        Returns:
+            list: List of RandomStream.
+        """
+        return [RandomStream(seed, self.block_size) for seed in self.seed_seq.spawn(n)]
+
+    def get_state(self):
+        """
+        Get the state of the stream, including the position in the current block.
+
+        The block itself is not stored; it is identified by the generator state it was
+        drawn from and drawn again on restore.
+
+        Returns:
+            dict: Picklable state.
+        """
+        position = self._block_len - operator.length_hint(self._block_iter)  # Variates handed out
+        return {"bit_generator": self.generator.bit_generator.state, "block_state": self._block_state,
+                "block_size": self._block_len, "position": position}
+
+    def set_state(self, state):
+        """
+        Restore a state returned by get_state.
+
+        Args:
+            state (dict): State of a stream.
+        """
+        block = []
+        if state["block_state"] is not None:  # Draw the current block again
+            self.generator.bit_generator.state = state["block_state"]
+            block = self.generator.random(state["block_size"]).tolist()
+        self.generator.bit_generator.state = state["bit_generator"]
+        self._block_state = state["block_state"]
+        self._start(block, state["position"])
+
+    def __getstate__(self):
+        """
+        Pickle the stream by its seed and state (the block generator itself cannot be pickled).
+        """
+        return {"seed_seq": self.seed_seq, "block_size": self.block_size, "state": self.get_state()}
+
+    def __setstate__(self, state):
+        """
+        Restore a pickled stream.
+        """
+        self.__init__(state["seed_seq"], state["block_size"])
+        self.set_state(state["state"])
+
+
+def as_random_stream(rng):
+    """
+    Turn a seed into a RandomStream, passing existing streams through.
+
+    Args:
+        rng (RandomStream, int, np.random.SeedSequence or None): Stream or seed.
+
+    Returns:
+        RandomStream: The stream.
+    """
+    return rng if isinstance(rng, RandomStream) else RandomStream(rng)
+
+
+class _WealthIndexMap(Mapping):
+    """
+    Read-only mapping from wealth levels to grid indices, computed arithmetically.
+
+    Behaves like the wealth_to_index dict of Environment without storing an entry per level.
+    """
+
+    def __init__(self, W_STEP, n_wealth):
+        self.W_STEP = W_STEP  # Set discretization step for wealth
+        self.n_wealth = n_wealth  # Set the number of wealth levels
+
+    def __getitem__(self, w):
+        if w % self.W_STEP != 0 or not 0 <= w < self.n_wealth * self.W_STEP:
+            raise KeyError(w)
+        return int(w // self.W_STEP)
+
+    def __iter__(self):
+        return iter(range(0, self.n_wealth * self.W_STEP, self.W_STEP))
+
+    def __len__(self):
+        return self.n_wealth
+
+
+class _ActionCandidateMap(_WealthIndexMap):
+    """
+    Read-only mapping from wealth levels to their action ranges, computed on access.
+    """
+
+    def __init__(self, W_STEP, n_wealth, ACTION_STEP):
+        super().__init__(W_STEP, n_wealth)
+        self.ACTION_STEP = ACTION_STEP  # Set discretization step for actions
+
+    def __getitem__(self, w):
+        super().__getitem__(w)  # Validate the wealth level
+        return range(0, w + 1, self.ACTION_STEP)
+
 
 class Environment:
     """
-    The Environment class represents the financial environment for the Q-learning agent.
+    The Environment class represents the financial environment for the Q-learning agent.
+
+    Attributes:
+        T (int): Total number of stages.
+        p (float): Probability of obtaining high return from risky asset.
+        a_ret (float): High return of risky asset.
+        b_ret (float): Low return of risky asset.
+        riskless_ret (float): Fixed return of riskless asset.
+        W_MAX (int): Maximum wealth.
+        W_STEP (int): Discretization step for wealth.
+        ACTION_STEP (int): Discretization step for actions.
+        alpha (float): Parameter for the utility function.
+        rng (RandomStream): Random stream for the risky-asset outcomes.
+        lazy (bool): Whether the per-pair transition tables were skipped.
+        n_assets (int): Number of risky assets, 1 here (see MultiAssetEnvironment).
+    """
+
+    n_assets = 1  # One risky asset
+
+    def __init__(self, T, p, a_ret, b_ret, riskless_ret, alpha, W_MAX, W_STEP, ACTION_STEP, rng=None, lazy=False):
+        """
+        Initialize the environment with the given parameters.
+
+        Args:
+            T (int): Total number of stages.
+            p (float): Probability of obtaining high return from risky asset.
+            a_ret (float): High return of risky asset.
+            b_ret (float): Low return of risky asset.
+            riskless_ret (float): Fixed return of risky asset.
+            alpha (float): Parameter for the utility function.
+            W_MAX (int): Maximum wealth.
+            W_STEP (int): Discretization step for wealth.
+            ACTION_STEP (int): Discretization step for actions.
+            rng (RandomStream or int): Random stream, or seed of a new one; unseeded if None.
+            lazy (bool): If True, skip the per-pair transition tables (computing next states
+                arithmetically instead) and replace the wealth dicts by arithmetic mappings,
+                so grids with millions of wealth levels fit in memory. Exact solving and
+                transition_outcomes() need the tables.
+        """
+        self.T = T  # Set total number of stages
+        self.p = p  # Set probability of obtaining high return from risky asset
+        self.a_ret = a_ret  # Set high return of risky asset
+        self.b_ret = b_ret  # Set low return of risky asset
+        self.riskless_ret = riskless_ret  # Set fixed return of riskless asset
+        self.W_MAX = W_MAX  # Set maximum wealth
+        self.W_STEP = W_STEP  # Set discretization step for wealth
+        self.ACTION_STEP = ACTION_STEP  # Set discretization step for actions
+        self.alpha = alpha  # Set parameter for the utility function
+        self.rng = as_random_stream(rng)  # Set the random stream
+
+        self.lazy = lazy  # Set the table mode
+
+        if lazy:  # Arithmetic mappings; per-level Python objects would not fit for huge grids
+            self.all_wealth_levels = range(0, W_MAX + 1, W_STEP)
+            n_wealth = len(self.all_wealth_levels)
+            self.wealth_to_index = _WealthIndexMap(W_STEP, n_wealth)
+            self.action_candidates = _ActionCandidateMap(W_STEP, n_wealth, ACTION_STEP)
+            self.wealth_values = np.arange(n_wealth, dtype=np.int64) * W_STEP
+            self.action_counts = self.wealth_values // ACTION_STEP + 1
+            self.action_offsets = np.concatenate(([0], np.cumsum(self.action_counts)[:-1]))
+            self.n_pairs = int(self.action_counts.sum())
+            self.next_index_up = self.next_index_down = None  # Next states are computed on demand
+            self.utility_table = self.utility(self.wealth_values.astype(float))
+            return
+
+        # Construct the list of discretized wealth levels
+        self.all_wealth_levels = list(range(0, W_MAX + 1, W_STEP))
+        # Create a mapping from wealth levels to their indices
+        self.wealth_to_index = {w: i for i, w in enumerate(self.all_wealth_levels)}
+        # Create a dictionary of action candidates for each wealth level (lazy ranges)
+        self.action_candidates = {
+            w: range(0, w + 1, ACTION_STEP) for w in self.all_wealth_levels
+        }
+
+        # Precompute the transition tables once; the hot loop then works on indices only.
+        # Number of valid actions of every wealth index; action index a_idx means x = a_idx * ACTION_STEP
+        self.action_counts = np.array(
+            [len(self.action_candidates[w]) for w in self.all_wealth_levels], dtype=np.int64
+        )
+        # The (w_idx, a_idx) pairs are packed row by row; row w_idx starts at action_offsets[w_idx]
+        self.action_offsets = np.concatenate(([0], np.cumsum(self.action_counts)[:-1]))
+        self.n_pairs = int(self.action_counts.sum())
+        w_of_pair = np.repeat(np.arange(len(self.all_wealth_levels)), self.action_counts)
+        a_of_pair = np.arange(self.n_pairs) - self.action_offsets[w_of_pair]
+        # Next wealth index for the up and down outcomes of every packed (w_idx, a_idx) pair
+        self.next_index_up = self.next_wealth_index(w_of_pair, a_of_pair, a_ret).astype(np.int32)
+        self.next_index_down = self.next_wealth_index(w_of_pair, a_of_pair, b_ret).astype(np.int32)
+        # Wealth value and terminal utility of every wealth index
+        self.wealth_values = np.asarray(self.all_wealth_levels, dtype=np.int64)
+        self.utility_table = self.utility(self.wealth_values.astype(float))
+
+    def get_next_state(self, w, x):
+        """
+        Calculate the next state based on the current state and action.
+
+        The action is validated by action_index before the transition tables are read, so an
+        infeasible or off-grid amount raises KeyError instead of using another pair's entry.
+
+        Args:
+            w (int): Current wealth.
+            x (int): Investment amount.
+
+        Returns:
+            int: Next state (wealth).
+        """
+        w_idx = self.wealth_to_index[w]
+        a_idx = self.action_index(w_idx, x)  # Checked action index
+        w_next_idx = self.step_index(w_idx, a_idx)
+        return self.all_wealth_levels[w_next_idx]  # Return the next wealth level
+
+    def action_index(self, w_idx, x):
+        """
+        Get the action index of an investment amount.
+
+        Like the action dicts it replaces, it raises KeyError for an amount that is not a
+        multiple of ACTION_STEP or not within 0..w, instead of aliasing another state's cells.
+
+        Args:
+            w_idx (int): Current wealth index.
+            x (int): Investment amount.
+
+        Returns:
+            int: Action index.
+        """
+        if x % self.ACTION_STEP != 0 or not 0 <= x <= self.wealth_values[w_idx]:
+            raise KeyError(x)
+        return int(x // self.ACTION_STEP)
+
+    def step_index(self, w_idx, a_idx):
+        """
+        Sample the next wealth index from the precomputed transition tables.
+
+        Args:
+            w_idx (int): Current wealth index.
+            a_idx (int): Action index (investment amount / ACTION_STEP).
+
+        Returns:
+            int: Next wealth index.
+        """
+        if self.next_index_up is None:  # Lazy environment: compute the next index arithmetically
+            ret_risky = self.a_ret if self.rng.random() < self.p else self.b_ret
+            x = a_idx * float(self.ACTION_STEP)
+            w_float = x * (1.0 + ret_risky) + (w_idx * float(self.W_STEP) - x) * (1.0 + self.riskless_ret)
+            return min(max(round(w_float / self.W_STEP), 0), len(self.all_wealth_levels) - 1)
+
+        pair = self.action_offsets[w_idx] + a_idx  # Position of the (w_idx, a_idx) pair
+        # Determine the outcome of the risky asset and look up the next wealth index
+        if self.rng.random() < self.p:
+            return int(self.next_index_up[pair])
+        return int(self.next_index_down[pair])
+
+    def sample_next_index(self, w_idx, a_idx, u):
+        """
+        Vectorized transition: map uniform draws to next wealth indices.
+
+        Args:
+            w_idx (np.ndarray): Current wealth indices.
+            a_idx (np.ndarray): Action indices.
+            u (np.ndarray): Uniform draws in [0, 1), one per transition.
+
+        Returns:
+            np.ndarray: Next wealth indices.
+        """
+        up = u < self.p  # High return of the risky asset
+        if self.next_index_up is None:  # Lazy environment: compute the next indices arithmetically
+            return self.next_wealth_index(w_idx, a_idx, np.where(up, self.a_ret, self.b_ret))
+        pair = self.pair_index(w_idx, a_idx)
+        return np.where(up, self.next_index_up[pair], self.next_index_down[pair])
+
+    def pair_index(self, w_idx, a_idx):
+        """
+        Get the position of (w_idx, a_idx) pairs in the packed transition tables.
+
+        Args:
+            w_idx (int or np.ndarray): Wealth index (or indices).
+            a_idx (int or np.ndarray): Action index (or indices).
+
+        Returns:
+            int or np.ndarray: Packed pair position(s).
+        """
+        return self.action_offsets[w_idx] + a_idx
+
+    def next_wealth_index(self, w_idx, a_idx, ret_risky):
+        """
+        Vectorized counterpart of get_next_state working on grid indices.
+
+        Args:
+            w_idx (np.ndarray): Current wealth indices.
+            a_idx (np.ndarray): Action indices (investment amount / ACTION_STEP).
+            ret_risky (float or np.ndarray): Realized return of the risky asset.
+
+        Returns:
+            np.ndarray: Next wealth indices, rounded and clipped as in get_next_state.
+        """
+        w = np.asarray(w_idx) * float(self.W_STEP)  # Current wealth values
+        x = np.asarray(a_idx) * float(self.ACTION_STEP)  # Investment amounts
+        w_float = x * (1.0 + ret_risky) + (w - x) * (1.0 + self.riskless_ret)
+        # Discretize and keep within the wealth grid
+        return np.clip(np.rint(w_float / self.W_STEP).astype(np.int64), 0, len(self.all_wealth_levels) - 1)
+
+    def utility(self, w):
+        """
+        Calculate the exponential utility of wealth.
+
+        Args:
+            w (float): Wealth.
+
+        Returns:
+            float: Utility value.
+        """
+        return -np.exp(-self.alpha * w) / self.alpha  # Calculate and return the utility value
+
+    def certainty_equivalent(self, u):
+        """
+        Calculate the wealth whose utility equals a given (expected) utility.
+
+        Args:
+            u (float or np.ndarray): Utility value(s), negative.
+
+        Returns:
+            float or np.ndarray: Certainty equivalent wealth.
+        """
+        return -np.log(-self.alpha * np.asarray(u)) / self.alpha  # Invert the exponential utility
+
+    def get_reward(self, t, w):
+        """
+        Calculate the reward based on the current time step and wealth.
+
+        Args:
+            t (int): Current time step.
+            w (int): Current wealth.
+
+        Returns:
+            float: Reward value.
+        """
+        if t == self.T - 1:  # If it is the last time step
+            return self.utility(w)  # Return the utility as the reward
+        return 0.0  # Otherwise, return 0 as the reward
+
+    def get_reward_index(self, t, w_idx):
+        """
+        Calculate the reward for a wealth index, using the precomputed utilities.
+
+        Args:
+            t (int): Current time step.
+            w_idx (int or np.ndarray): Wealth index (or indices).
+
+        Returns:
+            float or np.ndarray: Reward value(s).
+        """
+        if t == self.T - 1:  # If it is the last time step
+            return self.utility_table[w_idx]  # Return the utility as the reward
+        return 0.0  # Otherwise, return 0 as the reward
+
+    def transition_outcomes(self):
+        """
+        List the outcomes of the transition model.
+
+        Returns:
+            list: (probability, next wealth index table) pairs; each table holds the next
+                wealth index of every packed (w_idx, a_idx) pair, see pair_index. A
+                probability is a scalar or, in subclasses, an array over the pairs.
+        """
+        if self.next_index_up is None:
+            raise ValueError("transition tables are not built for a lazy Environment")
+        return [(self.p, self.next_index_up), (1.0 - self.p, self.next_index_down)]
+
+    def _outcome_next_indices(self, w_idx, a_idx):
+        """
+        Get the next wealth indices of (w_idx, a_idx) pairs under every possible outcome.
+
+        Args:
+            w_idx (np.ndarray): Wealth indices.
+            a_idx (np.ndarray): Action indices.
+
+        Returns:
+            list: Next wealth indices, one array per outcome; pairs for which an outcome has
+                zero probability are left out of its array.
+        """
+        if self.lazy:  # No tables: compute the next states arithmetically
+            return [self.next_wealth_index(w_idx, a_idx, ret)
+                    for prob, ret in ((self.p, self.a_ret), (1.0 - self.p, self.b_ret)) if prob > 0]
+        pair = self.pair_index(w_idx, a_idx)
+        return [next_idx[pair][np.broadcast_to(prob, next_idx.shape)[pair] > 0]
+                for prob, next_idx in self.transition_outcomes()]
+
+    def reachable_states(self, initial_wealth):
+        """
+        Find the states that can be reached from an initial wealth under some policy.
+
+        Args:
+            initial_wealth (float): Wealth at t = 0.
+
+        Returns:
+            np.ndarray: Boolean mask of shape (T, n_wealth).
+        """
+        reachable = np.zeros((self.T, len(self.all_wealth_levels)), dtype=bool)
+        reachable[0, self.wealth_to_index[initial_wealth]] = True
+        for t in range(self.T - 1):  # Expand every action of the states reached at t
+            w_idx = np.flatnonzero(reachable[t])
+            counts = self.action_counts[w_idx]
+            pair_w = np.repeat(w_idx, counts)
+            pair_a = np.arange(len(pair_w)) - np.repeat(np.cumsum(counts) - counts, counts)
+            for next_idx in self._outcome_next_indices(pair_w, pair_a):
+                reachable[t + 1, next_idx] = True
+        return reachable
+
+
+class NonUniformEnvironment(Environment):
+    """
+    The NonUniformEnvironment class is an Environment on an arbitrary sorted wealth grid.
+
+    Resolution can be concentrated where it matters (e.g. a log-spaced grid, see
+    log_grid) instead of one W_STEP over 0..W_MAX. Actions are fractions of the current
+    wealth, so every wealth level has the same number of actions. A next wealth that
+    falls between two grid points is mapped either to the nearest point or, with
+    interpolation="linear", to one of the two neighbours at random with probabilities
+    that preserve the expected wealth.
+
+    Attributes:
+        wealth_grid (np.ndarray): Sorted wealth levels.
+        action_fractions (np.ndarray): Invested fractions of wealth.
+        interpolation (str): "nearest" or "linear".
+        upper_weight_up (np.ndarray): Probability of the upper neighbour after the high
+            return, per pair ("linear" only, otherwise None).
+        upper_weight_down (np.ndarray): The same after the low return.
+    """
+
+    def __init__(self, T, p, a_ret, b_ret, riskless_ret, alpha, wealth_grid, action_fractions,
+                 interpolation="nearest", rng=None):
+        """
+        Initialize the environment.
+
+        Args:
+            T (int): Total number of stages.
+            p (float): Probability of obtaining high return from risky asset.
+            a_ret (float): High return of risky asset.
+            b_ret (float): Low return of risky asset.
+            riskless_ret (float): Fixed return of riskless asset.
+            alpha (float): Parameter for the utility function.
+            wealth_grid (array-like): Wealth levels, sorted and unique after conversion.
+            action_fractions (array-like): Invested fractions of wealth in [0, 1].
+            interpolation (str): "nearest" or "linear".
+            rng (RandomStream or int): Random stream, or seed of a new one; unseeded if None.
+        """
+        if interpolation not in ("nearest", "linear"):
+            raise ValueError(f"Unknown interpolation: {interpolation}")
+        self.T = T  # Set total number of stages
+        self.p = p  # Set probability of obtaining high return from risky asset
+        self.a_ret = a_ret  # Set high return of risky asset
+        self.b_ret = b_ret  # Set low return of risky asset
+        self.riskless_ret = riskless_ret  # Set fixed return of riskless asset
+        self.alpha = alpha  # Set parameter for the utility function
+        self.rng = as_random_stream(rng)  # Set the random stream
+        self.lazy = False  # The transition tables are always built
+        self.interpolation = interpolation  # Set the next-state mapping
+        self.wealth_grid = np.unique(np.asarray(wealth_grid, dtype=float))  # Set the sorted wealth levels
+        self.action_fractions = np.asarray(action_fractions, dtype=float)  # Set the invested fractions
+        self.W_MAX = float(self.wealth_grid[-1])  # Set maximum wealth
+        self.W_STEP = self.ACTION_STEP = None  # No uniform steps
+
+        # Grid mappings as in Environment, with values from the grid
+        self.all_wealth_levels = self.wealth_grid.tolist()
+        self.wealth_to_index = {w: i for i, w in enumerate(self.all_wealth_levels)}
+        self.action_candidates = {w: (w * self.action_fractions).tolist() for w in self.all_wealth_levels}
+        self.wealth_values = self.wealth_grid
+        n_wealth, n_actions = len(self.wealth_grid), len(self.action_fractions)
+        self.action_counts = np.full(n_wealth, n_actions, dtype=np.int64)
+        self.action_offsets = np.arange(n_wealth, dtype=np.int64) * n_actions
+        self.n_pairs = n_wealth * n_actions
+
+        # Lower (or nearest) neighbour and upper-neighbour probability of every pair and outcome
+        w_of_pair = np.repeat(np.arange(n_wealth), n_actions)
+        a_of_pair = np.tile(np.arange(n_actions), n_wealth)
+        self.next_index_up, self.upper_weight_up = self._locate(self.next_wealth_value(w_of_pair, a_of_pair, a_ret))
+        self.next_index_down, self.upper_weight_down = self._locate(self.next_wealth_value(w_of_pair, a_of_pair, b_ret))
+        self.utility_table = self.utility(self.wealth_grid)
+
+    @staticmethod
+    def log_grid(W_MAX, n_levels, W_MIN=1.0, include=()):
+        """
+        Build a wealth grid of 0 and n_levels - 1 log-spaced levels from W_MIN to W_MAX.
+
+        Args:
+            W_MAX (float): Largest wealth level.
+            n_levels (int): Number of levels before adding `include`.
+            W_MIN (float): Smallest positive wealth level.
+            include (iterable): Extra levels to add, e.g. the initial wealth.
+
+        Returns:
+            np.ndarray: Sorted unique wealth levels.
+        """
+        return np.unique(np.concatenate(([0.0], np.geomspace(W_MIN, W_MAX, n_levels - 1), list(include))))
+
+    def next_wealth_value(self, w_idx, a_idx, ret_risky):
+        """
+        Compute the next wealth before mapping it onto the grid.
+
+        Args:
+            w_idx (np.ndarray): Current wealth indices.
+            a_idx (np.ndarray): Action indices.
+            ret_risky (float or np.ndarray): Realized return of the risky asset.
+
+        Returns:
+            np.ndarray: Next wealth values.
+        """
+        w = self.wealth_grid[w_idx]
+        x = w * self.action_fractions[a_idx]  # Investment amounts
+        return x * (1.0 + ret_risky) + (w - x) * (1.0 + self.riskless_ret)
+
+    def _locate(self, w_float):
+        """
+        Map wealth values onto the grid.
+
+        Args:
+            w_float (np.ndarray): Wealth values.
+
+        Returns:
+            tuple: (nearest index, None) for "nearest"; (lower neighbour index, probability
+                of the upper neighbour) for "linear". Values outside the grid are clipped.
+        """
+        grid = self.wealth_grid
+        w_float = np.clip(w_float, grid[0], grid[-1])
+        lower = np.clip(np.searchsorted(grid, w_float, side="right") - 1, 0, len(grid) - 2)
+        weight = (w_float - grid[lower]) / (grid[lower + 1] - grid[lower])  # Position between the neighbours
+        if self.interpolation == "nearest":
+            return (lower + (weight >= 0.5)).astype(np.int32), None
+        return lower.astype(np.int32), weight
+
+    def next_wealth_index(self, w_idx, a_idx, ret_risky):
+        """
+        Map the next wealth to its nearest grid index (the expected index for "linear").
+
+        Args:
+            w_idx (np.ndarray): Current wealth indices.
+            a_idx (np.ndarray): Action indices.
+            ret_risky (float or np.ndarray): Realized return of the risky asset.
+
+        Returns:
+            np.ndarray: Next wealth indices.
+        """
+        lower, weight = self._locate(self.next_wealth_value(w_idx, a_idx, ret_risky))
+        return lower if weight is None else lower + (weight >= 0.5)
+
+    def action_index(self, w_idx, x):
+        """
+        Get the action index of an investment amount.
+
+        As in Environment.action_index, an amount that is not one of the candidates of the
+        wealth level (up to floating-point rounding) raises KeyError.
+
+        Args:
+            w_idx (int): Current wealth index.
+            x (float): Investment amount.
+
+        Returns:
+            int: Action index.
+        """
+        amounts = self.action_fractions * self.wealth_grid[w_idx]  # Candidate amounts
+        a_idx = int(np.argmin(np.abs(amounts - x)))  # Closest candidate; the first one at zero wealth
+        if not np.isclose(amounts[a_idx], x, rtol=1e-9, atol=1e-9):
+            raise KeyError(x)
+        return a_idx
+
+    def step_index(self, w_idx, a_idx):
+        """
+        Sample the next wealth index with one uniform draw.
+
+        Args:
+            w_idx (int): Current wealth index.
+            a_idx (int): Action index.
+
+        Returns:
+            int: Next wealth index.
+        """
+        pair = self.action_offsets[w_idx] + a_idx  # Position of the (w_idx, a_idx) pair
+        u = self.rng.random()
+        if u < self.p:  # High return of the risky asset
+            lower, weight, u_within = self.next_index_up[pair], self.upper_weight_up, u / self.p
+        else:
+            lower, weight, u_within = self.next_index_down[pair], self.upper_weight_down, (u - self.p) / (1.0 - self.p)
+        if weight is not None and u_within < weight[pair]:  # Upper neighbour under linear interpolation
+            return int(lower) + 1
+        return int(lower)
+
+    def sample_next_index(self, w_idx, a_idx, u):
+        """
+        Vectorized transition: map uniform draws to next wealth indices.
+
+        The draw u selects the risky-asset outcome; rescaled to [0, 1) within that outcome,
+        it also selects the grid neighbour under linear interpolation.
+
+        Args:
+            w_idx (np.ndarray): Current wealth indices.
+            a_idx (np.ndarray): Action indices.
+            u (np.ndarray): Uniform draws in [0, 1), one per transition.
+
+        Returns:
+            np.ndarray: Next wealth indices.
+        """
+        pair = self.pair_index(w_idx, a_idx)
+        up = u < self.p  # High return of the risky asset
+        lower = np.where(up, self.next_index_up[pair], self.next_index_down[pair])
+        if self.interpolation == "nearest":
+            return lower
+        u_within = np.where(up, u / self.p, (u - self.p) / (1.0 - self.p))  # Uniform within the outcome
+        weight = np.where(up, self.upper_weight_up[pair], self.upper_weight_down[pair])
+        return lower + (u_within < weight)
+
+    def transition_outcomes(self):
+        """
+        List the outcomes of the transition model.
+
+        Returns:
+            list: (probability, next wealth index table) pairs, see Environment; under
+                linear interpolation the probabilities are arrays over the pairs.
+        """
+        if self.interpolation == "nearest":
+            return [(self.p, self.next_index_up), (1.0 - self.p, self.next_index_down)]
+        outcomes = []
+        for prob, lower, weight in ((self.p, self.next_index_up, self.upper_weight_up),
+                                    (1.0 - self.p, self.next_index_down, self.upper_weight_down)):
+            outcomes.append((prob * (1.0 - weight), lower))
+            outcomes.append((prob * weight, lower + 1))
+        return outcomes
+
+
+@functools.lru_cache(maxsize=32)
+def _binomial_table(max_c, k):
+    """
+    Tabulate binomial coefficients C(c, j) for c = 0..max_c and j = 0..k.
+
+    Tables are cached, so the scalar steps of a lazy MultiAssetEnvironment do not rebuild them.
+
+    Args:
+        max_c (int): Largest c.
+        k (int): Largest j.
+
+    Returns:
+        np.ndarray: Read-only int64 table of shape (k + 1, max_c + 1).
+    """
+    table = np.zeros((k + 1, max_c + 1), dtype=np.int64)
+    table[0] = 1
+    for j in range(1, k + 1):  # Pascal's rule: C(c, j) = C(c - 1, j - 1) + C(c - 1, j)
+        table[j, 1:] = np.cumsum(table[j - 1, :-1])
+    table.setflags(write=False)
+    return table
+
+
+def simplex_count(units, n_assets):
+    """
+    Count the allocations of at most `units` units over n_assets assets.
+
+    Args:
+        units (int or np.ndarray): Budget(s) in units.
+        n_assets (int): Number of assets.
+
+    Returns:
+        np.ndarray: C(units + n_assets, n_assets) per budget.
+    """
+    units = np.asarray(units, dtype=np.int64)
+    return _binomial_table(int(units.max(initial=0)) + n_assets, n_assets)[n_assets, units + n_assets].copy()
+
+
+def simplex_rank(allocations):
+    """
+    Encode allocations of units over assets as integers.
+
+    An allocation (k_1, ..., k_n) maps to the combination c_j = k_1 + ... + k_j + j - 1,
+    whose colexicographic rank sum_j C(c_j, j) is the code. Allocations with a smaller
+    total come first, so the allocations within a budget of m units are exactly the codes
+    0 .. C(m + n, n) - 1, and for one asset the code is the number of units.
+
+    Args:
+        allocations (array-like): Units per asset, shape (..., n_assets).
+
+    Returns:
+        np.ndarray: Codes, shape (...).
+    """
+    allocations = np.asarray(allocations, dtype=np.int64)
+    n_assets = allocations.shape[-1]
+    c = np.cumsum(allocations, axis=-1) + np.arange(n_assets)  # Strictly increasing combination
+    max_c = n_assets
+    while max_c < c.max(initial=0):  # Round up so the cached tables are reused
+        max_c *= 2
+    table = _binomial_table(max_c, n_assets)
+    return sum(table[j + 1, c[..., j]] for j in range(n_assets))
+
+
+def simplex_unrank(codes, n_assets):
+    """
+    Decode integers produced by simplex_rank back into allocations.
+
+    Args:
+        codes (int or np.ndarray): Codes.
+        n_assets (int): Number of assets.
+
+    Returns:
+        np.ndarray: Units per asset, shape codes.shape + (n_assets,).
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    max_c = n_assets
+    while _binomial_table(max_c, n_assets)[n_assets, -1] <= codes.max(initial=0):  # Cover the largest code
+        max_c *= 2
+    table = _binomial_table(max_c, n_assets)
+    rest = codes.copy()
+    c = np.empty(codes.shape + (n_assets,), dtype=np.int64)
+    for j in range(n_assets, 0, -1):  # Greedy: largest c_j with C(c_j, j) <= rest
+        c[..., j - 1] = np.searchsorted(table[j], rest, side="right") - 1
+        rest -= table[j, c[..., j - 1]]
+    totals = c - np.arange(n_assets)  # Partial sums k_1 + ... + k_j
+    return np.diff(totals, axis=-1, prepend=0)
+
+
+class _AllocationRange:
+    """
+    Read-only sequence of the allocations of one wealth level, decoded on access.
+    """
+
+    def __init__(self, count, n_assets, ACTION_STEP):
+        self.count = count  # Set the number of allocations
+        self.n_assets = n_assets  # Set the number of risky assets
+        self.ACTION_STEP = ACTION_STEP  # Set discretization step for actions
+
+    def __getitem__(self, a_idx):
+        if not 0 <= a_idx < self.count:
+            raise IndexError(a_idx)
+        return tuple((simplex_unrank(a_idx, self.n_assets) * self.ACTION_STEP).tolist())
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return (self[a_idx] for a_idx in range(self.count))
+
+
+class _AllocationMap(_WealthIndexMap):
+    """
+    Read-only mapping from wealth levels to their allocation sequences.
+    """
+
+    def __init__(self, W_STEP, action_counts, n_assets, ACTION_STEP):
+        super().__init__(W_STEP, len(action_counts))
+        self.action_counts = action_counts  # Set the number of allocations per wealth index
+        self.n_assets = n_assets  # Set the number of risky assets
+        self.ACTION_STEP = ACTION_STEP  # Set discretization step for actions
+
+    def __getitem__(self, w):
+        w_idx = super().__getitem__(w)  # Validate the wealth level
+        return _AllocationRange(int(self.action_counts[w_idx]), self.n_assets, self.ACTION_STEP)
+
+
+class MultiAssetEnvironment(Environment):
+    """
+    The MultiAssetEnvironment class is an Environment with several correlated risky assets.
+
+    The risky returns of a stage are drawn jointly from an outcome table (one row of
+    returns per outcome, with its probability), which can express any correlation. An
+    action allocates a multiple of ACTION_STEP to every risky asset, in total at most the
+    current wealth, with the rest in the riskless asset. Instead of a Cartesian product
+    of per-asset amounts, the feasible allocations form a simplex grid and are encoded
+    as integers by simplex_rank: the allocations of a wealth level are exactly the action
+    indices 0 .. action_counts[w_idx] - 1 and are decoded on demand, so Q-tables (use
+    q_layout="packed"), the greedy argmax and the transition tables scale with the number
+    of feasible allocations. With one asset the encoding is the number of units and the
+    environment matches Environment.
+
+    Attributes:
+        returns (np.ndarray): Risky returns per outcome, shape (n_outcomes, n_assets).
+        probs (np.ndarray): Probability of every outcome.
+        n_assets (int): Number of risky assets.
+        next_index (np.ndarray): Next wealth index per outcome and packed pair, shape
+            (n_outcomes, n_pairs); None if lazy.
+    """
+
+    def __init__(self, T, returns, probs, riskless_ret, alpha, W_MAX, W_STEP, ACTION_STEP, rng=None, lazy=False):
+        """
+        Initialize the environment.
+
+        Args:
+            T (int): Total number of stages.
+            returns (array-like): Risky returns per outcome, shape (n_outcomes, n_assets).
+            probs (array-like): Probability of every outcome, summing to 1.
+            riskless_ret (float): Fixed return of riskless asset.
+            alpha (float): Parameter for the utility function.
+            W_MAX (int): Maximum wealth.
+            W_STEP (int): Discretization step for wealth.
+            ACTION_STEP (int): Discretization step for the amount of every risky asset.
+            rng (RandomStream or int): Random stream, or seed of a new one; unseeded if None.
+            lazy (bool): If True, skip the per-pair transition tables and compute next
+                states arithmetically, as for Environment.
+        """
+        returns = np.asarray(returns, dtype=float)
+        returns = returns.reshape(len(returns), -1)  # One column per asset
+        probs = np.asarray(probs, dtype=float)
+        if probs.shape != (len(returns),) or np.any(probs < 0) or not np.isclose(probs.sum(), 1.0):
+            raise ValueError("probs must hold one non-negative probability per outcome, summing to 1")
+        self.T = T  # Set total number of stages
+        self.returns = returns  # Set the joint outcome table
+        self.probs = probs  # Set the outcome probabilities
+        self.n_assets = returns.shape[1]  # Set the number of risky assets
+        self.riskless_ret = riskless_ret  # Set fixed return of riskless asset
+        self.alpha = alpha  # Set parameter for the utility function
+        self.W_MAX = W_MAX  # Set maximum wealth
+        self.W_STEP = W_STEP  # Set discretization step for wealth
+        self.ACTION_STEP = ACTION_STEP  # Set discretization step for actions
+        self.rng = as_random_stream(rng)  # Set the random stream
+        self.lazy = lazy  # Set the table mode
+        self._cum_probs = np.cumsum(probs)  # Outcome boundaries for the uniform draws
+
+        # Arithmetic wealth mappings and simplex allocation counts
+        self.all_wealth_levels = range(0, W_MAX + 1, W_STEP)
+        n_wealth = len(self.all_wealth_levels)
+        self.wealth_to_index = _WealthIndexMap(W_STEP, n_wealth)
+        self.wealth_values = np.arange(n_wealth, dtype=np.int64) * W_STEP
+        self.action_counts = simplex_count(self.wealth_values // ACTION_STEP, self.n_assets)
+        self.action_offsets = np.concatenate(([0], np.cumsum(self.action_counts)[:-1]))
+        self.n_pairs = int(self.action_counts.sum())
+        self.action_candidates = _AllocationMap(W_STEP, self.action_counts, self.n_assets, ACTION_STEP)
+        self.utility_table = self.utility(self.wealth_values.astype(float))
+
+        self.next_index = None  # Next states are computed on demand when lazy
+        if not lazy:  # Next wealth index of every outcome and packed (w_idx, a_idx) pair
+            w_of_pair = np.repeat(np.arange(n_wealth), self.action_counts)
+            a_of_pair = np.arange(self.n_pairs) - self.action_offsets[w_of_pair]
+            self.next_index = np.stack([self.next_wealth_index(w_of_pair, a_of_pair, o)
+                                        for o in range(len(probs))]).astype(np.int32)
+
+    @staticmethod
+    def independent_outcomes(p, a_ret, b_ret):
+        """
+        Build the joint outcome table of independent two-point risky assets.
+
+        Args:
+            p (array-like): Probability of the high return of every asset.
+            a_ret (array-like): High return of every asset.
+            b_ret (array-like): Low return of every asset.
+
+        Returns:
+            tuple: (returns of shape (2 ** n_assets, n_assets), probabilities).
+        """
+        p, a_ret, b_ret = (np.atleast_1d(np.asarray(v, dtype=float)) for v in (p, a_ret, b_ret))
+        high = np.array(np.meshgrid(*[[True, False]] * len(p), indexing="ij")).reshape(len(p), -1).T
+        returns = np.where(high, a_ret, b_ret)
+        probs = np.prod(np.where(high, p, 1.0 - p), axis=1)
+        return returns, probs
+
+    def allocation(self, a_idx):
+        """
+        Decode action indices into the amounts invested in every risky asset.
+
+        Args:
+            a_idx (int or np.ndarray): Action index (or indices).
+
+        Returns:
+            np.ndarray: Amounts, shape a_idx.shape + (n_assets,).
+        """
+        return simplex_unrank(a_idx, self.n_assets) * self.ACTION_STEP
+
+    def action_index(self, w_idx, x):
+        """
+        Get the action index of an allocation.
+
+        Raises KeyError, like Environment.action_index, unless every amount is a non-negative
+        multiple of ACTION_STEP and the total is within the wealth.
+
+        Args:
+            w_idx (int): Current wealth index.
+            x (sequence): Amount invested in every risky asset.
+
+        Returns:
+            int: Action index.
+        """
+        x = np.asarray(x)
+        if (x.shape != (self.n_assets,) or np.any(x % self.ACTION_STEP != 0) or np.any(x < 0)
+                or x.sum() > self.wealth_values[w_idx]):
+            raise KeyError(tuple(x.tolist()))
+        return int(simplex_rank(x // self.ACTION_STEP))
+
+    def outcome_index(self, u):
+        """
+        Map uniform draws to outcome indices.
+
+        Args:
+            u (float or np.ndarray): Uniform draw(s) in [0, 1).
+
+        Returns:
+            int or np.ndarray: Outcome index (or indices).
+        """
+        return np.minimum(np.searchsorted(self._cum_probs, u, side="right"), len(self.probs) - 1)
+
+    def next_wealth_index(self, w_idx, a_idx, outcome):
+        """
+        Vectorized next wealth index for given outcomes.
+
+        Args:
+            w_idx (np.ndarray): Current wealth indices.
+            a_idx (np.ndarray): Action indices.
+            outcome (int or np.ndarray): Outcome index (or indices).
+
+        Returns:
+            np.ndarray: Next wealth indices, rounded and clipped to the grid.
+        """
+        w = np.asarray(w_idx) * float(self.W_STEP)  # Current wealth values
+        x = self.allocation(a_idx).astype(float)  # Amounts per risky asset
+        w_float = (x * (1.0 + self.returns[outcome])).sum(axis=-1) + (w - x.sum(axis=-1)) * (1.0 + self.riskless_ret)
+        # Discretize and keep within the wealth grid
+        return np.clip(np.rint(w_float / self.W_STEP).astype(np.int64), 0, len(self.all_wealth_levels) - 1)
+
+    def step_index(self, w_idx, a_idx):
+        """
+        Sample the next wealth index.
+
+        Args:
+            w_idx (int): Current wealth index.
+            a_idx (int): Action index.
+
+        Returns:
+            int: Next wealth index.
+        """
+        outcome = int(self.outcome_index(self.rng.random()))
+        if self.next_index is None:  # Lazy environment: decode the allocation
+            return int(self.next_wealth_index(w_idx, a_idx, outcome))
+        return int(self.next_index[outcome, self.action_offsets[w_idx] + a_idx])
+
+    def sample_next_index(self, w_idx, a_idx, u):
+        """
+        Vectorized transition: map uniform draws to next wealth indices.
+
+        Args:
+            w_idx (np.ndarray): Current wealth indices.
+            a_idx (np.ndarray): Action indices.
+            u (np.ndarray): Uniform draws in [0, 1), one per transition.
+
+        Returns:
+            np.ndarray: Next wealth indices.
+        """
+        outcome = self.outcome_index(u)
+        if self.next_index is None:
+            return self.next_wealth_index(w_idx, a_idx, outcome)
+        return self.next_index[outcome, self.pair_index(w_idx, a_idx)]
+
+    def transition_outcomes(self):
+        """
+        List the outcomes of the transition model.
+
+        Returns:
+            list: (probability, next wealth index table) pairs, one per joint outcome.
+        """
+        if self.next_index is None:
+            raise ValueError("transition tables are not built for a lazy Environment")
+        return [(prob, next_idx) for prob, next_idx in zip(self.probs.tolist(), self.next_index)]
+
+    def _outcome_next_indices(self, w_idx, a_idx):
+        """
+        Get the next wealth indices of (w_idx, a_idx) pairs under every possible outcome.
+
+        Args:
+            w_idx (np.ndarray): Wealth indices.
+            a_idx (np.ndarray): Action indices.
+
+        Returns:
+            list: Next wealth indices, one array per outcome of nonzero probability.
+        """
+        if self.lazy:  # No tables: decode the allocations
+            return [self.next_wealth_index(w_idx, a_idx, outcome) for outcome in np.flatnonzero(self.probs)]
+        return super()._outcome_next_indices(w_idx, a_idx)
+
+
+class QTable:
+    """
+    The QTable class stores the Q-values of all (t, wealth index, action index) cells.
+
+    Every (t, wealth index) owns one row of action values. The rows of stage t are stored
+    back to back in data[t], row w_idx starting at offsets[w_idx], so an action is found
+    arithmetically as data[t, offsets[w_idx] + a_idx]. The "dense" layout pads every row to
+    the largest action count (the classic (T, n_wealth, max_act_count) array); the "packed"
+    layout keeps only the action_counts[w_idx] valid slots, which is about half the memory
+    on the triangular action sets of the Environment.
+
+    Attributes:
+        T (int): Total number of stages.
+        counts (np.ndarray): Number of actions of every wealth index.
+        layout (str): "dense" or "packed".
+        offsets (np.ndarray): Start of every wealth row within a stage.
+        data (np.ndarray): Q-values, shape (T, row_size).
+    """
+
+    def __init__(self, T, action_counts, layout="dense", dtype=np.float64):
+        """
+        Initialize a zero Q-table.
+
+        Args:
+            T (int): Total number of stages.
+            action_counts (np.ndarray): Number of actions of every wealth index.
+            layout (str): "dense" or "packed".
+            dtype (np.dtype): Floating point type of the Q-values, e.g. np.float32.
+        """
+        if layout not in ("dense", "packed"):
+            raise ValueError(f"Unknown Q-table layout: {layout}")
+        self.T = T  # Set total number of stages
+        self.counts = np.asarray(action_counts, dtype=np.int64)  # Set the action counts
+        self.layout = layout  # Set the storage layout
+        self.max_count = int(self.counts.max())  # Largest action count
+
+        if layout == "packed":  # Rows stored back to back without padding
+            self.offsets = np.concatenate(([0], np.cumsum(self.counts)[:-1]))
+            row_size = int(self.counts.sum())
+        else:  # Rows padded to the largest action count
+            self.offsets = np.arange(len(self.counts)) * self.max_count
+            row_size = len(self.counts) * self.max_count
+        self.data = np.zeros((T, row_size), dtype=dtype)
+
+    @property
+    def array(self):
+        """
+        np.ndarray: View of the Q-values, (T, n_wealth, max_act_count) for the dense
+        layout and (T, n_pairs) for the packed layout.
+        """
+        if self.layout == "dense":
+            return self.data.reshape(self.T, len(self.counts), self.max_count)
+        return self.data
+
+    @property
+    def nbytes(self):
+        """
+        int: Memory used by the Q-values and the row offsets.
+        """
+        return self.data.nbytes + self.offsets.nbytes + self.counts.nbytes
+
+    def row(self, t, w_idx):
+        """
+        Get the valid action values of one state as a view.
+
+        Args:
+            t (int): Time step.
+            w_idx (int): Wealth index.
+
+        Returns:
+            np.ndarray: Q-values of the actions of the state.
+        """
+        start = self.offsets[w_idx]
+        return self.data[t, start:start + self.counts[w_idx]]
+
+    def write_row(self, t, w_idx):
+        """
+        Get the action values of one state as a writable view (same as row).
+
+        Args:
+            t (int): Time step.
+            w_idx (int): Wealth index.
+
+        Returns:
+            np.ndarray: Q-values of the actions of the state.
+        """
+        return self.row(t, w_idx)
+
+    def flat_index(self, w_idx, a_idx):
+        """
+        Get the position of (w_idx, a_idx) cells within a stage row data[t].
+
+        Args:
+            w_idx (int or np.ndarray): Wealth index (or indices).
+            a_idx (int or np.ndarray): Action index (or indices).
+
+        Returns:
+            int or np.ndarray: Cell position(s).
+        """
+        return self.offsets[w_idx] + a_idx
+
+    def greedy(self, t, w_idx):
+        """
+        Get the greedy action index and the maximum Q-value for a batch of states.
+
+        Each distinct state is evaluated once, since batches are concentrated on few states.
+
+        Args:
+            t (int or np.ndarray): Time step, or time steps broadcast against w_idx.
+            w_idx (np.ndarray): Wealth indices of the batch.
+
+        Returns:
+            tuple: (best action indices, maximum Q-values), both of the shape of w_idx.
+        """
+        if np.ndim(t) == 0:  # One stage: gather from its row
+            uniq, inverse = np.unique(w_idx, return_inverse=True)  # Distinct states of the batch
+            stage_data, stage_start, w_uniq = self.data[t], 0, uniq
+        else:  # Mixed stages: gather from the flattened table
+            n_wealth = len(self.counts)
+            uniq, inverse = np.unique(np.asarray(t) * n_wealth + w_idx, return_inverse=True)
+            t_uniq, w_uniq = np.divmod(uniq, n_wealth)
+            stage_data, stage_start = self.data.reshape(-1), (t_uniq * self.data.shape[1])[:, None]
+        counts = self.counts[w_uniq][:, None]
+        cols = np.arange(counts.max())[None, :]
+        # Gather the rows padded to the widest one, with the padding set to -inf
+        cells = stage_start + self.offsets[w_uniq][:, None] + np.minimum(cols, counts - 1)
+        q_rows = np.where(cols < counts, stage_data[cells], -np.inf)
+        best_idx = np.argmax(q_rows, axis=1)
+        best_q = q_rows[np.arange(len(uniq)), best_idx]
+        return best_idx[inverse].reshape(np.shape(w_idx)), best_q[inverse].reshape(np.shape(w_idx))
+
+    def occupancy(self):
+        """
+        Report the memory occupancy; every row of a dense or packed table is allocated.
+
+        Returns:
+            dict: Allocated and total rows and cells, and the bytes of the Q-values.
+        """
+        rows = self.T * len(self.counts)
+        cells = self.T * int(self.counts.sum())
+        return {"rows_allocated": rows, "rows_total": rows, "cells_allocated": cells, "cells_total": cells,
+                "bytes_allocated": self.data.nbytes, "bytes_packed": cells * self.data.itemsize}
+
+    def greedy_actions(self):
+        """
+        Get the greedy action index of every state.
+
+        Returns:
+            np.ndarray: Action indices of shape (T, n_wealth).
+        """
+        w_idx = np.arange(len(self.counts))
+        return np.stack([self.greedy(t, w_idx)[0] for t in range(self.T)])
+
+    def set_stage(self, t, pair_values, pair_w_idx, pair_a_idx):
+        """
+        Set all valid cells of stage t from values listed per (w_idx, a_idx) pair.
+
+        Args:
+            t (int): Time step.
+            pair_values (np.ndarray): Q-value of every pair.
+            pair_w_idx (np.ndarray): Wealth index of every pair.
+            pair_a_idx (np.ndarray): Action index of every pair.
+        """
+        self.data[t, self.flat_index(pair_w_idx, pair_a_idx)] = pair_values
+
+    def to_dense(self):
+        """
+        Convert the Q-values to a (T, n_wealth, max_act_count) array with zero padding.
+
+        Returns:
+            np.ndarray: Dense Q-values.
+        """
+        dense = np.zeros((self.T, len(self.counts), self.max_count), dtype=self.data.dtype)
+        for w_idx, count in enumerate(self.counts):
+            start = self.offsets[w_idx]
+            dense[:, w_idx, :count] = self.data[:, start:start + count]
+        return dense
+
+
+class SparseQTable:
+    """
+    The SparseQTable class stores Q-values only for the (t, wealth index) rows that were written.
+
+    Trajectories from one initial wealth reach a narrow band of the wealth grid, so most
+    rows of a dense table stay zero forever. Here a row is allocated on its first write
+    (write_row) as a slice of a chunk of chunk_size values; reading an unallocated row
+    (row) returns a read-only zero row without allocating. The row interface matches
+    QTable, so the scalar Agent and Trainer work unchanged; BatchTrainer and the exact
+    solver need the contiguous storage of QTable.
+
+    Attributes:
+        T (int): Total number of stages.
+        counts (np.ndarray): Number of actions of every wealth index.
+        layout (str): "sparse".
+        offsets (np.ndarray): Start of every wealth row in the packed order.
+        data (None): No contiguous storage.
+        array (None): No array view of the Q-values.
+        chunk_size (int): Number of values per allocation chunk.
+    """
+
+    layout = "sparse"  # Storage layout
+    data = None  # No contiguous storage; rows live in chunks
+    array = None  # No array view of the Q-values
+
+    def __init__(self, T, action_counts, dtype=np.float64, chunk_size=1 << 16):
+        """
+        Initialize an empty Q-table.
+
+        Args:
+            T (int): Total number of stages.
+            action_counts (np.ndarray): Number of actions of every wealth index.
+            dtype (np.dtype): Floating point type of the Q-values, e.g. np.float32.
+            chunk_size (int): Number of values per allocation chunk.
+        """
+        self.T = T  # Set total number of stages
+        self.counts = np.asarray(action_counts, dtype=np.int64)  # Set the action counts
+        self.max_count = int(self.counts.max())  # Largest action count
+        self.offsets = np.concatenate(([0], np.cumsum(self.counts)[:-1]))  # Packed row starts
+        self.dtype = np.dtype(dtype)  # Set the floating point type
+        self.chunk_size = chunk_size  # Set the chunk size
+        self._n_wealth = len(self.counts)
+        self._rows = {}  # Row view per key t * n_wealth + w_idx
+        self._chunks = []  # Allocated chunks
+        self._fill = 0  # Used values of the last chunk
+        self._zeros = np.zeros(self.max_count, dtype=self.dtype)  # Shared value of unallocated rows
+        self._zeros.flags.writeable = False
+
+    @property
+    def nbytes(self):
+        """
+        int: Memory used by the chunks and the row offsets.
+        """
+        return sum(chunk.nbytes for chunk in self._chunks) + self.offsets.nbytes + self.counts.nbytes
+
+    def row(self, t, w_idx):
+        """
+        Get the action values of one state; a read-only zero row if it was never written.
+
+        Args:
+            t (int): Time step.
+            w_idx (int): Wealth index.
+
+        Returns:
+            np.ndarray: Q-values of the actions of the state.
+        """
+        row = self._rows.get(t * self._n_wealth + w_idx)
+        return row if row is not None else self._zeros[:self.counts[w_idx]]
+
+    def write_row(self, t, w_idx):
+        """
+        Get the action values of one state as a writable view, allocating it on first use.
+
+        Args:
+            t (int): Time step.
+            w_idx (int): Wealth index.
+
+        Returns:
+            np.ndarray: Q-values of the actions of the state.
+        """
+        key = t * self._n_wealth + w_idx
+        row = self._rows.get(key)
+        if row is None:  # First touch: carve the row out of the current chunk
+            count = int(self.counts[w_idx])
+            if not self._chunks or self._fill + count > len(self._chunks[-1]):
+                self._chunks.append(np.zeros(max(self.chunk_size, count), dtype=self.dtype))
+                self._fill = 0
+            row = self._chunks[-1][self._fill:self._fill + count]
+            self._fill += count
+            self._rows[key] = row
+        return row
+
+    def greedy(self, t, w_idx):
+        """
+        Get the greedy action index and the maximum Q-value for a batch of states.
+
+        Args:
+            t (int or np.ndarray): Time step, or time steps broadcast against w_idx.
+            w_idx (np.ndarray): Wealth indices of the batch.
+
+        Returns:
+            tuple: (best action indices, maximum Q-values), both of the shape of w_idx.
+        """
+        uniq, inverse = np.unique(np.asarray(t) * self._n_wealth + w_idx, return_inverse=True)  # Distinct states
+        best_idx = np.zeros(len(uniq), dtype=np.int64)
+        best_q = np.zeros(len(uniq), dtype=self.dtype)
+        for i, key in enumerate(uniq.tolist()):
+            row = self._rows.get(key)
+            if row is not None:  # Unallocated rows are all zero: action 0, value 0
+                best_idx[i] = np.argmax(row)
+                best_q[i] = row[best_idx[i]]
+        return best_idx[inverse].reshape(np.shape(w_idx)), best_q[inverse].reshape(np.shape(w_idx))
+
+    def greedy_actions(self):
+        """
+        Get the greedy action index of every state.
+
+        Returns:
+            np.ndarray: Action indices of shape (T, n_wealth).
+        """
+        # The smallest integer type, since unallocated rows make this table large on huge grids
+        dtype = np.int16 if self.max_count <= np.iinfo(np.int16).max + 1 else np.int32
+        actions = np.zeros((self.T, self._n_wealth), dtype=dtype)
+        for key, row in self._rows.items():
+            actions[divmod(key, self._n_wealth)] = np.argmax(row)
+        return actions
+
+    def occupancy(self):
+        """
+        Report the memory occupancy.
+
+        Returns:
+            dict: Allocated and total rows and cells, the bytes of the allocated chunks and
+                the bytes a packed table would need.
+        """
+        cells = self.T * int(self.counts.sum())
+        return {"rows_allocated": len(self._rows), "rows_total": self.T * self._n_wealth,
+                "cells_allocated": sum(len(row) for row in self._rows.values()), "cells_total": cells,
+                "bytes_allocated": sum(chunk.nbytes for chunk in self._chunks),
+                "bytes_packed": cells * self.dtype.itemsize}
+
+    def to_dense(self):
+        """
+        Convert the Q-values to a (T, n_wealth, max_act_count) array with zero padding.
+
+        Returns:
+            np.ndarray: Dense Q-values.
+        """
+        dense = np.zeros((self.T, self._n_wealth, self.max_count), dtype=self.dtype)
+        for key, row in self._rows.items():
+            t, w_idx = divmod(key, self._n_wealth)
+            dense[t, w_idx, :len(row)] = row
+        return dense
+
+    def save(self, path):
+        """
+        Save the allocated rows to a .npz file.
+
+        Args:
+            path (str): Output file.
+        """
+        keys = np.fromiter(self._rows, dtype=np.int64, count=len(self._rows))
+        values = np.concatenate([self._rows[key] for key in keys.tolist()]) if len(keys) else np.zeros(0, self.dtype)
+        np.savez(path, keys=keys, values=values)
+
+    def load(self, path):
+        """
+        Replace the Q-values by the rows saved with save.
+
+        Args:
+            path (str): File written by save.
+        """
+        self._rows, self._chunks, self._fill = {}, [], 0
+        with np.load(path) as data:
+            keys, values = data["keys"], data["values"]
+        start = 0
+        for key in keys.tolist():
+            row = self.write_row(*divmod(key, self._n_wealth))
+            row[:] = values[start:start + len(row)]
+            start += len(row)
+
+
+class GreedyPolicy:
+    """
+    The GreedyPolicy class is a compact export of the greedy policy of a Q-table.
+
+    The best action index of every (t, w_idx) state is stored in an int16 table (int32 if
+    a wealth level has more than 32767 actions). Queries are vectorized, snap wealth
+    values onto the Environment grid, and need neither an Agent nor an Environment, so
+    a saved policy can be served with NumPy alone. For a NonUniformEnvironment the wealth
+    grid and the action fractions are stored instead of the two steps; for a
+    MultiAssetEnvironment the action indices are simplex codes (see simplex_rank).
+
+    Attributes:
+        actions (np.ndarray): Best action index per state, shape (T, n_wealth).
+        W_STEP (int): Discretization step for wealth, or None for a non-uniform grid.
+        ACTION_STEP (int): Discretization step for actions, or None for action fractions.
+        wealth_grid (np.ndarray): Wealth levels of a non-uniform grid, or None.
+        action_fractions (np.ndarray): Invested fractions of wealth, or None.
+        n_assets (int): Number of risky assets.
+    """
+
+    def __init__(self, actions, W_STEP=None, ACTION_STEP=None, wealth_grid=None, action_fractions=None, n_assets=1):
+        """
+        Initialize the policy from a table of action indices.
+
+        Args:
+            actions (np.ndarray): Best action index per state, shape (T, n_wealth).
+            W_STEP (int): Discretization step for wealth of a uniform grid.
+            ACTION_STEP (int): Discretization step for actions of a uniform grid.
+            wealth_grid (np.ndarray): Wealth levels of a non-uniform grid.
+            action_fractions (np.ndarray): Invested fractions of wealth of a non-uniform grid.
+            n_assets (int): Number of risky assets; above 1 the actions are simplex codes.
+        """
+        actions = np.asarray(actions)
+        dtype = np.int16 if actions.size == 0 or actions.max() <= np.iinfo(np.int16).max else np.int32
+        self.actions = np.ascontiguousarray(actions, dtype=dtype)  # Set the action table
+        self.W_STEP = W_STEP  # Set discretization step for wealth
+        self.ACTION_STEP = ACTION_STEP  # Set discretization step for actions
+        self.wealth_grid = None if wealth_grid is None else np.asarray(wealth_grid, dtype=float)
+        self.action_fractions = None if action_fractions is None else np.asarray(action_fractions, dtype=float)
+        self.n_assets = n_assets  # Set the number of risky assets
+
+    @classmethod
+    def from_q_table(cls, q_table, env):
+        """
+        Collapse a Q-table into its greedy policy.
+
+        Args:
+            q_table (QTable): Q-values, e.g. Agent.q_table or BackwardInductionSolver.q_table.
+            env (Environment): Environment the Q-values belong to.
+
+        Returns:
+            GreedyPolicy: The policy.
+        """
+        if env.W_STEP is None:  # Non-uniform grid with action fractions
+            return cls(q_table.greedy_actions(), wealth_grid=env.wealth_grid, action_fractions=env.action_fractions)
+        return cls(q_table.greedy_actions(), env.W_STEP, env.ACTION_STEP, n_assets=env.n_assets)
+
+    @property
+    def T(self):
+        """
+        int: Total number of stages.
+        """
+        return self.actions.shape[0]
+
+    @property
+    def nbytes(self):
+        """
+        int: Memory used by the action table.
+        """
+        return self.actions.nbytes
+
+    def wealth_index(self, w):
+        """
+        Snap wealth values onto the grid.
+
+        Args:
+            w (float or np.ndarray): Wealth value(s).
+
+        Returns:
+            np.ndarray: Index of the nearest wealth level, clipped to the grid.
+        """
+        if self.wealth_grid is not None:  # Nearest level of a non-uniform grid
+            grid = self.wealth_grid
+            w = np.clip(np.asarray(w, dtype=float), grid[0], grid[-1])
+            lower = np.clip(np.searchsorted(grid, w, side="right") - 1, 0, len(grid) - 2)
+            return lower + (w - grid[lower] >= grid[lower + 1] - w)
+        return np.clip(np.rint(np.asarray(w) / self.W_STEP), 0, self.actions.shape[1] - 1).astype(np.intp)
+
+    def action_index(self, t, w):
+        """
+        Get the greedy action indices for a batch of queries.
+
+        Args:
+            t (int or np.ndarray): Time step(s).
+            w (float or np.ndarray): Wealth value(s), broadcast against t.
+
+        Returns:
+            np.ndarray: Action indices.
+        """
+        return self.actions[t, self.wealth_index(w)]
+
+    def __call__(self, t, w):
+        """
+        Get the greedy investment amounts for a batch of queries.
+
+        Args:
+            t (int or np.ndarray): Time step(s).
+            w (float or np.ndarray): Wealth value(s), broadcast against t.
+
+        Returns:
+            np.ndarray: Investment amounts in the risky asset, with a trailing axis of one
+                amount per asset if there are several risky assets.
+        """
+        if self.wealth_grid is not None:  # Fraction of the snapped wealth level
+            w_idx = self.wealth_index(w)
+            return self.action_fractions[self.actions[t, w_idx]] * self.wealth_grid[w_idx]
+        if self.n_assets > 1:  # Decode the allocations
+            return simplex_unrank(self.action_index(t, w), self.n_assets) * self.ACTION_STEP
+        return self.action_index(t, w).astype(np.int64) * self.ACTION_STEP
+
+    def save(self, path):
+        """
+        Save the policy to a compressed .npz file.
+
+        Args:
+            path (str): Output file.
+        """
+        if self.wealth_grid is not None:
+            np.savez_compressed(path, actions=self.actions, wealth_grid=self.wealth_grid,
+                                action_fractions=self.action_fractions)
+        else:
+            np.savez_compressed(path, actions=self.actions, W_STEP=self.W_STEP, ACTION_STEP=self.ACTION_STEP,
+                                n_assets=self.n_assets)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a policy written by save.
+
+        Args:
+            path (str): File written by save.
+
+        Returns:
+            GreedyPolicy: The policy.
+        """
+        with np.load(path) as data:
+            if "wealth_grid" in data:
+                return cls(data["actions"], wealth_grid=data["wealth_grid"], action_fractions=data["action_fractions"])
+            n_assets = data["n_assets"].item() if "n_assets" in data else 1
+            return cls(data["actions"], data["W_STEP"].item(), data["ACTION_STEP"].item(), n_assets=n_assets)
+
+
+class Agent:
+    """
+    The Agent class represents the Q-learning agent.
+
+    Attributes:
+        env (Environment): The environment in which the agent operates.
+        alpha (float): Learning rate.
+        gamma (float): Discount factor.
+        epsilon_start (float): Initial epsilon value for epsilon-greedy policy.
+        epsilon_end (float): Final epsilon value for epsilon-greedy policy.
+        decay_rate (float): Decay rate for epsilon.
+        q_table (QTable or SparseQTable): Storage of the Q-values.
+        Q (np.ndarray): View of the Q-values, see QTable.array; None for the sparse layout.
+        rng (RandomStream): Random stream for exploration.
+    """
+
+    def __init__(self, env, alpha, gamma, epsilon_start, epsilon_end, decay_rate, INITIAL_WEALTH,
+                 q_layout="dense", q_dtype=np.float64, rng=None):
+        """
+        Initialize the agent with the given parameters.
+
+        Args:
+            env (Environment): The environment in which the agent operates.
+            alpha (float): Learning rate.
+            gamma (float): Discount factor.
+            epsilon_start (float): Initial epsilon value for epsilon-greedy policy.
+            epsilon_end (float): Final epsilon value for epsilon-greedy policy.
+            decay_rate (float): Decay rate for epsilon.
+            q_layout (str): Q-table layout, "dense" (padded), "packed" (triangular) or "sparse"
+                (rows allocated on first write, see SparseQTable).
+            q_dtype (np.dtype): Floating point type of the Q-values, e.g. np.float32.
+            rng (RandomStream or int): Random stream, or seed of a new one; shares env.rng if None.
+        """
+        self.env = env  # Set the environment
+        self.alpha = alpha  # Set the learning rate
+        self.gamma = gamma  # Set the discount factor
+        self.epsilon_start = epsilon_start  # Set the initial epsilon value
+        self.epsilon_end = epsilon_end  # Set the final epsilon value
+        self.decay_rate = decay_rate  # Set the decay rate for epsilon
+        self.INITIAL_WEALTH = INITIAL_WEALTH # Set the initial wealth
+        self.rng = env.rng if rng is None else as_random_stream(rng)  # Set the random stream
+
+        # Initialize the Q-table
+        self.max_act_count = int(env.action_counts.max())
+        if q_layout == "sparse":
+            self.q_table = SparseQTable(env.T, env.action_counts, dtype=q_dtype)
+        else:
+            self.q_table = QTable(env.T, env.action_counts, layout=q_layout, dtype=q_dtype)
+        self.Q = self.q_table.array  # View of the Q-values (None for the sparse layout)
+        self.action_index_map = self._build_action_index_map()  # Build the action index map
+
+        # Running sum of |delta Q| over all updates since the last reset
+        self.q_diff_accum = 0.0
+        self._outcomes = None  # Transition outcomes of the environment, cached for expected updates
+
+    def _build_action_index_map(self):
+        """
+        Build the action index map.
+
+        Actions are indexed arithmetically (a_idx = x // ACTION_STEP), so the map reduces to
+        the start of every wealth row within a stage of the Q storage.
+
+        Returns:
+            np.ndarray: Row offset of every wealth index.
+        """
+        return self.q_table.offsets  # Return the action index map
+
+    def compute_epsilon(self, episode):
+        """
+        Compute the epsilon value for epsilon-greedy, decaying exponentially.
+        """
+        return self.epsilon_end + (self.epsilon_start - self.epsilon_end)*np.exp(-self.decay_rate*episode)
+
+    def choose_action(self, t, w, eps):
+        """
+        Choose an action using epsilon-greedy policy.
+
+        Args:
+            t (int): Current time step.
+            w (int): Current wealth.
+            eps (float): Epsilon value for epsilon-greedy policy.
+
+        Returns:
+            int: Chosen action (investment amount).
+        """
+        a_idx = self.choose_action_index(t, self.env.wealth_to_index[w], eps)
+        return self.env.action_candidates[w][a_idx]  # Return the investment amount
+
+    def choose_action_index(self, t, w_idx, eps):
+        """
+        Choose an action index using epsilon-greedy policy.
+
+        Args:
+            t (int): Current time step.
+            w_idx (int): Current wealth index.
+            eps (float): Epsilon value for epsilon-greedy policy.
+
+        Returns:
+            int: Chosen action index.
+        """
+        if self.rng.random() < eps:  # With probability eps, choose a random action (exploration)
+            return int(self.rng.random() * self.env.action_counts[w_idx])  # Return a random action index
+        else:  # Otherwise, choose the best action (exploitation)
+            return int(np.argmax(self.q_table.row(t, w_idx)))  # Return the index of the best action
+
+    def update_q_table(self, t, w, x, reward, w_next):
+        """
+        Update the Q-table based on the current state, action, reward, and next state.
+
+        Args:
+            t (int): Current time step.
+            w (int): Current wealth.
+            x (int): Chosen action (investment amount).
+            reward (float): Reward received.
+            w_next (int): Next state (wealth).
+        """
+        w_idx = self.env.wealth_to_index[w]  # Get the index of the current wealth level
+        a_idx = self.env.action_index(w_idx, x)  # Get the index of the chosen action
+        self.update_q_index(t, w_idx, a_idx, reward, self.env.wealth_to_index[w_next])
+
+    def update_q_index(self, t, w_idx, a_idx, reward, w_next_idx):
+        """
+        Update the Q-table for a transition given by grid indices.
+
+        Args:
+            t (int): Current time step.
+            w_idx (int): Current wealth index.
+            a_idx (int): Chosen action index.
+            reward (float): Reward received.
+            w_next_idx (int): Next wealth index.
+        """
+        q_table = self.q_table
+        if t < self.env.T - 1:  # If it is not the last time step
+            max_q_next = q_table.row(t + 1, w_next_idx).max()  # Get the maximum Q-value for the next state
+        else:  # If it is the last time step
+            max_q_next = 0.0  # Set the maximum Q-value for the next state to 0
+
+        if q_table.data is None:  # Sparse storage: the row is allocated on its first write
+            row = q_table.write_row(t, w_idx)
+            old_q = row[a_idx]
+            new_q = old_q + self.alpha * (reward + self.gamma * max_q_next - old_q)
+            row[a_idx] = new_q
+        else:
+            cell = q_table.flat_index(w_idx, a_idx)  # Position of the state-action pair in the stage row
+            old_q = q_table.data[t, cell]  # Get the old Q-value for the current state-action pair
+            # Update the Q-value using the Q-learning update rule
+            new_q = old_q + self.alpha * (reward + self.gamma * max_q_next - old_q)
+            q_table.data[t, cell] = new_q
+        # Accumulate the absolute change so the episode error does not need a full Q-table diff
+        self.q_diff_accum += abs(new_q - old_q)
+
+    def update_q_expected(self, t, w_idx, a_idx, reward=None, w_next_idx=None):
+        """
+        Update the Q-table with the expectation over all transition outcomes (full backup).
+
+        The target averages reward + gamma * max Q(t + 1) over env.transition_outcomes()
+        instead of using the one sampled next state, so it carries no transition noise
+        and a much larger alpha can be used. The signature matches update_q_index; the
+        sampled reward and next state are ignored.
+
+        Args:
+            t (int): Current time step.
+            w_idx (int): Current wealth index.
+            a_idx (int): Chosen action index.
+            reward (float): Ignored.
+            w_next_idx (int): Ignored.
+        """
+        env = self.env
+        q_table = self.q_table
+        if self._outcomes is None:  # Per-pair probabilities are kept as arrays, scalars as floats
+            self._outcomes = [(prob, next_idx) for prob, next_idx in env.transition_outcomes()]
+        pair = env.action_offsets[w_idx] + a_idx  # Position of the (w_idx, a_idx) pair
+        last = t == env.T - 1  # Whether the next state is terminal
+
+        target = 0.0
+        for prob, next_idx in self._outcomes:  # Expected reward plus discounted value of the next state
+            w_next = next_idx[pair]
+            value = env.utility_table[w_next] if last else self.gamma * q_table.row(t + 1, w_next).max()
+            target += (prob[pair] if np.ndim(prob) else prob) * value
+
+        row = q_table.write_row(t, w_idx)  # Allocates a sparse row on its first write
+        old_q = row[a_idx]
+        new_q = old_q + self.alpha * (target - old_q)
+        row[a_idx] = new_q
+        self.q_diff_accum += abs(new_q - old_q)
+
+    def td_error(self, t, w_idx, a_idx, reward, w_next_idx):
+        """
+        Compute the sampled TD errors of a batch of transitions without updating.
+
+        Args:
+            t (np.ndarray): Time steps.
+            w_idx (np.ndarray): Wealth indices.
+            a_idx (np.ndarray): Action indices.
+            reward (np.ndarray): Rewards.
+            w_next_idx (np.ndarray): Next wealth indices.
+
+        Returns:
+            tuple: (TD errors, flat cell positions in q_table.data).
+        """
+        q_table = self.q_table
+        if q_table.data is None:
+            raise ValueError("batch updates need a dense or packed Q-table")
+        cells = t * q_table.data.shape[1] + q_table.flat_index(w_idx, a_idx)  # Positions in the flattened table
+        max_q_next = np.zeros(len(cells))
+        inner = t < self.env.T - 1  # Transitions with a successor stage
+        if inner.any():
+            max_q_next[inner] = q_table.greedy(t[inner] + 1, w_next_idx[inner])[1]
+        return reward + self.gamma * max_q_next - q_table.data.reshape(-1)[cells], cells
+
+    def update_q_batch(self, t, w_idx, a_idx, reward, w_next_idx):
+        """
+        Update the Q-table from a minibatch of transitions at once.
+
+        All TD errors are computed from the Q-values before the update. A cell that occurs
+        several times in the minibatch moves by alpha times the mean of its TD errors, so
+        replaying many copies of one transition cannot overshoot.
+
+        Args:
+            t (np.ndarray): Time steps.
+            w_idx (np.ndarray): Wealth indices.
+            a_idx (np.ndarray): Action indices.
+            reward (np.ndarray): Rewards.
+            w_next_idx (np.ndarray): Next wealth indices.
+
+        Returns:
+            np.ndarray: TD errors before the update.
+        """
+        td, cells = self.td_error(t, w_idx, a_idx, reward, w_next_idx)
+        uniq, inverse, counts = np.unique(cells, return_inverse=True, return_counts=True)
+        step = self.alpha * np.bincount(inverse, weights=td) / counts  # Mean TD error per distinct cell
+        self.q_table.data.reshape(-1)[uniq] += step
+        self.q_diff_accum += float(np.abs(step).sum())
+        return td
+
+    def reset_q_diff(self):
+        """
+        Reset the accumulated Q-value change and return the value it held.
+
+        Returns:
+            float: Sum of |delta Q| over all updates since the previous reset.
+        """
+        q_diff = self.q_diff_accum  # Keep the accumulated value
+        self.q_diff_accum = 0.0  # Start a new accumulation
+        return q_diff
+
+    def warm_start(self, Q):
+        """
+        Initialize the Q-table from given values, e.g. the BackwardInductionSolver result.
+
+        Args:
+            Q (np.ndarray): Q-values with the same layout as self.Q.
+        """
+        if self.Q is None:
+            raise ValueError("warm_start needs a dense or packed Q-table")
+        np.copyto(self.Q, Q)  # Copy in place so views of self.Q stay valid
+
+    def export_policy(self, path=None):
+        """
+        Export the greedy policy of the Q-table.
+
+        Args:
+            path (str): If given, also save the policy there.
+
+        Returns:
+            GreedyPolicy: The policy.
+        """
+        policy = GreedyPolicy.from_q_table(self.q_table, self.env)
+        if path is not None:
+            policy.save(path)
+        return policy
+
+    def compute_q_diff(self, Q_old):
+        """
+        Compute the difference between the old and new Q-tables.
+
+        This is the full-table reference for the incremental value tracked by
+        update_q_table; both agree because every (t, w, x) cell is updated at
+        most once per episode.
+
+        Args:
+            Q_old (np.ndarray): Old Q-table.
+
+        Returns:
+            float: Sum of absolute differences between the old and new Q-tables.
+        """
+        return np.sum(np.abs(Q_old - self.Q))  # Calculate and return the sum of absolute differences
+
+
+def moving_average(values, window):
+    """
+    Calculate the trailing moving average with a cumulative sum in O(n).
+
+    The first window - 1 points average over the values available so far.
+
+    Args:
+        values (np.ndarray): Input series.
+        window (int): Window size.
+
+    Returns:
+        np.ndarray: Moving average of the same length as values.
+    """
+    values = np.asarray(values, dtype=float)
+    csum = np.concatenate(([0.0], np.cumsum(values)))  # Prefix sums
+    end = np.arange(1, len(values) + 1)  # Exclusive end of every window
+    start = np.maximum(0, end - window)  # Inclusive start of every window
+    return (csum[end] - csum[start]) / (end - start)
+
+
+def downsample(values, max_points):
+    """
+    Pick at most max_points evenly strided points of a series for plotting.
+
+    Args:
+        values (np.ndarray): Input series.
+        max_points (int): Maximum number of points to keep.
+
+    Returns:
+        tuple: (x positions, values at those positions).
+    """
+    step = max(1, -(-len(values) // max_points))  # Ceiling division
+    x = np.arange(0, len(values), step)
+    return x, np.asarray(values)[x]
+
+
+class MetricsRecorder:
+    """
+    The MetricsRecorder class stores per-episode training metrics in NumPy buffers.
+
+    The buffers are preallocated (and doubled when full), and running sums over the last
+    `window` episodes give the rolling averages of the progress log in O(1).
+
+    Attributes:
+        window (int): Window size of the rolling averages.
+        count (int): Number of recorded episodes.
+    """
+
+    def __init__(self, capacity=1024, window=100):
+        """
+        Initialize empty buffers.
+
+        Args:
+            capacity (int): Initial number of episodes the buffers can hold.
+            window (int): Window size of the rolling averages.
+        """
+        self.window = window  # Set the rolling window size
+        self.count = 0  # Number of recorded episodes
+        self._errors = np.empty(max(1, capacity))  # Buffer of training errors
+        self._final_wealths = np.empty(max(1, capacity))  # Buffer of final wealths
+        self._error_sum = 0.0  # Sum of the errors in the rolling window
+        self._wealth_sum = 0.0  # Sum of the final wealths in the rolling window
+
+    @property
+    def errors(self):
+        """
+        np.ndarray: Recorded training errors (a view of the buffer).
+        """
+        return self._errors[:self.count]
+
+    @property
+    def final_wealths(self):
+        """
+        np.ndarray: Recorded final wealths (a view of the buffer).
+        """
+        return self._final_wealths[:self.count]
+
+    def _reserve(self, n):
+        """
+        Make sure the buffers can hold n more episodes.
+
+        Args:
+            n (int): Number of episodes to be added.
+        """
+        needed = self.count + n
+        if needed > len(self._errors):  # Grow the buffers geometrically
+            capacity = max(needed, 2 * len(self._errors))
+            for name in ("_errors", "_final_wealths"):
+                buffer = np.empty(capacity)
+                buffer[:self.count] = getattr(self, name)[:self.count]
+                setattr(self, name, buffer)
+
+    def record(self, error, final_wealth):
+        """
+        Record the metrics of one episode.
+
+        Args:
+            error (float): Sum of |delta Q| of the episode.
+            final_wealth (float): Final wealth of the episode.
+        """
+        self._reserve(1)
+        i = self.count
+        self._errors[i] = error
+        self._final_wealths[i] = final_wealth
+        self._error_sum += error
+        self._wealth_sum += final_wealth
+        if i >= self.window:  # Drop the episode that leaves the rolling window
+            self._error_sum -= self._errors[i - self.window]
+            self._wealth_sum -= self._final_wealths[i - self.window]
+        self.count += 1
+
+    def record_batch(self, errors, final_wealths):
+        """
+        Record the metrics of several episodes.
+
+        Args:
+            errors (np.ndarray): Sum of |delta Q| of every episode.
+            final_wealths (np.ndarray): Final wealth of every episode.
+        """
+        n = len(errors)
+        self._reserve(n)
+        self._errors[self.count:self.count + n] = errors
+        self._final_wealths[self.count:self.count + n] = final_wealths
+        self.count += n
+        # Recompute the rolling sums from the last window
+        start = max(0, self.count - self.window)
+        self._error_sum = float(self._errors[start:self.count].sum())
+        self._wealth_sum = float(self._final_wealths[start:self.count].sum())
+
+    def save(self, path):
+        """
+        Save the recorded metrics to an .npz file.
+
+        Args:
+            path (str): File path.
+        """
+        np.savez(path, errors=self.errors, final_wealths=self.final_wealths, window=self.window)
+
+    @classmethod
+    def load(cls, path, capacity=0):
+        """
+        Load metrics saved with save().
+
+        Args:
+            path (str): File path.
+            capacity (int): Minimum number of episodes the buffers should hold.
+
+        Returns:
+            MetricsRecorder: Recorder holding the saved metrics.
+        """
+        with np.load(path) as data:
+            metrics = cls(capacity=max(capacity, len(data["errors"])), window=int(data["window"]))
+            metrics.record_batch(data["errors"], data["final_wealths"])
+        return metrics
+
+    def rolling_means(self, episode=None):
+        """
+        Get the average error and final wealth over the window ending at an episode.
+
+        Args:
+            episode (int): Last episode of the window; the latest recorded episode if None.
+
+        Returns:
+            tuple: (average error, average final wealth).
+        """
+        if episode is None or episode == self.count - 1:  # O(1) from the running sums
+            n = min(self.count, self.window)
+            return self._error_sum / n, self._wealth_sum / n
+        start = max(0, episode - self.window + 1)
+        return (float(np.mean(self._errors[start:episode + 1])),
+                float(np.mean(self._final_wealths[start:episode + 1])))
+
+
+class ReplayBuffer:
+    """
+    The ReplayBuffer class keeps the most recent transitions in fixed-capacity NumPy arrays.
+
+    New transitions overwrite the oldest ones (ring buffer). Every slot also carries a
+    priority, the |TD error| of its transition when it was last evaluated, for
+    prioritized sweeping.
+
+    Attributes:
+        capacity (int): Maximum number of stored transitions.
+        t, w_idx, a_idx, w_next_idx (np.ndarray): Transition fields per slot.
+        reward (np.ndarray): Reward per slot.
+        priorities (np.ndarray): |TD error| per slot.
+        rng (RandomStream): Random stream for uniform sampling.
+    """
+
+    def __init__(self, capacity, rng=None):
+        """
+        Initialize an empty buffer.
+
+        Args:
+            capacity (int): Maximum number of stored transitions.
+            rng (RandomStream or int): Random stream, or seed of a new one; unseeded if None.
+        """
+        self.capacity = capacity  # Set the capacity
+        self.rng = as_random_stream(rng)  # Set the random stream
+        self.t = np.zeros(capacity, dtype=np.int32)  # Time step per slot
+        self.w_idx = np.zeros(capacity, dtype=np.int32)  # Wealth index per slot
+        self.a_idx = np.zeros(capacity, dtype=np.int32)  # Action index per slot
+        self.reward = np.zeros(capacity)  # Reward per slot
+        self.w_next_idx = np.zeros(capacity, dtype=np.int32)  # Next wealth index per slot
+        self.priorities = np.zeros(capacity)  # |TD error| per slot
+        self._next = 0  # Slot written next
+        self._size = 0  # Number of filled slots
+
+    def __len__(self):
+        return self._size
+
+    def add(self, t, w_idx, a_idx, reward, w_next_idx):
+        """
+        Store one transition.
+
+        Args:
+            t (int): Time step.
+            w_idx (int): Wealth index.
+            a_idx (int): Action index.
+            reward (float): Reward.
+            w_next_idx (int): Next wealth index.
+
+        Returns:
+            int: Slot of the transition.
+        """
+        i = self._next
+        self.t[i], self.w_idx[i], self.a_idx[i], self.reward[i], self.w_next_idx[i] = t, w_idx, a_idx, reward, w_next_idx
+        self.priorities[i] = 0.0
+        self._next = (i + 1) % self.capacity
+        self._size = min(self._size + 1, self.capacity)
+        return i
+
+    def add_batch(self, t, w_idx, a_idx, reward, w_next_idx):
+        """
+        Store a batch of transitions.
+
+        Args:
+            t (int or np.ndarray): Time step(s).
+            w_idx (np.ndarray): Wealth indices.
+            a_idx (np.ndarray): Action indices.
+            reward (float or np.ndarray): Reward(s).
+            w_next_idx (np.ndarray): Next wealth indices.
+
+        Returns:
+            np.ndarray: Slots of the transitions.
+        """
+        n = len(w_idx)
+        slots = (self._next + np.arange(n)) % self.capacity  # Only the last `capacity` survive if n is larger
+        for field, values in ((self.t, t), (self.w_idx, w_idx), (self.a_idx, a_idx), (self.reward, reward),
+                              (self.w_next_idx, w_next_idx)):
+            field[slots] = values
+        self.priorities[slots] = 0.0
+        self._next = int((self._next + n) % self.capacity)
+        self._size = min(self._size + n, self.capacity)
+        return slots
+
+    def get(self, slots):
+        """
+        Get the fields of the transitions in some slots.
+
+        Args:
+            slots (np.ndarray): Slots.
+
+        Returns:
+            tuple: (t, w_idx, a_idx, reward, w_next_idx) arrays.
+        """
+        return self.t[slots], self.w_idx[slots], self.a_idx[slots], self.reward[slots], self.w_next_idx[slots]
+
+    def sample(self, batch_size):
+        """
+        Draw slots uniformly with replacement.
+
+        Args:
+            batch_size (int): Number of slots.
+
+        Returns:
+            np.ndarray: Slots.
+        """
+        return (self.rng.random_array(batch_size) * self._size).astype(np.int64)
+
+    def top(self, batch_size, threshold=0.0):
+        """
+        Get the slots with the largest priorities (the head of the sweeping queue).
+
+        Args:
+            batch_size (int): Maximum number of slots.
+            threshold (float): Only slots with a priority above it are returned.
+
+        Returns:
+            np.ndarray: Slots, largest priority first.
+        """
+        priorities = self.priorities[:self._size]
+        if batch_size < self._size:
+            slots = np.argpartition(priorities, -batch_size)[-batch_size:]
+        else:
+            slots = np.arange(self._size)
+        slots = slots[priorities[slots] > threshold]
+        return slots[np.argsort(-priorities[slots])]
+
+    def predecessors(self, t, w_idx):
+        """
+        Get the slots of transitions that lead into any of the given states.
+
+        Args:
+            t (np.ndarray): Time steps of the states.
+            w_idx (np.ndarray): Wealth indices of the states.
+
+        Returns:
+            np.ndarray: Slots whose (t + 1, w_next_idx) is one of the states.
+        """
+        n = self._size
+        if n == 0:
+            return np.zeros(0, dtype=np.int64)
+        t_next = self.t[:n] + 1  # Stage the stored transitions lead into
+        n_wealth = int(max(self.w_next_idx[:n].max(), np.max(w_idx))) + 1
+        marked = np.zeros((int(max(t_next.max(), np.max(t))) + 1) * n_wealth, dtype=bool)  # Flag per state
+        marked[np.asarray(t, dtype=np.int64) * n_wealth + w_idx] = True
+        return np.flatnonzero(marked[t_next * n_wealth + self.w_next_idx[:n]])
+
+
+def load_checkpoint_q(path, mmap_mode="r"):
+    """
+    Open the Q-values of a checkpoint as a memory map without loading them fully.
+
+    Args:
+        path (str): Checkpoint directory written by Trainer.save_checkpoint.
+        mmap_mode (str): Memory-map mode passed to np.load, e.g. "r" or "c".
+
+    Returns:
+        np.ndarray: Memory-mapped Q-values with the layout of Agent.Q.
+    """
+    return np.load(os.path.join(_checkpoint_dir(path), "Q.npy"), mmap_mode=mmap_mode)
+
+
+def _checkpoint_dir(path):
+    """
+    Resolve a checkpoint directory, falling back to the previous checkpoint if a crash
+    interrupted the replacement of path.
+
+    Args:
+        path (str): Checkpoint directory.
+
+    Returns:
+        str: Directory holding a complete checkpoint.
+    """
+    if not os.path.isdir(path) and os.path.isdir(path + ".old"):
+        return path + ".old"
+    return path
+
+
+class TrainerCallback:
+    """
+    The TrainerCallback class is the base class of training hooks.
+
+    Subclasses override any subset of the methods; the trainers only dispatch to
+    methods that are overridden, so unused hooks cost nothing in the training loop.
+    BatchTrainer calls on_step once per stage with arrays over the batch, and
+    on_batch_start/on_batch_end once per batch; by default these forward to
+    on_episode_start/on_episode_end for every episode of the batch.
+    """
+
+    def on_train_start(self, trainer):
+        """
+        Called before the first episode of a train() call.
+
+        Args:
+            trainer (Trainer): The trainer.
+        """
+
+    def on_episode_start(self, trainer, episode, epsilon):
+        """
+        Called before an episode.
+
+        Args:
+            trainer (Trainer): The trainer.
+            episode (int): Episode index.
+            epsilon (float): Epsilon value of the episode.
+        """
+
+    def on_step(self, trainer, episode, t, w_idx, a_idx, reward, w_next_idx):
+        """
+        Called after every Q update.
+
+        Args:
+            trainer (Trainer): The trainer.
+            episode (int or np.ndarray): Episode index (indices for BatchTrainer).
+            t (int): Time step.
+            w_idx (int or np.ndarray): Wealth index.
+            a_idx (int or np.ndarray): Action index.
+            reward (float or np.ndarray): Reward received.
+            w_next_idx (int or np.ndarray): Next wealth index.
+        """
+
+    def on_episode_end(self, trainer, episode, epsilon, error, final_wealth):
+        """
+        Called after an episode has been recorded.
+
+        Args:
+            trainer (Trainer): The trainer.
+            episode (int): Episode index.
+            epsilon (float): Epsilon value of the episode.
+            error (float): Sum of |delta Q| of the episode.
+            final_wealth (float): Final wealth of the episode.
+        """
+
+    def on_batch_start(self, trainer, episodes, epsilon):
+        """
+        Called by BatchTrainer before a batch.
+
+        Args:
+            trainer (Trainer): The trainer.
+            episodes (np.ndarray): Episode indices of the batch.
+            epsilon (np.ndarray): Epsilon value of every episode.
+        """
+        for episode, eps in zip(episodes, epsilon):
+            self.on_episode_start(trainer, int(episode), float(eps))
+
+    def on_batch_end(self, trainer, episodes, epsilon, errors, final_wealths):
+        """
+        Called by BatchTrainer after a batch has been recorded.
+
+        Args:
+            trainer (Trainer): The trainer.
+            episodes (np.ndarray): Episode indices of the batch.
+            epsilon (np.ndarray): Epsilon value of every episode.
+            errors (np.ndarray): Sum of |delta Q| of every episode.
+            final_wealths (np.ndarray): Final wealth of every episode.
+        """
+        for episode, eps, error, final_wealth in zip(episodes, epsilon, errors, final_wealths):
+            self.on_episode_end(trainer, int(episode), float(eps), float(error), float(final_wealth))
+
+    def on_train_end(self, trainer):
+        """
+        Called after the last episode of a train() call.
+
+        Args:
+            trainer (Trainer): The trainer.
+        """
+
+    def overrides(self, name):
+        """
+        Check whether this callback overrides a hook of the base class.
+
+        Args:
+            name (str): Hook name.
+
+        Returns:
+            bool: True if the hook is overridden.
+        """
+        return getattr(type(self), name) is not getattr(TrainerCallback, name)
+
+
+class ProgressLogger(TrainerCallback):
+    """
+    The ProgressLogger class prints the training progress every `every` episodes.
+    """
+
+    def __init__(self, every=1000):
+        """
+        Initialize the logger.
+
+        Args:
+            every (int): Number of episodes between log lines.
+        """
+        self.every = every  # Set the log interval
+
+    def on_episode_end(self, trainer, episode, epsilon, error, final_wealth):
+        """
+        Print the log line when a multiple of `every` episodes has finished.
+        """
+        if (episode + 1) % self.every == 0:
+            trainer._log_progress(episode, epsilon)
+
+    def on_batch_end(self, trainer, episodes, epsilon, errors, final_wealths):
+        """
+        Print the log lines of the multiples of `every` inside a batch.
+        """
+        for i in np.flatnonzero((episodes + 1) % self.every == 0):
+            trainer._log_progress(int(episodes[i]), float(epsilon[i]))
+
+    def on_train_end(self, trainer):
+        """
+        Report an early stop.
+        """
+        if trainer.stop_reason is not None:
+            print(f"Stopped after {trainer.stopped_episode}/{trainer.num_episodes} episodes: {trainer.stop_reason}")
+
+
+class StoppingRule(TrainerCallback):
+    """
+    The StoppingRule class is the base class of early stopping rules.
+
+    Every check_every episodes (in BatchTrainer: at the first batch end after every
+    check_every episodes), once min_episodes have run, check() is evaluated and a
+    returned reason stops the training via Trainer.request_stop.
+
+    Attributes:
+        check_every (int): Number of episodes between checks.
+        min_episodes (int): Number of episodes before the first check.
+    """
+
+    def __init__(self, check_every=1000, min_episodes=0):
+        """
+        Initialize the rule.
+
+        Args:
+            check_every (int): Number of episodes between checks.
+            min_episodes (int): Number of episodes before the first check.
+        """
+        self.check_every = check_every  # Set the check interval
+        self.min_episodes = min_episodes  # Set the warm-up length
+
+    def check(self, trainer):
+        """
+        Evaluate the rule after trainer.episode episodes.
+
+        Args:
+            trainer (Trainer): The trainer.
+
+        Returns:
+            str: Reason to stop, or None to continue.
+        """
+        raise NotImplementedError
+
+    def _maybe_stop(self, trainer, previous):
+        """
+        Run check() if a multiple of check_every was crossed since `previous` episodes.
+        """
+        if trainer.episode >= self.min_episodes and trainer.episode // self.check_every > previous // self.check_every:
+            reason = self.check(trainer)
+            if reason is not None:
+                trainer.request_stop(reason)
+
+    def on_episode_end(self, trainer, episode, epsilon, error, final_wealth):
+        """
+        Check the rule after every check_every episodes.
+        """
+        self._maybe_stop(trainer, episode)
+
+    def on_batch_end(self, trainer, episodes, epsilon, errors, final_wealths):
+        """
+        Check the rule once at the end of a batch that crossed a multiple of check_every.
+        """
+        self._maybe_stop(trainer, int(episodes[0]))
+
+
+class QDiffThreshold(StoppingRule):
+    """
+    The QDiffThreshold class stops when the rolling mean of the per-episode Q-diff
+    falls below a threshold.
+    """
+
+    def __init__(self, threshold, window=1000, check_every=1000, min_episodes=0):
+        """
+        Initialize the rule.
+
+        Args:
+            threshold (float): Threshold of the mean sum of |delta Q| per episode.
+            window (int): Number of recent episodes averaged.
+            check_every (int): Number of episodes between checks.
+            min_episodes (int): Number of episodes before the first check.
+        """
+        super().__init__(check_every, max(min_episodes, window))
+        self.threshold = threshold  # Set the Q-diff threshold
+        self.window = window  # Set the averaging window
+
+    def check(self, trainer):
+        """
+        Compare the rolling mean Q-diff with the threshold.
+        """
+        mean_diff = float(np.mean(trainer.errors[-self.window:]))
+        if mean_diff < self.threshold:
+            return f"rolling Q-diff {mean_diff:.4g} < {self.threshold:g} over {self.window} episodes"
+        return None
+
+
+class PolicyPlateau(StoppingRule):
+    """
+    The PolicyPlateau class stops when the greedy policy has stopped changing.
+
+    At every check the greedy action of every (t, w) state is compared with the previous
+    check; after `patience` consecutive checks in which at most a fraction `tolerance` of
+    the states changed, training stops. Only states reachable from INITIAL_WEALTH (see
+    Environment.reachable_states) are counted: the others are never trained, and on
+    large grids they would dilute the fraction until any policy looks stable.
+
+    Attributes:
+        changes (list): Fraction of changed reachable states at every check.
+    """
+
+    def __init__(self, tolerance=0.0, patience=3, check_every=1000, min_episodes=0):
+        """
+        Initialize the rule.
+
+        Args:
+            tolerance (float): Largest fraction of changed states that counts as unchanged.
+            patience (int): Number of consecutive unchanged checks required.
+            check_every (int): Number of episodes between checks.
+            min_episodes (int): Number of episodes before the first check.
+        """
+        super().__init__(check_every, min_episodes)
+        self.tolerance = tolerance  # Set the tolerated fraction of changes
+        self.patience = patience  # Set the required number of stable checks
+        self.changes = []  # Fraction of changed states per check
+        self._policy = None  # Greedy policy at the previous check
+        self._reachable = None  # Mask of the compared states
+        self._stable = 0  # Number of consecutive stable checks
+
+    def on_train_start(self, trainer):
+        """
+        Take the policy at the start of training as the first reference.
+        """
+        agent = trainer.agent
+        self._reachable = agent.env.reachable_states(agent.INITIAL_WEALTH)
+        self._policy = agent.q_table.greedy_actions()
+        self._stable = 0
+
+    def check(self, trainer):
+        """
+        Compare the greedy policy with the one of the previous check.
+        """
+        policy = trainer.agent.q_table.greedy_actions()
+        changed = float(np.mean((policy != self._policy)[self._reachable]))
+        self.changes.append(changed)
+        self._policy = policy
+        self._stable = self._stable + 1 if changed <= self.tolerance else 0
+        if self._stable >= self.patience:
+            return f"greedy policy changed in <= {self.tolerance:.2%} of reachable states for {self.patience} checks"
+        return None
+
+
+class GreedyEvaluation(StoppingRule):
+    """
+    The GreedyEvaluation class stops when the score of the greedy policy on held-out
+    episodes stops improving.
+
+    The score is the mean utility of the final wealth over n_episodes greedy rollouts.
+    The rollouts use their own random stream, restarted from the same seed at every
+    check, so all checks are evaluated on the same held-out return paths and never
+    touch the training streams.
+
+    Attributes:
+        scores (list): Score at every check.
+        best_score (float): Best score so far.
+    """
+
+    def __init__(self, n_episodes=1000, patience=3, min_delta=0.0, seed=0, check_every=1000, min_episodes=0):
+        """
+        Initialize the rule.
+
+        Args:
+            n_episodes (int): Number of held-out greedy episodes per check.
+            patience (int): Number of checks without improvement that stop training.
+            min_delta (float): Smallest score increase that counts as an improvement.
+            seed (int): Seed of the held-out random stream.
+            check_every (int): Number of episodes between checks.
+            min_episodes (int): Number of episodes before the first check.
+        """
+        super().__init__(check_every, min_episodes)
+        self.n_episodes = n_episodes  # Set the number of held-out episodes
+        self.patience = patience  # Set the number of checks without improvement
+        self.min_delta = min_delta  # Set the improvement threshold
+        self.seed = seed  # Set the seed of the held-out stream
+        self.scores = []  # Score per check
+        self.best_score = -np.inf  # Best score so far
+        self._stale = 0  # Number of checks since the last improvement
+
+    def evaluate(self, agent):
+        """
+        Run the held-out greedy rollouts.
+
+        Args:
+            agent (Agent): The agent whose greedy policy is evaluated.
+
+        Returns:
+            float: Mean utility of the final wealth.
+        """
+        env = agent.env
+        rng = RandomStream(self.seed)  # Same held-out paths at every check
+        w_idx = np.full(self.n_episodes, env.wealth_to_index[agent.INITIAL_WEALTH])
+        for t in range(env.T):
+            a_idx = agent.q_table.greedy(t, w_idx)[0]
+            w_idx = env.sample_next_index(w_idx, a_idx, rng.random_array(self.n_episodes))
+        return float(np.mean(env.utility_table[w_idx]))
+
+    def check(self, trainer):
+        """
+        Score the greedy policy and compare with the best score so far.
+        """
+        score = self.evaluate(trainer.agent)
+        self.scores.append(score)
+        if len(self.scores) == 1 or score > self.best_score + self.min_delta:  # The first score is the reference
+            self.best_score = score
+            self._stale = 0
+        else:
+            self._stale += 1
+        if self._stale >= self.patience:
+            return f"greedy evaluation score {self.best_score:.6g} not improved for {self.patience} checks"
+        return None
+
+
+class ExperienceReplay(TrainerCallback):
+    """
+    The ExperienceReplay class replays stored transitions after every episode (or batch).
+
+    on_step stores every transition in a ReplayBuffer; at the end of an episode,
+    `updates` minibatches of `batch_size` transitions are replayed with vectorized
+    Agent.update_q_batch calls. With prioritized=True the minibatches are taken from the
+    head of a prioritized-sweeping queue instead of uniformly: transitions are ordered by
+    |TD error|, and after an update the errors of the replayed transitions and of all
+    stored transitions leading into the updated states are re-evaluated, so large value
+    changes (e.g. a rare high terminal utility) propagate backward stage by stage.
+    Replay uses sampled TD targets and needs a dense or packed Q-table.
+
+    Attributes:
+        buffer (ReplayBuffer): Stored transitions.
+        batch_size (int): Transitions per minibatch.
+        updates (int): Minibatches per episode.
+        prioritized (bool): Use the prioritized-sweeping queue.
+        threshold (float): Smallest |TD error| kept in the queue.
+        replayed (int): Number of replayed transitions.
+    """
+
+    def __init__(self, capacity=100_000, batch_size=64, updates=1, prioritized=False, threshold=1e-6, rng=None):
+        """
+        Initialize the replay.
+
+        Args:
+            capacity (int): Capacity of the ReplayBuffer.
+            batch_size (int): Transitions per minibatch.
+            updates (int): Minibatches per episode (BatchTrainer: per episode of the batch).
+            prioritized (bool): Use the prioritized-sweeping queue instead of uniform sampling.
+            threshold (float): Smallest |TD error| kept in the queue.
+            rng (RandomStream or int): Random stream for uniform sampling; trainer.agent.rng if None.
+        """
+        self.buffer = ReplayBuffer(capacity, rng=rng)  # Set the buffer
+        self._share_rng = rng is None  # Use the agent stream once training starts
+        self.batch_size = batch_size  # Set the minibatch size
+        self.updates = updates  # Set the number of minibatches per episode
+        self.prioritized = prioritized  # Set the sampling scheme
+        self.threshold = threshold  # Set the queue threshold
+        self.replayed = 0  # Number of replayed transitions
+        self._new_slots = []  # Slots stored since the last replay
+
+    def on_train_start(self, trainer):
+        """
+        Check the Q-table and share the exploration stream of the agent.
+        """
+        if trainer.agent.q_table.data is None:
+            raise ValueError("ExperienceReplay needs a dense or packed Q-table")
+        if self._share_rng:
+            self.buffer.rng = trainer.agent.rng
+
+    def on_step(self, trainer, episode, t, w_idx, a_idx, reward, w_next_idx):
+        """
+        Store the transition (a batch of transitions in BatchTrainer).
+        """
+        if np.ndim(w_idx) == 0:
+            self._new_slots.append(self.buffer.add(t, w_idx, a_idx, reward, w_next_idx))
+        else:
+            self._new_slots.extend(self.buffer.add_batch(t, w_idx, a_idx, reward, w_next_idx).tolist())
+
+    def on_episode_end(self, trainer, episode, epsilon, error, final_wealth):
+        """
+        Replay `updates` minibatches.
+        """
+        self._replay(trainer.agent, self.updates)
+
+    def on_batch_end(self, trainer, episodes, epsilon, errors, final_wealths):
+        """
+        Replay `updates` minibatches per episode of the batch.
+        """
+        self._replay(trainer.agent, self.updates * len(episodes))
+
+    def _refresh(self, agent, slots):
+        """
+        Re-evaluate the |TD error| of some slots as their priorities.
+        """
+        if len(slots):
+            self.buffer.priorities[slots] = np.abs(agent.td_error(*self.buffer.get(slots))[0])
+
+    def _replay(self, agent, n_updates):
+        """
+        Run n_updates minibatch updates from the buffer.
+
+        Args:
+            agent (Agent): The agent to update.
+            n_updates (int): Number of minibatches.
+        """
+        buffer = self.buffer
+        if self.prioritized:  # New transitions enter the queue with their current error
+            self._refresh(agent, np.unique(np.asarray(self._new_slots, dtype=np.int64)))
+        self._new_slots = []
+
+        for _ in range(n_updates):
+            slots = buffer.top(self.batch_size, self.threshold) if self.prioritized else buffer.sample(self.batch_size)
+            if len(slots) == 0:  # The queue is empty
+                break
+            t, w_idx, a_idx, reward, w_next_idx = buffer.get(slots)
+            agent.update_q_batch(t, w_idx, a_idx, reward, w_next_idx)
+            self.replayed += len(slots)
+            if self.prioritized:  # Re-evaluate the replayed transitions and the ones leading into them
+                self._refresh(agent, np.union1d(slots, buffer.predecessors(t, w_idx)))
+
+
+class PhaseTimer:
+    """
+    The PhaseTimer class accumulates wall-clock time and call counts per training phase.
+
+    Attributes:
+        totals_ns (dict): Total nanoseconds per phase.
+        counts (dict): Number of timed calls per phase.
+    """
+
+    def __init__(self):
+        """
+        Initialize empty timers.
+        """
+        self.totals_ns = {}  # Total nanoseconds per phase
+        self.counts = {}  # Number of timed calls per phase
+
+    def add(self, phase, elapsed_ns, count=1):
+        """
+        Add a measurement.
+
+        Args:
+            phase (str): Phase name.
+            elapsed_ns (int): Elapsed nanoseconds.
+            count (int): Number of calls covered by the measurement.
+        """
+        self.totals_ns[phase] = self.totals_ns.get(phase, 0) + elapsed_ns
+        self.counts[phase] = self.counts.get(phase, 0) + count
+
+    def summary(self):
+        """
+        Summarize the timers.
+
+        Returns:
+            dict: Per phase, the total seconds, the call count and the ns per call.
+        """
+        return {
+            phase: {"seconds": total / 1e9, "count": self.counts[phase], "ns_per_call": total / self.counts[phase]}
+            for phase, total in self.totals_ns.items()
+        }
+
+    def report(self):
+        """
+        Format the timers as a table, slowest phase first.
+
+        Returns:
+            str: Report text.
+        """
+        grand_total = sum(self.totals_ns.values()) or 1
+        lines = [f"{'phase':15s} {'seconds':>10s} {'share':>7s} {'calls':>12s} {'ns/call':>10s}"]
+        for phase, stats in sorted(self.summary().items(), key=lambda item: -item[1]["seconds"]):
+            lines.append(f"{phase:15s} {stats['seconds']:10.3f} {100 * stats['seconds'] * 1e9 / grand_total:6.1f}% "
+                         f"{stats['count']:12d} {stats['ns_per_call']:10.1f}")
+        return "\n".join(lines)
+
+
+def profile_training(trainer, path=None):
+    """
+    Run trainer.train() under cProfile.
+
+    For a sampling profile of a whole run use an external sampler instead, e.g.
+    `py-spy record -o profile.svg -- python benchmark.py --quick`.
+
+    Args:
+        trainer (Trainer): Trainer to run.
+        path (str): If given, write the profile there (readable with pstats or snakeviz).
+
+    Returns:
+        pstats.Stats: Profile statistics.
+    """
+    import cProfile
+    import pstats
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        trainer.train()
+    finally:
+        profiler.disable()
+    if path is not None:
+        profiler.dump_stats(path)
+    return pstats.Stats(profiler)
+
+
+class Trainer:
+    """
+    The Trainer class is responsible for training the Q-learning agent.
 
     Attributes:
-        T (int): Total number of stages.
-        p (float): Probability of obtaining high return from risky asset.
-        a_ret (float): High return of risky asset.
-        b_ret (float): Low return of risky asset.
-        riskless_ret (float): Fixed return of riskless asset.
-        W_MAX (int): Maximum wealth.
-        W_STEP (int): Discretization step for wealth.
-        ACTION_STEP (int): Discretization step for actions.
-        alpha (float): Parameter for the utility function.
+        agent (Agent): The Q-learning agent.
+        num_episodes (int): Number of training episodes.
+        verify_q_diff (bool): Compute the error from a full Q-table copy instead of the incremental sum.
+        checkpoint_dir (str): Directory for periodic checkpoints, or None.
+        checkpoint_every (int): Number of episodes between checkpoints.
+        update_mode (str): "sample" or "expected" Q updates.
+        episode (int): Index of the next episode to run.
+        callbacks (list): TrainerCallback hooks.
+        timers (PhaseTimer): Per-phase timers if instrumented, otherwise None.
+        stop_reason (str): Why the last train() call stopped early, or None.
+        stopped_episode (int): Number of episodes run when it stopped early, or None.
+        metrics (MetricsRecorder): Recorded per-episode metrics.
+        errors (np.ndarray): Training errors per episode.
+        final_wealths (np.ndarray): Final wealth values per episode.
     """
 
-    def __init__(self, T, p, a_ret, b_ret, riskless_ret, alpha, W_MAX, W_STEP, ACTION_STEP):
+    def __init__(self, agent, num_episodes, verify_q_diff=False, checkpoint_dir=None, checkpoint_every=1000,
+                 callbacks=None, instrument=False, update_mode="sample"):
         """
-        Initialize the environment with the given parameters.
+        Initialize the trainer with the given agent and number of episodes.
 
         Args:
-            T (int): Total number of stages.
-            p (float): Probability of obtaining high return from risky asset.
-            a_ret (float): High return of risky asset.
-            b_ret (float): Low return of risky asset.
-            riskless_ret (float): Fixed return of risky asset.
-            alpha (float): Parameter for the utility function.
-            W_MAX (int): Maximum wealth.
-            W_STEP (int): Discretization step for wealth.
-            ACTION_STEP (int): Discretization step for actions.
+            agent (Agent): The Q-learning agent.
+            num_episodes (int): Number of training episodes.
+            verify_q_diff (bool): If True, copy the Q-table every episode and compute the
+                error with Agent.compute_q_diff (slow, kept for verification).
+            checkpoint_dir (str): If given, save a checkpoint there every checkpoint_every
+                episodes and at the end of training.
+            checkpoint_every (int): Number of episodes between checkpoints.
+            callbacks (list): TrainerCallback hooks; [ProgressLogger()] if None, [] for silence.
+                StoppingRule callbacks end training early.
+            instrument (bool): If True, accumulate per-phase times in self.timers.
+            update_mode (str): "sample" for the sampled TD update (Agent.update_q_index) or
+                "expected" for the full backup over all outcomes (Agent.update_q_expected).
         """
-        self.T = T  # Set total number of stages
-        self.p = p  # Set probability of obtaining high return from risky asset
-        self.a_ret = a_ret  # Set high return of risky asset
-        self.b_ret = b_ret  # Set low return of risky asset
-        self.riskless_ret = riskless_ret  # Set fixed return of riskless asset
-        self.W_MAX = W_MAX  # Set maximum wealth
-        self.W_STEP = W_STEP  # Set discretization step for wealth
-        self.ACTION_STEP = ACTION_STEP  # Set discretization step for actions
-        self.alpha = alpha  # Set parameter for the utility function
-
-        # Construct the list of discretized wealth levels
-        self.all_wealth_levels = list(range(0, W_MAX + 1, W_STEP))
-        # Create a mapping from wealth levels to their indices
-        self.wealth_to_index = {w: i for i, w in enumerate(self.all_wealth_levels)}
-        # Create a dictionary of action candidates for each wealth level
-        self.action_candidates = {
-            w: list(range(0, w + 1, ACTION_STEP)) for w in self.all_wealth_levels
-        }
-
-    def get_next_state(self, w, x):
+        if update_mode not in ("sample", "expected"):
+            raise ValueError(f"Unknown update mode: {update_mode}")
+        if verify_q_diff and agent.Q is None:
+            raise ValueError("verify_q_diff needs a dense or packed Q-table")
+        self.agent = agent  # Set the agent
+        self.num_episodes = num_episodes  # Set the number of training episodes
+        self.verify_q_diff = verify_q_diff  # Set the error computation mode
+        self.checkpoint_dir = checkpoint_dir  # Set the checkpoint directory
+        self.checkpoint_every = checkpoint_every  # Set the checkpoint interval
+        self.update_mode = update_mode  # Set the Q update rule
+        self.episode = 0  # Index of the next episode to run
+        self.callbacks = [ProgressLogger()] if callbacks is None else list(callbacks)  # Set the hooks
+        self.timers = PhaseTimer() if instrument else None  # Set the per-phase timers
+        self.stop_reason = None  # Reason of an early stop
+        self.stopped_episode = None  # Episode count at an early stop
+        self.metrics = MetricsRecorder(capacity=num_episodes)  # Initialize the metrics buffers
+
+    def _hooks(self, *names):
         """
-        Calculate the next state based on the current state and action.
+        Collect the bound hooks of the callbacks that override any of the given methods.
 
         Args:
-            w (int): Current wealth.
-            x (int): Investment amount.
+            *names (str): Hook names; the first one is the method that gets bound.
 
         Returns:
-            int: Next state (wealth).
+            list: Bound methods.
         """
-        # Determine the return of the risky asset
-        ret_risky = self.a_ret if random.random() < self.p else self.b_ret
-        # Calculate the next wealth level
-        w_float = x * (1.0 + ret_risky) + (w - x) * (1.0 + self.riskless_ret)
-        # Discretize the next wealth level
-        w_next = int(round(w_float / self.W_STEP)) * self.W_STEP
-        # Ensure the next wealth level is within bounds
-        w_next = max(0, min(w_next, self.W_MAX))
-        return w_next  # Return the next wealth level
+        return [getattr(cb, names[0]) for cb in self.callbacks if any(cb.overrides(name) for name in names)]
 
-    def utility(self, w):
+    def request_stop(self, reason):
         """
-        Calculate the exponential utility of wealth.
+        Stop training after the current episode (BatchTrainer: after the current batch).
 
         Args:
-            w (float): Wealth.
-
-        Returns:
-            float: Utility value.
+            reason (str): Why training stops.
         """
-        return -np.exp(-self.alpha * w) / self.alpha  # Calculate and return the utility value
+        if self.stop_reason is None:  # Keep the first reason
+            self.stop_reason = reason
+            self.stopped_episode = self.episode
 
-    def get_reward(self, t, w):
+    @property
+    def errors(self):
         """
-        Calculate the reward based on the current time step and wealth.
+        np.ndarray: Training errors per episode.
+        """
+        return self.metrics.errors
 
-        Args:
-            t (int): Current time step.
-            w (int): Current wealth.
+    @property
+    def final_wealths(self):
+        """
+        np.ndarray: Final wealth values per episode.
+        """
+        return self.metrics.final_wealths
 
-        Returns:
-            float: Reward value.
+    def train(self):
         """
-        if t == self.T - 1:  # If it is the last time step
-            return self.utility(w)  # Return the utility as the reward
-        return 0.0  # Otherwise, return 0 as the reward
+        Train the Q-learning agent.
+        """
+        agent = self.agent
+        env = agent.env
+        timers = self.timers  # None unless instrumented
+        clock = time.perf_counter_ns
+        # Only hooks that are actually overridden are dispatched
+        start_hooks = self._hooks("on_episode_start")
+        step_hooks = self._hooks("on_step")
+        end_hooks = self._hooks("on_episode_end")
+        update_q = agent.update_q_index if self.update_mode == "sample" else agent.update_q_expected
+        self.stop_reason = self.stopped_episode = None
+        for callback in self.callbacks:
+            callback.on_train_start(self)
+        w0_idx = env.wealth_to_index[agent.INITIAL_WEALTH]  # Index of the initial wealth
+
+        for episode in range(self.episode, self.num_episodes):  # Iterate over the remaining episodes
+            # Calculate the current epsilon value
+            epsilon = agent.compute_epsilon(episode)
+            for hook in start_hooks:
+                hook(self, episode, epsilon)
+
+            # Copy the old Q-table only in verification mode; otherwise the agent accumulates |delta Q|
+            t0 = clock() if timers is not None else 0
+            Q_before = agent.Q.copy() if self.verify_q_diff else None
+            agent.reset_q_diff()
+            if timers is not None:
+                timers.add("q_diff", clock() - t0)
+
+            # Initialize the initial state (wealth values only appear at the edges)
+            t = 0  # Set the initial time step to 0
+            w_idx = w0_idx  # Set the initial wealth index
+
+            while t < env.T:  # Iterate over all time steps
+                if timers is None:
+                    # Choose an action index using the epsilon-greedy policy
+                    a_idx = agent.choose_action_index(t, w_idx, epsilon)
+
+                    # Execute the action and get the next state and reward
+                    w_next_idx = env.step_index(w_idx, a_idx)
+                    reward = env.get_reward_index(t, w_next_idx)
+
+                    # Update the Q-table
+                    update_q(t, w_idx, a_idx, reward, w_next_idx)
+                else:  # The same steps with a timer around every phase
+                    t0 = clock()
+                    a_idx = agent.choose_action_index(t, w_idx, epsilon)
+                    t1 = clock()
+                    w_next_idx = env.step_index(w_idx, a_idx)
+                    reward = env.get_reward_index(t, w_next_idx)
+                    t2 = clock()
+                    update_q(t, w_idx, a_idx, reward, w_next_idx)
+                    t3 = clock()
+                    timers.add("choose_action", t1 - t0)
+                    timers.add("step", t2 - t1)
+                    timers.add("update_q", t3 - t2)
+
+                if step_hooks:
+                    for hook in step_hooks:
+                        hook(self, episode, t, w_idx, a_idx, reward, w_next_idx)
 
+                # Update the current state
+                w_idx = w_next_idx
+                t += 1  # Increment the time step
 
-class Agent:
-    """
-    The Agent class represents the Q-learning agent.
+            # Record the error and final wealth
+            t0 = clock() if timers is not None else 0
+            if self.verify_q_diff:
+                diff_val = agent.compute_q_diff(Q_before)  # Calculate the full Q-table difference
+            else:
+                diff_val = agent.reset_q_diff()  # Take the accumulated difference of this episode
+            final_wealth = env.all_wealth_levels[w_idx]
+            self.metrics.record(diff_val, final_wealth)  # Record the error and final wealth
+            self.episode = episode + 1  # Episode finished
+            if timers is not None:
+                t1 = clock()
+                timers.add("q_diff" if self.verify_q_diff else "record", t1 - t0)
+
+            # Logging, metric export and monitors run as callbacks
+            for hook in end_hooks:
+                hook(self, episode, epsilon, diff_val, final_wealth)
+            if timers is not None:
+                t2 = clock()
+                timers.add("callbacks", t2 - t1)
+
+            # Save a checkpoint periodically
+            if self.checkpoint_dir is not None and self.episode % self.checkpoint_every == 0:
+                self.save_checkpoint(self.checkpoint_dir)
+                if timers is not None:
+                    timers.add("checkpoint", clock() - t2)
+            if self.stop_reason is not None:  # A stopping rule ended training
+                break
+
+        if self.checkpoint_dir is not None:  # Save the final state
+            self.save_checkpoint(self.checkpoint_dir)
+        for callback in self.callbacks:
+            callback.on_train_end(self)
+
+    def _rng_streams(self):
+        """
+        List the distinct random streams used for training.
 
-    Attributes:
-        env (Environment): The environment in which the agent operates.
-        alpha (float): Learning rate.
-        gamma (float): Discount factor.
-        epsilon_start (float): Initial epsilon value for epsilon-greedy policy.
-        epsilon_end (float): Final epsilon value for epsilon-greedy policy.
-        decay_rate (float): Decay rate for epsilon.
-    """
+        Returns:
+            list: List of RandomStream.
+        """
+        streams = []
+        for stream in (self.agent.env.rng, self.agent.rng):
+            if all(stream is not other for other in streams):
+                streams.append(stream)
+        return streams
 
-    def __init__(self, env, alpha, gamma, epsilon_start, epsilon_end, decay_rate, INITIAL_WEALTH):
+    def _get_rng_state(self):
         """
-        Initialize the agent with the given parameters.
+        Get the state of the random streams used for training.
 
-        Args:
-            env (Environment): The environment in which the agent operates.
-            alpha (float): Learning rate.
-            gamma (float): Discount factor.
-            epsilon_start (float): Initial epsilon value for epsilon-greedy policy.
-            epsilon_end (float): Final epsilon value for epsilon-greedy policy.
-            decay_rate (float): Decay rate for epsilon.
+        Returns:
+            list: Picklable states, one per stream of _rng_streams.
         """
-        self.env = env  # Set the environment
-        self.alpha = alpha  # Set the learning rate
-        self.gamma = gamma  # Set the discount factor
-        self.epsilon_start = epsilon_start  # Set the initial epsilon value
-        self.epsilon_end = epsilon_end  # Set the final epsilon value
-        self.decay_rate = decay_rate  # Set the decay rate for epsilon
-        self.INITIAL_WEALTH = INITIAL_WEALTH # Set the initial wealth
+        return [stream.get_state() for stream in self._rng_streams()]
 
-        # Initialize the Q-table
-        self.max_act_count = max(len(self.env.action_candidates[w]) for w in self.env.all_wealth_levels)
-        self.Q = np.zeros((env.T, len(env.all_wealth_levels), self.max_act_count), dtype=float)
-        self.action_index_map = self._build_action_index_map()  # Build the action index map
+    def _set_rng_state(self, state):
+        """
+        Restore the state of the random streams used for training.
 
-    def _build_action_index_map(self):
+        Args:
+            state (list): States returned by _get_rng_state.
         """
-        Build the action index map.
+        for stream, stream_state in zip(self._rng_streams(), state):
+            stream.set_state(stream_state)
 
-        Returns:
-            np.ndarray: Action index map.
+    def save_checkpoint(self, path):
         """
-        # Initialize an empty array for the action index map
-        action_index_map = np.empty((self.env.T, len(self.env.all_wealth_levels)), dtype=object)
-        for t in range(self.env.T):  # Iterate over all time steps
-            for w_idx, w_val in enumerate(self.env.all_wealth_levels):  # Iterate over all wealth levels
-                cand = self.env.action_candidates[w_val]  # Get the action candidates for the current wealth level
-                # Create a mapping from action values to their indices
-                idx_map = {x_val: i for i, x_val in enumerate(cand)}
-                action_index_map[t, w_idx] = idx_map  # Store the mapping in the action index map
-        return action_index_map  # Return the action index map
+        Save Q, the episode index, the random state and the metrics to a directory.
 
-    def compute_epsilon(self, episode):
+        Q is written as a memory-mapped .npy file. The checkpoint is first written to a
+        temporary directory which then replaces path, so a crash never leaves a partial
+        checkpoint behind.
+
+        Args:
+            path (str): Checkpoint directory.
         """
-        Compute the epsilon value for epsilon-greedy, decaying exponentially.
+        tmp_path = path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        # Write Q through a memory map; a sparse table saves its allocated rows only
+        Q = self.agent.Q
+        if Q is None:
+            self.agent.q_table.save(os.path.join(tmp_path, "Q_sparse.npz"))
+        else:
+            q_file = np.lib.format.open_memmap(os.path.join(tmp_path, "Q.npy"), mode="w+", dtype=Q.dtype, shape=Q.shape)
+            q_file[:] = Q
+            q_file.flush()
+            del q_file
+
+        self.metrics.save(os.path.join(tmp_path, "metrics.npz"))
+        with open(os.path.join(tmp_path, "state.pkl"), "wb") as f:
+            pickle.dump({"episode": self.episode, "rng_state": self._get_rng_state()}, f)
+
+        # Swap the new checkpoint in; load_checkpoint falls back to path.old in between
+        if os.path.isdir(path):
+            shutil.rmtree(path + ".old", ignore_errors=True)
+            os.replace(path, path + ".old")
+        os.replace(tmp_path, path)
+        shutil.rmtree(path + ".old", ignore_errors=True)
+
+    def load_checkpoint(self, path):
         """
-        return self.epsilon_end + (self.epsilon_start - self.epsilon_end)*np.exp(-self.decay_rate*episode)
+        Restore the state saved by save_checkpoint into this trainer and its agent.
 
-    def choose_action(self, t, w, eps):
+        The agent must have been constructed with the same parameters as the one that
+        wrote the checkpoint.
+
+        Args:
+            path (str): Checkpoint directory.
         """
-        Choose an action using epsilon-greedy policy.
+        path = _checkpoint_dir(path)
+        if self.agent.Q is None:
+            self.agent.q_table.load(os.path.join(path, "Q_sparse.npz"))
+        else:
+            np.copyto(self.agent.Q, load_checkpoint_q(path))  # Copy in place so views of Q stay valid
+        self.metrics = MetricsRecorder.load(os.path.join(path, "metrics.npz"), capacity=self.num_episodes)
+        with open(os.path.join(path, "state.pkl"), "rb") as f:
+            state = pickle.load(f)
+        self.episode = state["episode"]
+        self._set_rng_state(state["rng_state"])
+
+    def resume(self, path):
+        """
+        Continue training from a checkpoint up to num_episodes.
 
         Args:
-            t (int): Current time step.
-            w (int): Current wealth.
-            eps (float): Epsilon value for epsilon-greedy policy.
+            path (str): Checkpoint directory.
+        """
+        self.load_checkpoint(path)
+        self.train()
 
-        Returns:
-            int: Chosen action (investment amount).
+    def _log_progress(self, episode, epsilon):
         """
-        cand_x = self.env.action_candidates[w]  # Get the action candidates for the current wealth level
-        w_idx = self.env.wealth_to_index[w]  # Get the index of the current wealth level
-        q_vals_for_w = self.Q[t, w_idx, :len(cand_x)]  # Get the Q-values for the current state
+        Print the progress line for the given episode.
 
-        if random.random() < eps:  # With probability eps, choose a random action (exploration)
-            return random.choice(cand_x)  # Return a random action
-        else:  # Otherwise, choose the best action (exploitation)
-            best_idx = np.argmax(q_vals_for_w)  # Get the index of the best action
-            return cand_x[best_idx]  # Return the best action
+        Args:
+            episode (int): Index of the episode that has just finished.
+            epsilon (float): Epsilon value used in that episode.
+        """
+        # Calculate average Q-diff and final wealth over the last 100 episodes up to this episode
+        avg_qdiff, avg_wealth = self.metrics.rolling_means(episode)
 
-    def update_q_table(self, t, w, x, reward, w_next):
+        print(f"Episode {episode+1}/{self.num_episodes} | eps={epsilon:.4f} "
+              f"| Avg Q-diff Last {self.metrics.window}={avg_qdiff:.4f} "
+              f"| Avg Wealth Last {self.metrics.window}={avg_wealth:.2f}")
+
+    def plot_results(self, path=None, max_points=2000):
         """
-        Update the Q-table based on the current state, action, reward, and next state.
+        Plot the training results, including training error and final wealth.
+
+        Moving averages are computed with cumulative sums and every curve is downsampled
+        to at most max_points points, so long runs plot quickly.
 
         Args:
-            t (int): Current time step.
-            w (int): Current wealth.
-            x (int): Chosen action (investment amount).
-            reward (float): Reward received.
-            w_next (int): Next state (wealth).
+            path (str): If given, render with the non-interactive Agg backend and save the
+                figure to this file; otherwise show it with pyplot.
+            max_points (int): Maximum number of points per curve.
         """
-        w_idx = self.env.wealth_to_index[w]  # Get the index of the current wealth level
-        a_idx = self.action_index_map[t, w_idx][x]  # Get the index of the chosen action
+        if path is not None:  # Headless: a bare Figure renders with Agg without loading pyplot
+            from matplotlib.figure import Figure
+            fig = Figure(figsize=(12, 5))
+        else:
+            import matplotlib.pyplot as plt
+            fig = plt.figure(figsize=(12, 5))  # Create a new figure with a specified size
 
-        if t < self.env.T - 1:  # If it is not the last time step
-            w_next_idx = self.env.wealth_to_index[w_next]  # Get the index of the next wealth level
-            n_actions_next = len(self.env.action_candidates[w_next])  # Get the number of actions for the next state
-            max_q_next = np.max(self.Q[t + 1, w_next_idx, :n_actions_next])  # Get the maximum Q-value for the next state
-        else:  # If it is the last time step
-            max_q_next = 0.0  # Set the maximum Q-value for the next state to 0
+        # Plot the training error
+        ax = fig.add_subplot(1, 2, 1)  # Create a subplot for the training error
+        ax.plot(*downsample(self.errors, max_points), label="Training error (delta Q)")  # Plot the training errors
+        window_err = 100  # Set the window size for moving average
+        if len(self.errors) > window_err:  # If there are enough errors to calculate the moving average
+            # Calculate the moving average of the errors
+            smoothed_err = moving_average(self.errors, window_err)
+            ax.plot(*downsample(smoothed_err, max_points),
+                    label=f"Err Moving Avg(window={window_err})", color="red", alpha=0.7)
+        ax.set_xlabel("Episode")
+        ax.set_ylabel("Sum of |delta Q|")
+        ax.set_title("Training Error")
+        ax.legend()
+
+        # Plot the final wealth
+        ax = fig.add_subplot(1, 2, 2)
+        ax.plot(*downsample(self.final_wealths, max_points), label="Final wealth per episode", alpha=0.6)
+        window_w = 500
+        if len(self.final_wealths) > window_w:
+            smoothed = moving_average(self.final_wealths, window_w)
+            ax.plot(*downsample(smoothed, max_points), label=f"Wealth MA(window={window_w})", color="red", alpha=0.7)
 
-        old_q = self.Q[t, w_idx, a_idx]  # Get the old Q-value for the current state-action pair
-        # Update the Q-value using the Q-learning update rule
-        self.Q[t, w_idx, a_idx] = old_q + self.alpha * (reward + self.gamma * max_q_next - old_q)
+        ax.set_xlabel("Episode")
+        ax.set_ylabel("Final Wealth")
+        ax.set_title("Final Wealth over Episodes")
+        ax.legend()
 
-    def compute_q_diff(self, Q_old):
+        fig.tight_layout()
+        if path is not None:
+            fig.savefig(path)
+        else:
+            plt.show()
+
+
+class BatchTrainer(Trainer):
+    """
+    The BatchTrainer class trains the Q-learning agent on many episodes at once.
+
+    A batch of B episodes is kept as NumPy arrays of wealth indices and all of them
+    advance through the T stages in lockstep. Epsilon-greedy decisions and risky-asset
+    outcomes are drawn for the whole batch at once, and the Q updates of a stage are
+    accumulated with np.bincount (equivalent to np.add.at).
+
+    Difference to the sequential Trainer: within a stage, every episode computes its TD
+    target from the Q-table as it was before that stage of the batch. If k episodes of a
+    batch hit the same (t, w, x) cell, the cell moves by the sum of the k increments
+    alpha * (target_i - Q_old) rather than by k successive updates, i.e. by k * alpha
+    instead of 1 - (1 - alpha)^k of the way towards the mean target. The two agree to first
+    order in alpha * k, so batch_size * alpha should stay well below 1. Also, stage t of an
+    episode only sees the Q[t + 1] updates of earlier batches, not those of earlier episodes
+    in the same batch. The recorded error of an episode is the sum of |increment| of its
+    own updates.
+
+    Attributes:
+        batch_size (int): Number of concurrent episodes.
+        rng (RandomStream): Random stream for exploration and asset returns.
+    """
+
+    def __init__(self, agent, num_episodes, batch_size=1024, rng=None, checkpoint_dir=None, checkpoint_every=1000,
+                 callbacks=None, instrument=False, update_mode="sample"):
         """
-        Compute the difference between the old and new Q-tables.
+        Initialize the batch trainer.
 
         Args:
-            Q_old (np.ndarray): Old Q-table.
+            agent (Agent): The Q-learning agent.
+            num_episodes (int): Number of training episodes.
+            batch_size (int): Number of episodes simulated in lockstep.
+            rng (RandomStream or int): Random stream, or seed of a new one; shares agent.rng if None.
+            checkpoint_dir (str): If given, save a checkpoint there at the first batch end
+                after every checkpoint_every episodes and at the end of training.
+            checkpoint_every (int): Number of episodes between checkpoints.
+            callbacks (list): TrainerCallback hooks, as for Trainer.
+            instrument (bool): If True, accumulate per-phase times in self.timers.
+            update_mode (str): "sample" or "expected", as for Trainer.
+        """
+        if agent.q_table.data is None:
+            raise ValueError("BatchTrainer needs a dense or packed Q-table")
+        super().__init__(agent, num_episodes, checkpoint_dir=checkpoint_dir, checkpoint_every=checkpoint_every,
+                         callbacks=callbacks, instrument=instrument, update_mode=update_mode)
+        self.batch_size = batch_size  # Set the number of concurrent episodes
+        self.rng = agent.rng if rng is None else as_random_stream(rng)  # Set the random stream
+
+    def train(self):
+        """
+        Train the Q-learning agent in batches of concurrent episodes.
+        """
+        agent = self.agent
+        env = agent.env
+        q_table = agent.q_table
+        timers = self.timers  # None unless instrumented
+        clock = time.perf_counter_ns
+        # Only hooks that are actually overridden are dispatched
+        start_hooks = self._hooks("on_batch_start", "on_episode_start")
+        step_hooks = self._hooks("on_step")
+        end_hooks = self._hooks("on_batch_end", "on_episode_end")
+        outcomes = env.transition_outcomes() if self.update_mode == "expected" else None
+        self.stop_reason = self.stopped_episode = None
+        for callback in self.callbacks:
+            callback.on_train_start(self)
+        w0_idx = env.wealth_to_index[agent.INITIAL_WEALTH]  # Index of the initial wealth
+
+        for start in range(self.episode, self.num_episodes, self.batch_size):  # Iterate over the remaining batches
+            episodes = np.arange(start, min(start + self.batch_size, self.num_episodes))
+            B = len(episodes)
+            epsilon = agent.compute_epsilon(episodes)  # Epsilon value of every episode
+            for hook in start_hooks:
+                hook(self, episodes, epsilon)
+
+            w_idx = np.full(B, w0_idx)  # Every episode starts from the initial wealth
+            errors = np.zeros(B)  # Sum of |delta Q| of every episode
+
+            for t in range(env.T):  # Iterate over all time steps in lockstep
+                t0 = clock() if timers is not None else 0
+                # Choose actions with the epsilon-greedy policy for the whole batch
+                explore = self.rng.random_array(B) < epsilon
+                random_a = (self.rng.random_array(B) * env.action_counts[w_idx]).astype(np.int64)
+                greedy_a = q_table.greedy(t, w_idx)[0]
+                a_idx = np.where(explore, random_a, greedy_a)
+                t1 = clock() if timers is not None else 0
+
+                # Execute the actions and get the next states and rewards
+                w_next_idx = env.sample_next_index(w_idx, a_idx, self.rng.random_array(B))
+                reward = env.get_reward_index(t, w_next_idx)
+                t2 = clock() if timers is not None else 0
+
+                if outcomes is not None:  # Full backup: expectation over all outcomes
+                    pair = env.pair_index(w_idx, a_idx)
+                    target = 0.0
+                    for prob, next_idx in outcomes:
+                        w_out = next_idx[pair]
+                        if t < env.T - 1:
+                            value = agent.gamma * q_table.greedy(t + 1, w_out)[1]
+                        else:
+                            value = env.utility_table[w_out]
+                        target = target + (prob[pair] if np.ndim(prob) else prob) * value
+                elif t < env.T - 1:  # If it is not the last time step
+                    target = reward + agent.gamma * q_table.greedy(t + 1, w_next_idx)[1]
+                else:  # If it is the last time step
+                    target = reward
+
+                # Scatter the Q updates; repeated cells accumulate all increments
+                cells = q_table.flat_index(w_idx, a_idx)  # Cell positions in the stage row
+                old_q = q_table.data[t, cells]
+                delta = agent.alpha * (target - old_q)
+                q_table.data[t] += np.bincount(cells, weights=delta, minlength=q_table.data.shape[1])
+                errors += np.abs(delta)
+                if timers is not None:
+                    t3 = clock()
+                    timers.add("choose_action", t1 - t0, B)
+                    timers.add("step", t2 - t1, B)
+                    timers.add("update_q", t3 - t2, B)
+
+                for hook in step_hooks:
+                    hook(self, episodes, t, w_idx, a_idx, reward, w_next_idx)
+
+                w_idx = w_next_idx  # Update the current states
+
+            # Record the errors and final wealths of the batch
+            t0 = clock() if timers is not None else 0
+            final_wealths = env.wealth_values[w_idx]
+            self.metrics.record_batch(errors, final_wealths)
+            self.episode = start + B  # Batch finished
+            if timers is not None:
+                t1 = clock()
+                timers.add("record", t1 - t0, B)
+
+            # Logging, metric export and monitors run as callbacks
+            for hook in end_hooks:
+                hook(self, episodes, epsilon, errors, final_wealths)
+            if timers is not None:
+                t2 = clock()
+                timers.add("callbacks", t2 - t1, B)
+
+            # Save a checkpoint when the batch crosses a multiple of checkpoint_every
+            if self.checkpoint_dir is not None and (self.episode // self.checkpoint_every) > (start // self.checkpoint_every):
+                self.save_checkpoint(self.checkpoint_dir)
+                if timers is not None:
+                    timers.add("checkpoint", clock() - t2)
+            if self.stop_reason is not None:  # A stopping rule ended training
+                break
+
+        if self.checkpoint_dir is not None:  # Save the final state
+            self.save_checkpoint(self.checkpoint_dir)
+        for callback in self.callbacks:
+            callback.on_train_end(self)
+
+    def _rng_streams(self):
+        """
+        List the distinct random streams used for training, including the batch stream.
 
         Returns:
-            float: Sum of absolute differences between the old and new Q-tables.
+            list: List of RandomStream.
         """
-        return np.sum(np.abs(Q_old - self.Q))  # Calculate and return the sum of absolute differences
+        streams = super()._rng_streams()
+        if all(self.rng is not other for other in streams):
+            streams.append(self.rng)
+        return streams
 
 
-class Trainer:
+def _parallel_worker(agent, shm_name, shape, slot, update_mode, conn):
     """
-    The Trainer class is responsible for training the Q-learning agent.
+    Run episodes of a ParallelTrainer on a Q-table in shared memory (worker process).
+
+    Every task received on conn is a pair (episodes, seed); the worker runs the episodes
+    with a RandomStream(seed) and sends back their errors and final wealths. None ends
+    the worker.
+
+    Args:
+        agent (Agent): Copy of the agent; its Q-table is rebound to the shared memory.
+        shm_name (str): Name of the shared memory block.
+        shape (tuple): Shape of the blocks, (n_blocks, T, row_size).
+        slot (int): Block the worker updates; 0 is the shared Q-table, others are local copies.
+        update_mode (str): "sample" or "expected".
+        conn (multiprocessing.connection.Connection): Pipe to the trainer.
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    blocks = np.ndarray(shape, dtype=agent.q_table.data.dtype, buffer=shm.buf)
+    env = agent.env
+    q_table = agent.q_table
+    q_table.data = blocks[slot]  # Rebind the Q-values to the shared memory
+    agent.Q = q_table.array
+    update_q = agent.update_q_index if update_mode == "sample" else agent.update_q_expected
+    w0_idx = env.wealth_to_index[agent.INITIAL_WEALTH]  # Index of the initial wealth
+    try:
+        while True:
+            task = conn.recv()
+            if task is None:  # End of training
+                break
+            episodes, seed = task
+            if slot > 0:  # Averaging: start from the current average
+                np.copyto(q_table.data, blocks[0])
+            env.rng = agent.rng = RandomStream(seed)  # Stream of this worker and round
+            errors = np.empty(len(episodes))
+            final_wealths = np.empty(len(episodes))
+            for k, episode in enumerate(episodes):  # The loop of Trainer.train without hooks
+                epsilon = agent.compute_epsilon(episode)
+                agent.reset_q_diff()
+                w_idx = w0_idx
+                for t in range(env.T):
+                    a_idx = agent.choose_action_index(t, w_idx, epsilon)
+                    w_next_idx = env.step_index(w_idx, a_idx)
+                    reward = env.get_reward_index(t, w_next_idx)
+                    update_q(t, w_idx, a_idx, reward, w_next_idx)
+                    w_idx = w_next_idx
+                errors[k] = agent.reset_q_diff()
+                final_wealths[k] = env.wealth_values[w_idx]
+            conn.send((errors, final_wealths))
+    except Exception as exc:  # Report the error to the trainer instead of hanging it
+        conn.send(exc)
+    finally:
+        q_table.data = agent.Q = blocks = None  # Release the views before closing the memory
+        shm.close()
+        conn.close()
+
+
+class ParallelTrainer(Trainer):
+    """
+    The ParallelTrainer class trains the Q-learning agent with several worker processes.
+
+    The Q-table lives in multiprocessing.shared_memory and every worker runs the scalar
+    episode loop of Trainer with its own random stream. Training proceeds in rounds of
+    n_workers * sync_every episodes, dealt round-robin to the workers so all of them
+    follow the same epsilon schedule. Between rounds the trainer merges the errors and
+    final wealths into one stream in episode order and runs callbacks, checkpoints and
+    stopping rules, as BatchTrainer does for a batch (on_step hooks are not supported).
+
+    Modes:
+        "hogwild": all workers update the shared Q-table without locks. Updates of one
+            worker are visible to the others immediately; concurrent updates of the same
+            cell may occasionally be lost, and runs are not bit-for-bit reproducible.
+        "average": every worker updates a local copy, which starts each round from the
+            shared table; after the round every cell of the shared table becomes the mean
+            of the copies that changed it (a plain mean would shrink the update of a cell
+            visited by one worker to 1 / n_workers). This is reproducible from the seed, but
+            a cell visited by several workers moves by the mean of their changes rather
+            than their sum, so it learns more slowly per episode than "hogwild".
 
     Attributes:
-        agent (Agent): The Q-learning agent.
-        num_episodes (int): Number of training episodes.
-        errors (list): List to store training errors.
-        final_wealths (list): List to store final wealth values.
+        n_workers (int): Number of worker processes.
+        mode (str): "hogwild" or "average".
+        sync_every (int): Episodes per worker and round.
+        rng (RandomStream): Random stream from which the worker seeds of every round are drawn.
     """
 
-    def __init__(self, agent, num_episodes):
+    def __init__(self, agent, num_episodes, n_workers=None, mode="hogwild", sync_every=100, rng=None,
+                 checkpoint_dir=None, checkpoint_every=1000, callbacks=None, update_mode="sample",
+                 start_method=None):
         """
-        Initialize the trainer with the given agent and number of episodes.
+        Initialize the parallel trainer.
 
         Args:
-            agent (Agent): The Q-learning agent.
+            agent (Agent): The Q-learning agent; its Q-table must be dense or packed.
             num_episodes (int): Number of training episodes.
+            n_workers (int): Number of worker processes; os.cpu_count() if None.
+            mode (str): "hogwild" (lock-free shared updates) or "average" (periodic averaging).
+            sync_every (int): Episodes per worker and round.
+            rng (RandomStream or int): Random stream, or seed of a new one; shares agent.rng if None.
+            checkpoint_dir (str): If given, save a checkpoint there at the first round end
+                after every checkpoint_every episodes and at the end of training.
+            checkpoint_every (int): Number of episodes between checkpoints.
+            callbacks (list): TrainerCallback hooks, as for BatchTrainer.
+            update_mode (str): "sample" or "expected", as for Trainer.
+            start_method (str): multiprocessing start method; the platform default if None.
         """
-        self.agent = agent  # Set the agent
-        self.num_episodes = num_episodes  # Set the number of training episodes
-        self.errors = []  # Initialize the list to store training errors
-        self.final_wealths = []  # Initialize the list to store final wealth values
+        if agent.q_table.data is None:
+            raise ValueError("ParallelTrainer needs a dense or packed Q-table")
+        if mode not in ("hogwild", "average"):
+            raise ValueError(f"Unknown parallel mode: {mode}")
+        super().__init__(agent, num_episodes, checkpoint_dir=checkpoint_dir, checkpoint_every=checkpoint_every,
+                         callbacks=callbacks, update_mode=update_mode)
+        if self._hooks("on_step"):
+            raise ValueError("ParallelTrainer does not dispatch on_step hooks")
+        self.n_workers = n_workers or os.cpu_count()  # Set the number of worker processes
+        self.mode = mode  # Set the synchronization mode
+        self.sync_every = sync_every  # Set the episodes per worker and round
+        self.rng = agent.rng if rng is None else as_random_stream(rng)  # Set the random stream
+        self.start_method = start_method  # Set the multiprocessing start method
 
     def train(self):
         """
-        Train the Q-learning agent.
+        Train the Q-learning agent in rounds of parallel episodes.
         """
-        for episode in range(self.num_episodes):  # Iterate over all episodes
-            # Calculate the current epsilon value
-            epsilon = self.agent.compute_epsilon(episode)
+        agent = self.agent
+        q_table = agent.q_table
+        n = self.n_workers
+        start_hooks = self._hooks("on_batch_start", "on_episode_start")
+        end_hooks = self._hooks("on_batch_end", "on_episode_end")
+        self.stop_reason = self.stopped_episode = None
+
+        # Block 0 is the shared Q-table, blocks 1..n the local copies of the averaging mode
+        data = q_table.data
+        shape = (1 + (n if self.mode == "average" else 0),) + data.shape
+        shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * data.itemsize, 1))
+        blocks = np.ndarray(shape, dtype=data.dtype, buffer=shm.buf)
+        np.copyto(blocks[0], data)
+        q_table.data = blocks[0]  # The trainer sees the shared table, e.g. for stopping rules and checkpoints
+        agent.Q = q_table.array
+
+        context = multiprocessing.get_context(self.start_method)
+        conns, workers = [], []
+        try:
+            for i in range(n):
+                parent, child = context.Pipe()
+                slot = i + 1 if self.mode == "average" else 0
+                worker = context.Process(target=_parallel_worker,
+                                         args=(agent, shm.name, shape, slot, self.update_mode, child), daemon=True)
+                worker.start()
+                child.close()
+                conns.append(parent)
+                workers.append(worker)
+            for callback in self.callbacks:
+                callback.on_train_start(self)
+
+            round_size = n * self.sync_every
+            for start in range(self.episode, self.num_episodes, round_size):  # Iterate over the remaining rounds
+                episodes = np.arange(start, min(start + round_size, self.num_episodes))
+                epsilon = agent.compute_epsilon(episodes)
+                for hook in start_hooks:
+                    hook(self, episodes, epsilon)
+
+                # Deal the episodes round-robin, each worker with a fresh seed drawn from self.rng
+                seeds = (self.rng.random_array(n) * 2.0 ** 63).astype(np.int64)
+                for i, conn in enumerate(conns):
+                    conn.send((episodes[i::n], int(seeds[i])))
+                errors = np.empty(len(episodes))
+                final_wealths = np.empty(len(episodes))
+                for i, conn in enumerate(conns):
+                    result = conn.recv()
+                    if isinstance(result, Exception):
+                        raise result
+                    errors[i::n], final_wealths[i::n] = result
+                if self.mode == "average":  # Per-cell mean over the copies that changed the cell
+                    changes = blocks[1:] - blocks[0]
+                    blocks[0] += changes.sum(axis=0) / np.maximum(np.count_nonzero(changes, axis=0), 1)
+
+                # Record the merged metrics of the round
+                self.metrics.record_batch(errors, final_wealths)
+                self.episode = start + len(episodes)  # Round finished
+                for hook in end_hooks:
+                    hook(self, episodes, epsilon, errors, final_wealths)
+
+                # Save a checkpoint when the round crosses a multiple of checkpoint_every
+                if self.checkpoint_dir is not None and (self.episode // self.checkpoint_every) > (start // self.checkpoint_every):
+                    self.save_checkpoint(self.checkpoint_dir)
+                if self.stop_reason is not None:  # A stopping rule ended training
+                    break
+
+            if self.checkpoint_dir is not None:  # Save the final state
+                self.save_checkpoint(self.checkpoint_dir)
+        finally:
+            for conn in conns:
+                try:
+                    conn.send(None)
+                except OSError:  # The worker has already exited
+                    pass
+                conn.close()
+            for worker in workers:
+                worker.join()
+            np.copyto(data, blocks[0])  # Move the result back into the agent's own array
+            q_table.data = data
+            agent.Q = q_table.array
+            del blocks
+            shm.close()
+            shm.unlink()
+        for callback in self.callbacks:
+            callback.on_train_end(self)
+
+    def _rng_streams(self):
+        """
+        List the distinct random streams used for training, including the round stream.
 
-            # Copy the old Q-table to calculate the difference later
-            Q_before = self.agent.Q.copy()
+        Returns:
+            list: List of RandomStream.
+        """
+        streams = super()._rng_streams()
+        if all(self.rng is not other for other in streams):
+            streams.append(self.rng)
+        return streams
 
-            # Initialize the initial state
-            t = 0  # Set the initial time step to 0
-            w_current = self.agent.INITIAL_WEALTH  # Set the initial wealth
 
-            while t < self.agent.env.T:  # Iterate over all time steps
-                # Choose an action using the epsilon-greedy policy
-                x_action = self.agent.choose_action(t, w_current, epsilon)
+class BackwardInductionSolver:
+    """
+    The BackwardInductionSolver class computes the optimal Q-values of the Environment exactly.
 
-                # Execute the action and get the next state and reward
-                w_next = self.agent.env.get_next_state(w_current, x_action)
-                reward = self.agent.env.get_reward(t, w_next)
+    The environment is a finite MDP with two risky-asset outcomes, so the optimal Q for all
+    (t, w, x) follows by backward induction from the last stage, one vectorized array
+    operation per stage. The result has the same layout as Agent.Q (padding slots are 0),
+    so it can serve as ground truth for Q-learning (e.g. agent.compute_q_diff(solver.Q))
+    or seed an agent via Agent.warm_start.
 
-                # Update the Q-table
-                self.agent.update_q_table(t, w_current, x_action, reward, w_next)
+    Attributes:
+        env (Environment): The environment to solve.
+        gamma (float): Discount factor.
+        q_table (QTable): Optimal Q-values, after solve().
+        Q (np.ndarray): View of the optimal Q-values, see QTable.array, after solve().
+        V (np.ndarray): Optimal state values, shape (T, n_wealth), after solve().
+    """
 
-                # Update the current state
-                w_current = w_next
-                t += 1  # Increment the time step
+    def __init__(self, env, gamma=1.0, q_layout="dense", q_dtype=np.float64):
+        """
+        Initialize the solver.
 
-            # Record the error and final wealth
-            diff_val = self.agent.compute_q_diff(Q_before)  # Calculate the Q-table difference
-            self.errors.append(diff_val)  # Append the error to the list
-            self.final_wealths.append(w_current)  # Append the final wealth to the list
+        Args:
+            env (Environment): The environment to solve.
+            gamma (float): Discount factor.
+            q_layout (str): Layout of the result, as for Agent.
+            q_dtype (np.dtype): Floating point type of the result, as for Agent.
+        """
+        self.env = env  # Set the environment
+        self.gamma = gamma  # Set the discount factor
+        self.q_layout = q_layout  # Set the layout of the result
+        self.q_dtype = q_dtype  # Set the floating point type of the result
+        self.q_table = None  # Optimal Q-values, filled by solve()
+        self.Q = None
+        self.V = None  # Optimal state values, filled by solve()
+
+    def solve(self):
+        """
+        Run backward induction over all stages.
+
+        Returns:
+            np.ndarray: Optimal Q-values with the layout of Agent.Q.
+        """
+        env = self.env
+        n_wealth = len(env.all_wealth_levels)
+        # Wealth and action index of every packed (w_idx, a_idx) pair
+        pair_w_idx = np.repeat(np.arange(n_wealth), env.action_counts)
+        pair_a_idx = np.arange(env.n_pairs) - env.action_offsets[pair_w_idx]
+
+        self.q_table = QTable(env.T, env.action_counts, layout=self.q_layout, dtype=self.q_dtype)
+        self.V = np.zeros((env.T, n_wealth))
+        v_next = np.zeros(n_wealth)  # Value after the last stage
+        for t in reversed(range(env.T)):  # Iterate backwards over all time steps
+            # Expected reward plus discounted value of the next state over all outcomes
+            q_t = 0.0
+            for prob, next_idx in env.transition_outcomes():
+                q_t = q_t + prob * (env.get_reward_index(t, next_idx) + self.gamma * v_next[next_idx])
+
+            self.q_table.set_stage(t, q_t, pair_w_idx, pair_a_idx)
+            self.V[t] = np.maximum.reduceat(q_t, env.action_offsets)  # Best action of every wealth row
+            v_next = self.V[t]
+        self.Q = self.q_table.array
+        return self.Q
+
+
+class PolicyEvaluator:
+    """
+    The PolicyEvaluator class measures the quality of a greedy policy without exploration.
 
-            # Print the log every 1000 episodes
-            if (episode + 1) % 1000 == 0:
-                # Calculate average Q-diff over last 100 episodes
-                recent_qdiffs = self.errors[-100:] if len(self.errors)>=100 else self.errors
-                avg_qdiff_last100 = np.mean(recent_qdiffs)
+    evaluate() simulates n_paths independent T-step paths of the Environment dynamics in
+    chunks of NumPy arrays and only keeps the histogram of the final wealth index, from
+    which all statistics follow exactly. exact_distribution() propagates the final-wealth
+    distribution of a policy through the transition tables without sampling, and the
+    BackwardInductionSolver gives the optimum for comparison.
 
-                # Calculate average final wealth over last 100 episodes
-                recent_wealth = self.final_wealths[-100:] if len(self.final_wealths)>=100 else self.final_wealths
-                avg_wealth_last100 = np.mean(recent_wealth)
+    Attributes:
+        env (Environment): The environment.
+        n_paths (int): Number of simulated paths.
+        chunk_size (int): Number of paths simulated at once.
+        confidence (float): Level of the confidence intervals.
+        rng (RandomStream): Random stream of the simulation.
+    """
 
-                print(f"Episode {episode+1}/{self.num_episodes} | eps={epsilon:.4f} "
-                      f"| Avg Q-diff Last 100={avg_qdiff_last100:.4f} "
-                      f"| Avg Wealth Last 100={avg_wealth_last100:.2f}")
+    # Quantiles of the final wealth that are reported
+    QUANTILES = (0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99)
 
-    def plot_results(self):
+    def __init__(self, env, n_paths=1_000_000, chunk_size=1 << 18, confidence=0.95, rng=None):
         """
-        Plot the training results, including training error and final wealth.
+        Initialize the evaluator.
+
+        Args:
+            env (Environment): The environment.
+            n_paths (int): Number of simulated paths.
+            chunk_size (int): Number of paths simulated at once, bounding the memory.
+            confidence (float): Level of the confidence intervals.
+            rng (RandomStream or int): Random stream, or seed of a new one; unseeded if None.
+        """
+        self.env = env  # Set the environment
+        self.n_paths = n_paths  # Set the number of paths
+        self.chunk_size = chunk_size  # Set the chunk size
+        self.confidence = confidence  # Set the confidence level
+        self.rng = as_random_stream(rng)  # Set the random stream
+        self._optimal_V = None  # Optimal state values, computed on demand
+
+    @staticmethod
+    def _as_policy(policy, initial_wealth):
         """
-        plt.figure(figsize=(12, 5))  # Create a new figure with a specified size
+        Turn an Agent into its GreedyPolicy and resolve the initial wealth.
 
-        # Plot the training error
-        plt.subplot(1, 2, 1)  # Create a subplot for the training error
-        plt.plot(self.errors, label="Training error (delta Q)")  # Plot the training errors
-        window_err = 100  # Set the window size for moving average
-        if len(self.errors) > window_err:  # If there are enough errors to calculate the moving average
-            # Calculate the moving average of the errors
-            smoothed_err = [np.mean(self.errors[max(0, i - window_err + 1):i + 1]) for i in range(len(self.errors))]
-            plt.plot(smoothed_err, label=f"Err Moving Avg(window={window_err})", color="red", alpha=0.7)
-        plt.xlabel("Episode")
-        plt.ylabel("Sum of |delta Q|")
-        plt.title("Training Error")
-        plt.legend()
+        Args:
+            policy (Agent or GreedyPolicy): Policy to evaluate.
+            initial_wealth (int): Initial wealth; Agent.INITIAL_WEALTH if None.
 
-        # Plot the final wealth
-        plt.subplot(1, 2, 2)
-        plt.plot(self.final_wealths, label="Final wealth per episode", alpha=0.6)
-        window_w = 500
-        if len(self.final_wealths) > window_w:
-            smoothed = [np.mean(self.final_wealths[max(0, i - window_w + 1):i + 1]) for i in range(len(self.final_wealths))]
-            plt.plot(smoothed, label=f"Wealth MA(window={window_w})", color="red", alpha=0.7)
+        Returns:
+            tuple: (GreedyPolicy, initial wealth).
+        """
+        if isinstance(policy, Agent):
+            initial_wealth = policy.INITIAL_WEALTH if initial_wealth is None else initial_wealth
+            policy = policy.export_policy()
+        if initial_wealth is None:
+            raise ValueError("initial_wealth is required to evaluate a GreedyPolicy")
+        return policy, initial_wealth
+
+    def simulate(self, policy, initial_wealth=None):
+        """
+        Simulate n_paths paths of the policy.
+
+        Args:
+            policy (Agent or GreedyPolicy): Policy to evaluate.
+            initial_wealth (int): Initial wealth; Agent.INITIAL_WEALTH if None.
+
+        Returns:
+            np.ndarray: Number of paths ending at every wealth index.
+        """
+        policy, initial_wealth = self._as_policy(policy, initial_wealth)
+        env = self.env
+        w0_idx = env.wealth_to_index[initial_wealth]
+        counts = np.zeros(len(env.all_wealth_levels), dtype=np.int64)
+
+        for start in range(0, self.n_paths, self.chunk_size):  # Iterate over the chunks of paths
+            n = min(self.chunk_size, self.n_paths - start)
+            w_idx = np.full(n, w0_idx, dtype=np.intp)
+            for t in range(env.T):  # Advance all paths of the chunk in lockstep
+                w_idx = env.sample_next_index(w_idx, policy.actions[t, w_idx], self.rng.random_array(n))
+            counts += np.bincount(w_idx, minlength=len(counts))
+        return counts
+
+    def exact_distribution(self, policy, initial_wealth=None):
+        """
+        Compute the exact final-wealth distribution of the policy.
 
-        plt.xlabel("Episode")
-        plt.ylabel("Final Wealth")
-        plt.title("Final Wealth over Episodes")
-        plt.legend()
+        Args:
+            policy (Agent or GreedyPolicy): Policy to evaluate.
+            initial_wealth (int): Initial wealth; Agent.INITIAL_WEALTH if None.
+
+        Returns:
+            np.ndarray: Probability of ending at every wealth index.
+        """
+        policy, initial_wealth = self._as_policy(policy, initial_wealth)
+        env = self.env
+        n_wealth = len(env.all_wealth_levels)
+        all_w_idx = np.arange(n_wealth)
+        dist = np.zeros(n_wealth)
+        dist[env.wealth_to_index[initial_wealth]] = 1.0
+        for t in range(env.T):  # Push the probability mass through every stage
+            pair = env.pair_index(all_w_idx, policy.actions[t])
+            next_dist = np.zeros(n_wealth)
+            for prob, next_idx in env.transition_outcomes():
+                pair_prob = prob[pair] if np.ndim(prob) else prob  # Per-pair or scalar probability
+                next_dist += np.bincount(next_idx[pair], weights=pair_prob * dist, minlength=n_wealth)
+            dist = next_dist
+        return dist
+
+    def optimum(self, initial_wealth):
+        """
+        Get the optimal expected utility and certainty equivalent from the exact solver.
+
+        Args:
+            initial_wealth (int): Initial wealth.
+
+        Returns:
+            dict: "expected_utility" and "certainty_equivalent" of the optimal policy.
+        """
+        if self._optimal_V is None:  # Solve once per evaluator
+            solver = BackwardInductionSolver(self.env, q_layout="packed")
+            solver.solve()
+            self._optimal_V = solver.V
+        expected_utility = float(self._optimal_V[0, self.env.wealth_to_index[initial_wealth]])
+        return {"expected_utility": expected_utility,
+                "certainty_equivalent": float(self.env.certainty_equivalent(expected_utility))}
+
+    def evaluate(self, policy, initial_wealth=None, compare_optimum=True):
+        """
+        Simulate the policy and summarize the final wealth and utility.
 
-        plt.tight_layout()
-        plt.show()
+        Args:
+            policy (Agent or GreedyPolicy): Policy to evaluate.
+            initial_wealth (int): Initial wealth; Agent.INITIAL_WEALTH if None.
+            compare_optimum (bool): If True, add the exact optimum and the gap to it (skipped for
+                a lazy Environment, which has no transition tables to solve).
 
+        Returns:
+            dict: Expected utility, certainty equivalent and mean wealth with confidence
+                intervals, wealth quantiles, the final-wealth distribution over the grid
+                and, if requested, the optimum.
+        """
+        policy, initial_wealth = self._as_policy(policy, initial_wealth)
+        env = self.env
+        counts = self.simulate(policy, initial_wealth)
+        n = counts.sum()
+        prob = counts / n
+        wealth = env.wealth_values.astype(float)
+        z = statistics.NormalDist().inv_cdf(0.5 + self.confidence / 2)  # Two-sided normal quantile
+
+        def mean_ci(values):  # Mean and normal confidence interval from the sample variance
+            mean = float(prob @ values)
+            half_width = float(z * np.sqrt(prob @ (values - mean) ** 2 / max(n - 1, 1)))
+            return mean, (mean - half_width, mean + half_width)
+
+        expected_utility, utility_ci = mean_ci(env.utility_table)
+        mean_wealth, wealth_ci = mean_ci(wealth)
+        cum_prob = np.cumsum(prob)
+        result = {
+            "n_paths": int(n),
+            "expected_utility": expected_utility,
+            "expected_utility_ci": utility_ci,
+            # The certainty equivalent is monotone in the utility, so its interval maps directly
+            "certainty_equivalent": float(env.certainty_equivalent(expected_utility)),
+            "certainty_equivalent_ci": tuple(float(env.certainty_equivalent(u)) for u in utility_ci),
+            "mean_wealth": mean_wealth,
+            "mean_wealth_ci": wealth_ci,
+            "wealth_std": float(np.sqrt(prob @ (wealth - mean_wealth) ** 2)),
+            "wealth_quantiles": {q: float(wealth[np.searchsorted(cum_prob, q)]) for q in self.QUANTILES},
+            "wealth_distribution": prob,
+        }
+        if compare_optimum and not env.lazy:
+            optimum = self.optimum(initial_wealth)
+            result["optimal_expected_utility"] = optimum["expected_utility"]
+            result["optimal_certainty_equivalent"] = optimum["certainty_equivalent"]
+            result["certainty_equivalent_gap"] = optimum["certainty_equivalent"] - result["certainty_equivalent"]
+        return result
 
 # =========== Code below remains the same, but we add new code for multiple scenarios ===========
 if __name__ == "__main__":
@@ -439,8 +3851,7 @@ if __name__ == "__main__":
         # Train for the current scenario
         trainer.train()
 
-        # Print final results label
-        print(f"Plotting results for {scenario['name']}...")
-
-        # Plot results for this scenario (shows a new figure each loop)
-        trainer.plot_results()
\ No newline at end of file
+        # Save the plots of this scenario to a file instead of blocking on a window
+        plot_path = f"{scenario['name'].lower().replace(' ', '_')}.png"
+        print(f"Plotting results for {scenario['name']} to {plot_path}...")
+        trainer.plot_results(plot_path)
\ No newline at end of file
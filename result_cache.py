@@ -0,0 +1,394 @@
+"""
+This module caches trained results on disk, keyed by their configuration.
+
+A run is described by a configuration with the sections "env", "agent" and "trainer"
+(the format of one sweep point, see sweep.py) and a seed. The cache key is a stable
+hash of all parameters except trainer.num_episodes, the seed and the version of the
+code (the Q-learning module and this one). For every key the cache holds one entry per
+trained episode count, each a Trainer checkpoint (Q, metrics and random state) plus the
+exported greedy policy. Identical runs are loaded instead of trained, and a run with
+more episodes resumes from the longest cached prefix that ends on a batch boundary.
+Entries are evicted least recently used first when the cache grows beyond max_bytes.
+Several processes may share a cache, e.g. the workers of a sweep.
+
+Example:
+    cache = ResultCache("q_cache", max_bytes=2 << 30)
+    trainer, source = cache.run(config, seed=0)  # source is "hit", "resumed" or "trained"
+"""
+
+import contextlib  # Import contextlib for the cache lock
+import hashlib  # Import hashlib for the cache keys
+import json  # Import json for the key payloads and entry metadata
+import os  # Import os for file paths
+import shutil  # Import shutil to evict entries
+import tempfile  # Import tempfile to write the entry metadata atomically
+import time  # Import time for the last use of entries
+
+import numpy as np  # Import numpy for numerical operations
+
+try:  # fcntl is POSIX only; without it the cache is not locked
+    import fcntl  # Import fcntl to lock the cache between processes
+except ImportError:
+    fcntl = None
+
+import msbd6000m_assignment1  # Import the module itself to hash its source as the code version
+from msbd6000m_assignment1 import (
+    Environment, Agent, Trainer, BatchTrainer, ParallelTrainer, RandomStream, ProgressLogger, QDiffThreshold,
+    PolicyPlateau, GreedyEvaluation, GreedyPolicy
+)
+
+# Trainer classes selectable by name in the "trainer" section
+TRAINERS = {"Trainer": Trainer, "BatchTrainer": BatchTrainer, "ParallelTrainer": ParallelTrainer}
+
+# Stopping rules selectable by name in the "stopping" entry of the "trainer" section
+STOPPING_RULES = {"QDiffThreshold": QDiffThreshold, "PolicyPlateau": PolicyPlateau, "GreedyEvaluation": GreedyEvaluation}
+
+
+def build_trainer(config, seed):
+    """
+    Create the environment, agent and trainer of a run configuration.
+
+    Args:
+        config (dict): Run configuration with the sections "env", "agent" and "trainer".
+            The trainer section may name the trainer class ("type", default "BatchTrainer")
+            and stopping rules ("stopping"); env.name is ignored.
+        seed (int or np.random.SeedSequence): Seed of the stream shared by all three.
+
+    Returns:
+        Trainer: The untrained trainer; its agent is trainer.agent.
+    """
+    trainer_params = dict(config["trainer"])
+    trainer_cls = TRAINERS[trainer_params.pop("type", "BatchTrainer")]
+    stopping = trainer_params.pop("stopping", {})
+    if stopping:  # Stopping rules in addition to the progress log
+        trainer_params["callbacks"] = [ProgressLogger()] + [STOPPING_RULES[name](**kwargs)
+                                                            for name, kwargs in stopping.items()]
+    env_params = {k: v for k, v in config["env"].items() if k != "name"}
+
+    # One seeded stream shared by Environment, Agent and Trainer
+    env = Environment(**env_params, rng=RandomStream(seed))
+    agent = Agent(env, **config["agent"])
+    return trainer_cls(agent, **trainer_params)
+
+
+def code_version():
+    """
+    Hash the source of the Q-learning module and of this module, which builds the runs,
+    so cached results of older code are not reused.
+
+    Returns:
+        str: Hex digest.
+    """
+    digest = hashlib.sha256()
+    for module_file in (msbd6000m_assignment1.__file__, __file__):
+        with open(module_file, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def config_key(config, seed, version):
+    """
+    Compute the cache key of a run.
+
+    Args:
+        config (dict): Run configuration, see build_trainer.
+        seed (int or np.random.SeedSequence): Seed of the run.
+        version (str): Code version, see code_version.
+
+    Returns:
+        str: Hex digest over all parameters except trainer.num_episodes and env.name.
+    """
+    if isinstance(seed, np.random.SeedSequence):
+        seed = [seed.entropy, list(seed.spawn_key)]
+    payload = {
+        "env": {k: v for k, v in config["env"].items() if k != "name"},
+        "agent": config["agent"],
+        "trainer": {k: v for k, v in config["trainer"].items() if k != "num_episodes"},
+        "seed": seed,
+        "code": version,
+    }
+    # Sorted keys make the text independent of the dict order; NumPy scalars become Python numbers
+    text = json.dumps(payload, sort_keys=True, separators=(",", ":"),
+                      default=lambda o: o.item() if isinstance(o, np.generic) else str(o))
+    return hashlib.sha256(text.encode()).hexdigest()[:32]
+
+
+def resume_step(trainer_config):
+    """
+    Get the episode counts at which a run can be cut and continued without changing it.
+
+    A Trainer can be cut after any episode and a BatchTrainer after every full batch.
+    ParallelTrainer runs depend on their rounds and worker scheduling, so they are only
+    reused for identical requests.
+
+    Args:
+        trainer_config (dict): The "trainer" section of a run configuration.
+
+    Returns:
+        int: Episode step of the boundaries, or None if only exact hits are reused.
+    """
+    trainer_type = trainer_config.get("type", "BatchTrainer")
+    if trainer_type == "Trainer":
+        return 1
+    if trainer_type == "BatchTrainer":
+        return trainer_config.get("batch_size", 1024)
+    return None
+
+
+class ResultCache:
+    """
+    The ResultCache class stores trained runs on disk with least-recently-used eviction.
+
+    Layout: <root>/<key>/<num_episodes>/ holds the checkpoint written by
+    Trainer.save_checkpoint, the greedy policy (policy.npz) and meta.json, which is
+    written last and whose modification time is the last use of the entry.
+
+    The cache can be shared by several processes. meta.json is replaced atomically, so
+    an entry is either complete or invisible, and the file <root>/.lock serializes
+    writes and evictions (exclusive lock) against loads (shared lock).
+
+    Resuming continues the cached trainer state, and prefixes are only resumed at the
+    boundaries of resume_step, so a resumed run equals a fresh one. The state of stopping
+    rules is not cached; they start over when a run is resumed.
+
+    Attributes:
+        root (str): Cache directory.
+        max_bytes (int): Size limit of all entries.
+        version (str): Code version included in every key.
+    """
+
+    def __init__(self, root, max_bytes=1 << 30, version=None):
+        """
+        Initialize the cache.
+
+        Args:
+            root (str): Cache directory, created if missing.
+            max_bytes (int): Size limit of all entries.
+            version (str): Code version; code_version() if None.
+        """
+        self.root = root  # Set the cache directory
+        self.max_bytes = max_bytes  # Set the size limit
+        self.version = code_version() if version is None else version  # Set the code version
+        os.makedirs(root, exist_ok=True)
+
+    @contextlib.contextmanager
+    def _lock(self, exclusive):
+        """
+        Hold the cache lock, shared by all processes using the cache directory.
+
+        Args:
+            exclusive (bool): Exclusive lock to change entries, else a shared lock to read them.
+        """
+        with open(os.path.join(self.root, ".lock"), "a") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield  # The lock is released when the file is closed
+
+    def _entries(self, key):
+        """
+        List the complete entries of a key.
+
+        Args:
+            key (str): Cache key.
+
+        Returns:
+            dict: Entry metadata keyed by the trained episode count.
+        """
+        entries = {}
+        key_dir = os.path.join(self.root, key)
+        try:
+            names = os.listdir(key_dir)
+        except (FileNotFoundError, NotADirectoryError):  # Unknown or evicted key
+            return entries
+        for name in names:
+            if not name.isdigit():  # Checkpoint temporaries
+                continue
+            try:
+                with open(os.path.join(key_dir, name, "meta.json")) as f:
+                    entries[int(name)] = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):  # Incomplete or evicted entry
+                continue
+        return entries
+
+    def _find(self, key, trainer_config):
+        """
+        Find the cached entry that answers a run, or the longest prefix to resume from.
+
+        A run that stopped early after k episodes answers every request of at least k
+        episodes if k is on a boundary of resume_step, since the same run would stop at the
+        same episode again. Prefixes are resumed only from such boundaries as well.
+
+        Args:
+            key (str): Cache key.
+            trainer_config (dict): The "trainer" section of the requested run.
+
+        Returns:
+            tuple: (episode count of the entry or None, "hit", "resumed" or "trained").
+        """
+        num_episodes = trainer_config["num_episodes"]
+        entries = self._entries(key)
+        if num_episodes in entries:
+            return num_episodes, "hit"
+        step = resume_step(trainer_config)
+        if step is None:  # Only identical requests are reused
+            return None, "trained"
+        stopped = [n for n, meta in entries.items() if meta["stop_reason"] is not None
+                   and meta["episodes_run"] <= num_episodes and meta["episodes_run"] % step == 0]
+        if stopped:
+            return min(stopped), "hit"
+        prefixes = [n for n, meta in entries.items()
+                    if n < num_episodes and n % step == 0 and meta["stop_reason"] is None]
+        return (max(prefixes), "resumed") if prefixes else (None, "trained")
+
+    def _path(self, key, num_episodes):
+        return os.path.join(self.root, key, str(num_episodes))
+
+    def _touch(self, path):
+        # Mark the entry as recently used; an explicit time, since file timestamps may be coarse
+        now = time.time_ns()
+        os.utime(os.path.join(path, "meta.json"), ns=(now, now))
+
+    def run(self, config, seed=0):
+        """
+        Return the trained trainer of a run, from the cache where possible.
+
+        Args:
+            config (dict): Run configuration, see build_trainer.
+            seed (int or np.random.SeedSequence): Seed of the run.
+
+        Returns:
+            tuple: (Trainer, source); source is "hit" if the result was loaded, "resumed"
+                if it was trained on from a cached prefix and "trained" otherwise.
+        """
+        key = config_key(config, seed, self.version)
+        trainer = build_trainer(config, seed)
+        with self._lock(exclusive=False):  # The entry cannot be evicted while it is loaded
+            cached, source = self._find(key, config["trainer"])
+            if source != "trained":
+                path = self._path(key, cached)
+                trainer.load_checkpoint(path)
+                self._touch(path)
+            if source == "hit":  # Use the result without training
+                with open(os.path.join(path, "meta.json")) as f:
+                    meta = json.load(f)
+                trainer.stop_reason, trainer.stopped_episode = meta["stop_reason"], meta["stopped_episode"]
+                return trainer, source
+
+        trainer.train()  # Train from scratch or on from the loaded prefix
+        self._store(key, config, seed, trainer)
+        return trainer, source
+
+    def policy(self, config, seed=0):
+        """
+        Load the cached greedy policy of a run without building the trainer.
+
+        Args:
+            config (dict): Run configuration, see build_trainer.
+            seed (int or np.random.SeedSequence): Seed of the run.
+
+        Returns:
+            GreedyPolicy: The policy, or None if the run is not cached.
+        """
+        key = config_key(config, seed, self.version)
+        with self._lock(exclusive=False):
+            cached, source = self._find(key, config["trainer"])
+            if source != "hit":
+                return None
+            path = self._path(key, cached)
+            self._touch(path)
+            return GreedyPolicy.load(os.path.join(path, "policy.npz"))
+
+    def _store(self, key, config, seed, trainer):
+        """
+        Write a trained run into the cache and evict old entries.
+
+        Args:
+            key (str): Cache key.
+            config (dict): Run configuration.
+            seed (int or np.random.SeedSequence): Seed of the run.
+            trainer (Trainer): The trained trainer.
+        """
+        key_dir = os.path.join(self.root, key)
+        path = self._path(key, config["trainer"]["num_episodes"])
+        meta = {"episodes_run": trainer.episode, "stop_reason": trainer.stop_reason,
+                "stopped_episode": trainer.stopped_episode}
+        with self._lock(exclusive=True):
+            os.makedirs(key_dir, exist_ok=True)
+            with open(os.path.join(key_dir, "config.json"), "w") as f:  # For inspection only
+                json.dump({"config": config, "seed": str(seed), "code": self.version}, f, indent=2, default=str)
+
+            trainer.save_checkpoint(path)
+            trainer.agent.export_policy(os.path.join(path, "policy.npz"))
+            # Written last and moved into place: the entry is complete once meta.json exists
+            with tempfile.NamedTemporaryFile("w", dir=path, suffix=".tmp", delete=False) as f:
+                json.dump(meta, f)
+            os.replace(f.name, os.path.join(path, "meta.json"))
+            self._touch(path)
+            self._evict(keep=path)
+
+    def entries(self):
+        """
+        List all complete entries.
+
+        Returns:
+            list: Tuples (path, size in bytes, last use time), least recently used first.
+        """
+        result = []
+        for key in os.listdir(self.root):
+            for num_episodes in self._entries(key):
+                path = self._path(key, num_episodes)
+                try:
+                    size = sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+                    result.append((path, size, os.path.getmtime(os.path.join(path, "meta.json"))))
+                except FileNotFoundError:  # Evicted by another process meanwhile
+                    continue
+        return sorted(result, key=lambda entry: entry[2])
+
+    @property
+    def nbytes(self):
+        """
+        int: Size of all complete entries.
+        """
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used entries until the cache fits into max_bytes.
+
+        Args:
+            keep (str): Path of an entry that is never evicted, e.g. the one just written.
+        """
+        with self._lock(exclusive=True):
+            self._evict(keep)
+
+    def _evict(self, keep=None):
+        """
+        Evict entries like evict, with the exclusive lock already held.
+
+        Args:
+            keep (str): Path of an entry that is never evicted.
+        """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            key_dir = os.path.dirname(path)
+            try:
+                if not any(name.isdigit() for name in os.listdir(key_dir)):  # Last entry of the key
+                    shutil.rmtree(key_dir, ignore_errors=True)
+            except FileNotFoundError:  # Already removed
+                continue
+
+    def clear(self):
+        """
+        Remove all entries.
+        """
+        with self._lock(exclusive=True):
+            for key in os.listdir(self.root):
+                if key != ".lock":
+                    shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
@@ -0,0 +1,203 @@
+"""
+This module runs scenario and hyperparameter sweeps of the Q-learning code in parallel.
+
+A sweep grid has one section per class ("env", "agent", "trainer"). Every list value in
+a section is a sweep axis, and a section may also be given as a list of dicts (e.g. a
+list of market scenarios) to sweep over whole parameter sets. The trainer section may
+hold a "stopping" dict mapping StoppingRule class names to their arguments, e.g.
+{"QDiffThreshold": {"threshold": 0.05}}, to end runs early. After training, the greedy
+policy of every run is evaluated by Monte Carlo simulation and compared with the exact
+optimum; an optional top-level "evaluation" dict passes PolicyEvaluator arguments, and
+null disables it. All combinations are run in a process pool, each with its own random
+stream spawned from one root seed. Final Q-tables are written by the workers into
+memory-mapped .npy files and one results table is written to disk. With a cache
+directory, runs are taken from or added to a ResultCache (see result_cache.py), so
+repeating a sweep with the same root seed, or with more episodes, does not train from
+scratch.
+
+Example:
+    python sweep.py grid.json --out sweep_out --workers 8 --seed 0 --cache q_cache
+"""
+
+import argparse  # Import argparse for the command line interface
+import contextlib  # Import contextlib to redirect the training log
+import csv  # Import csv to write the results table
+import itertools  # Import itertools to expand the grid
+import json  # Import json to read the grid file
+import os  # Import os for file paths
+import time  # Import time to measure run times
+from concurrent.futures import ProcessPoolExecutor  # Import the process pool
+
+import numpy as np  # Import numpy for numerical operations
+
+from msbd6000m_assignment1 import RandomStream, PolicyEvaluator
+# The trainer classes and stopping rules selectable by name (TRAINERS, STOPPING_RULES) live with the run builder
+from result_cache import TRAINERS, STOPPING_RULES, ResultCache, build_trainer
+
+# Number of final episodes used for the summary metrics
+SUMMARY_WINDOW = 1000
+
+# Default PolicyEvaluator arguments of the post-training evaluation
+EVALUATION = {"n_paths": 100_000}
+
+
+def expand_section(section):
+    """
+    Expand one grid section into the list of its parameter combinations.
+
+    Args:
+        section (dict or list): Dict whose list values are sweep axes, or a list of such dicts.
+
+    Returns:
+        list: List of parameter dicts.
+    """
+    if isinstance(section, list):  # A list of whole parameter sets
+        return [combo for item in section for combo in expand_section(item)]
+    keys = list(section)
+    axes = [v if isinstance(v, list) else [v] for v in section.values()]
+    return [dict(zip(keys, values)) for values in itertools.product(*axes)]
+
+
+def expand_grid(grid):
+    """
+    Expand a sweep grid into the list of individual run configurations.
+
+    Args:
+        grid (dict): Sweep grid with the sections "env", "agent" and "trainer".
+
+    Returns:
+        list: List of dicts with the keys "env", "agent" and "trainer".
+    """
+    sections = ("env", "agent", "trainer")
+    expanded = [expand_section(grid.get(name, {})) for name in sections]
+    return [dict(zip(sections, combo)) for combo in itertools.product(*expanded)]
+
+
+def _run_point(run_id, config, seed, out_dir, evaluation=None, cache=None):
+    """
+    Train one configuration of a sweep (executed in a worker process).
+
+    Args:
+        run_id (int): Index of the run in the sweep.
+        config (dict): Run configuration as returned by expand_grid.
+        seed (np.random.SeedSequence): Seed of the random stream of this run.
+        out_dir (str): Output directory of the sweep.
+        evaluation (dict): PolicyEvaluator arguments, or None to skip the evaluation.
+        cache (dict): ResultCache arguments, or None to always train.
+
+    Returns:
+        dict: Result row of the run.
+    """
+    # Train with the progress log written to a per-run file
+    start = time.perf_counter()
+    with open(os.path.join(out_dir, f"run_{run_id}.log"), "w") as log, contextlib.redirect_stdout(log):
+        if cache is not None:
+            trainer, source = ResultCache(**cache).run(config, seed)
+        else:
+            trainer, source = build_trainer(config, seed), "trained"
+            trainer.train()
+    elapsed = time.perf_counter() - start
+    agent = trainer.agent
+    env = agent.env
+
+    # Write the final Q-table into a memory-mapped file instead of returning it by pickling
+    if agent.Q is None:  # A sparse table saves its allocated rows only
+        q_path = os.path.join(out_dir, f"q_{run_id}.npz")
+        agent.q_table.save(q_path)
+    else:
+        q_path = os.path.join(out_dir, f"q_{run_id}.npy")
+        q_file = np.lib.format.open_memmap(q_path, mode="w+", dtype=agent.Q.dtype, shape=agent.Q.shape)
+        q_file[:] = agent.Q
+        q_file.flush()
+        del q_file
+
+    row = {"run_id": run_id, "seed": ".".join(map(str, seed.spawn_key))}
+    for section in ("env", "agent", "trainer"):
+        row.update({f"{section}.{k}": v for k, v in config[section].items()})
+    row.update({
+        "elapsed_sec": elapsed,
+        "cache": source,
+        "episodes_run": trainer.episode,
+        "stop_reason": trainer.stop_reason or "",
+        "episodes_per_sec": trainer.episode / elapsed,
+        "avg_final_wealth": float(np.mean(trainer.final_wealths[-SUMMARY_WINDOW:])),
+        "avg_q_diff": float(np.mean(trainer.errors[-SUMMARY_WINDOW:])),
+        "q_path": q_path,
+    })
+
+    if evaluation is not None:  # Evaluate the greedy policy on an independent stream
+        evaluator = PolicyEvaluator(env, **evaluation, rng=RandomStream(seed.spawn(1)[0]))
+        result = evaluator.evaluate(agent)
+        row.update({
+            "eval_expected_utility": result["expected_utility"],
+            "eval_certainty_equivalent": result["certainty_equivalent"],
+            "eval_ce_ci_low": result["certainty_equivalent_ci"][0],
+            "eval_ce_ci_high": result["certainty_equivalent_ci"][1],
+        })
+        if "optimal_certainty_equivalent" in result:  # Lazy environments have no exact optimum
+            row["optimal_certainty_equivalent"] = result["optimal_certainty_equivalent"]
+            row["certainty_equivalent_gap"] = result["certainty_equivalent_gap"]
+    return row
+
+
+def run_sweep(grid, out_dir, max_workers=None, seed=0, cache=None):
+    """
+    Run all configurations of a sweep grid in a process pool.
+
+    Args:
+        grid (dict): Sweep grid, see expand_grid, with an optional "evaluation" entry.
+        out_dir (str): Directory for the results table, Q-table files and run logs.
+        max_workers (int): Number of worker processes; os.cpu_count() if None.
+        seed (int): Root seed from which independent per-run streams are spawned.
+        cache (dict): ResultCache arguments, e.g. {"root": "q_cache"}, or None to always train.
+
+    Returns:
+        list: Result rows, ordered by run_id. Each Q-table can be opened without
+            loading it fully via np.load(row["q_path"], mmap_mode="r").
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    configs = expand_grid(grid)
+    evaluation = grid.get("evaluation", EVALUATION)
+    # Spawn one independent random stream seed per run from the root seed
+    seeds = np.random.SeedSequence(seed).spawn(len(configs))
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(_run_point, i, config, seeds[i], out_dir, evaluation, cache) for i, config in enumerate(configs)]
+        rows = [future.result() for future in futures]
+
+    # Write all results into one table
+    fieldnames = list(dict.fromkeys(k for row in rows for k in row))
+    with open(os.path.join(out_dir, "results.csv"), "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+    return rows
+
+
+def main(argv=None):
+    """
+    Command line entry point of the sweep runner.
+
+    Args:
+        argv (list): Command line arguments; sys.argv[1:] if None.
+    """
+    parser = argparse.ArgumentParser(description="Run a parallel Q-learning sweep.")
+    parser.add_argument("grid", help="JSON file with the sweep grid")
+    parser.add_argument("--out", default="sweep_out", help="output directory")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--seed", type=int, default=0, help="root seed of the sweep")
+    parser.add_argument("--cache", help="directory of a result cache shared between sweeps")
+    parser.add_argument("--cache-max-bytes", type=int, default=1 << 30, help="size limit of the result cache")
+    args = parser.parse_args(argv)
+
+    with open(args.grid) as f:
+        grid = json.load(f)
+    start = time.perf_counter()
+    cache = {"root": args.cache, "max_bytes": args.cache_max_bytes} if args.cache else None
+    rows = run_sweep(grid, args.out, max_workers=args.workers, seed=args.seed, cache=cache)
+    print(f"Finished {len(rows)} runs in {time.perf_counter() - start:.1f}s, "
+          f"results in {os.path.join(args.out, 'results.csv')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,53 @@
+import os
+import subprocess
+import sys
+import tempfile
 import unittest
 import numpy as np
-from msbd6000m_assignment1 import Environment, Agent, Trainer  
+from msbd6000m_assignment1 import (
+    Environment, Agent, Trainer, BatchTrainer, BackwardInductionSolver, MetricsRecorder, moving_average,
+    load_checkpoint_q, RandomStream, TrainerCallback, profile_training, QDiffThreshold, PolicyPlateau,
+    GreedyEvaluation, GreedyPolicy, PolicyEvaluator, NonUniformEnvironment, ReplayBuffer, ExperienceReplay,
+    ParallelTrainer, MultiAssetEnvironment, simplex_rank, simplex_unrank, simplex_count
+)
 
 
+class TestRandomStream(unittest.TestCase):
+
+    def test_block_draws_match_generator(self):
+        """ Ensure block-drawn variates are the generator's uniform stream. """
+        stream = RandomStream(7, block_size=16)
+        draws = [stream.random() for _ in range(40)]
+        expected = np.random.Generator(np.random.PCG64(np.random.SeedSequence(7))).random(48)
+        np.testing.assert_array_equal(draws, expected[:40])
+        self.assertEqual(len(set(draws)), 40)
+
+    def test_state_round_trip(self):
+        """ Ensure a restored state continues the same sequence, also across blocks. """
+        stream = RandomStream(7, block_size=16)
+        for _ in range(10):
+            stream.random()
+        stream.random_array(5)  # Array draws advance the generator past the block
+        state = stream.get_state()
+        self.assertEqual(state["position"], 10)
+        expected = [stream.random() for _ in range(30)]
+
+        restored = RandomStream(0, block_size=32)  # The block is drawn again with its own size
+        restored.set_state(state)
+        self.assertEqual([restored.random() for _ in range(30)], expected)
+        np.testing.assert_array_equal(restored.random_array(5), stream.random_array(5))
+
+        fresh = RandomStream(7, block_size=16)
+        fresh.set_state(RandomStream(7, block_size=16).get_state())  # No block drawn yet
+        self.assertEqual(fresh.random(), RandomStream(7, block_size=16).random())
+
+    def test_spawn_independent_streams(self):
+        """ Ensure spawned streams are reproducible and differ from each other. """
+        first, second = RandomStream(1).spawn(2)
+        again, _ = RandomStream(1).spawn(2)
+        self.assertEqual(first.random(), again.random())
+        self.assertNotEqual(first.random(), second.random())
+
 class TestEnvironment(unittest.TestCase):
 
     def setUp(self):
@@ -17,6 +62,45 @@ class TestEnvironment(unittest.TestCase):
         w_next = self.env.get_next_state(1000, 500)
         self.assertTrue(850 <= w_next <= 1100)  # Wealth should be within limits
 
+    def test_reachable_states(self):
+        """ Ensure the reachable states are exactly those reached by some sequence of actions. """
+        reachable = self.env.reachable_states(1000)
+        levels = {1000}
+        for t in range(self.env.T):
+            np.testing.assert_array_equal(np.flatnonzero(reachable[t]),
+                                          sorted(self.env.wealth_to_index[w] for w in levels))
+            levels = {self.env.all_wealth_levels[int(self.env.next_wealth_index(self.env.wealth_to_index[w], a, ret))]
+                      for w in levels for a in range(self.env.action_counts[self.env.wealth_to_index[w]])
+                      for ret in (self.env.a_ret, self.env.b_ret)}
+        self.assertLess(reachable[1].sum(), reachable.shape[1])
+
+        lazy = Environment(T=10, p=0.8, a_ret=0.2, b_ret=-0.3, riskless_ret=0.02, alpha=0.001,
+                           W_MAX=6000, W_STEP=50, ACTION_STEP=50, lazy=True)
+        np.testing.assert_array_equal(lazy.reachable_states(1000), reachable)
+
+    def test_get_next_state_rejects_invalid_actions(self):
+        """ Ensure actions outside the action set of the wealth level raise. """
+        with self.assertRaises(KeyError):
+            self.env.get_next_state(100, 300)  # More than the wealth
+        with self.assertRaises(KeyError):
+            self.env.get_next_state(1000, 525)  # Not a multiple of ACTION_STEP
+        with self.assertRaises(KeyError):
+            self.env.get_next_state(1025, 0)  # Not a wealth level
+
+    def test_transition_tables(self):
+        """ Ensure the precomputed next-wealth indices match the wealth dynamics. """
+        for w in (0, 1000, 6000):
+            w_idx = self.env.wealth_to_index[w]
+            for a_idx, x in enumerate(self.env.action_candidates[w]):
+                for ret, table in ((self.env.a_ret, self.env.next_index_up), (self.env.b_ret, self.env.next_index_down)):
+                    w_float = x * (1.0 + ret) + (w - x) * (1.0 + self.env.riskless_ret)
+                    w_next = max(0, min(int(round(w_float / self.env.W_STEP)) * self.env.W_STEP, self.env.W_MAX))
+                    self.assertEqual(self.env.all_wealth_levels[table[self.env.pair_index(w_idx, a_idx)]], w_next)
+
+        w_next_idx = self.env.step_index(20, 10)
+        pair = self.env.pair_index(20, 10)
+        self.assertIn(w_next_idx, (self.env.next_index_up[pair], self.env.next_index_down[pair]))
+
     def test_utility(self):
         """ Test if utility function computes correctly. """
         utility1 = self.env.utility(1000)
@@ -31,6 +115,155 @@ class TestEnvironment(unittest.TestCase):
         reward = self.env.get_reward(self.env.T - 2, 1000)
         self.assertEqual(reward, 0.0)
 
+class TestNonUniformEnvironment(unittest.TestCase):
+
+    def make_env(self, interpolation="linear", seed=None):
+        """ Create a small environment on a log grid. """
+        grid = NonUniformEnvironment.log_grid(2000, 20, W_MIN=10, include=(100,))
+        return NonUniformEnvironment(
+            T=3, p=0.7, a_ret=0.4, b_ret=-0.2, riskless_ret=0.01, alpha=0.001,
+            wealth_grid=grid, action_fractions=np.linspace(0, 1, 6), interpolation=interpolation, rng=seed
+        )
+
+    def test_linear_interpolation_preserves_expected_wealth(self):
+        """ Ensure the outcome probabilities sum to one and keep the expected next wealth. """
+        env = self.make_env()
+        pair_w = np.repeat(np.arange(len(env.wealth_grid)), env.action_counts)
+        pair_a = np.arange(env.n_pairs) - env.action_offsets[pair_w]
+        total_prob = sum(prob for prob, _ in env.transition_outcomes())
+        mean_wealth = sum(prob * env.wealth_grid[next_idx] for prob, next_idx in env.transition_outcomes())
+        expected = (env.p * np.minimum(env.next_wealth_value(pair_w, pair_a, env.a_ret), env.W_MAX)
+                    + (1 - env.p) * np.minimum(env.next_wealth_value(pair_w, pair_a, env.b_ret), env.W_MAX))
+        np.testing.assert_allclose(total_prob, 1.0)
+        np.testing.assert_allclose(mean_wealth, expected)
+
+    def test_action_index_rejects_non_candidates(self):
+        """ Ensure only the candidate amounts of a wealth level map to action indices. """
+        env = self.make_env()
+        w_idx = env.wealth_to_index[100.0]
+        for a_idx, x in enumerate(env.action_candidates[100.0]):
+            self.assertEqual(env.action_index(w_idx, x), a_idx)
+        for x in (30.0, 150.0, -20.0):  # Between two fractions, more than the wealth, negative
+            with self.assertRaises(KeyError):
+                env.action_index(w_idx, x)
+        with self.assertRaises(KeyError):
+            env.get_next_state(100.0, 30.0)
+
+    def test_sampling_matches_outcome_probabilities(self):
+        """ Ensure vectorized and scalar sampling follow transition_outcomes. """
+        env = self.make_env(seed=0)
+        w_idx, a_idx = env.wealth_to_index[100.0], 3
+        pair = env.pair_index(w_idx, a_idx)
+        expected = np.zeros(len(env.wealth_grid))
+        for prob, next_idx in env.transition_outcomes():
+            expected[next_idx[pair]] += prob[pair]
+
+        n = 100_000
+        sampled = env.sample_next_index(np.full(n, w_idx), np.full(n, a_idx), env.rng.random_array(n))
+        np.testing.assert_allclose(np.bincount(sampled, minlength=len(expected)) / n, expected, atol=0.01)
+        stepped = [env.step_index(w_idx, a_idx) for _ in range(20_000)]
+        np.testing.assert_allclose(np.bincount(stepped, minlength=len(expected)) / 20_000, expected, atol=0.02)
+
+    def test_solver_trainer_and_policy(self):
+        """ Ensure the solver, trainer, evaluator and policy export work on the non-uniform grid. """
+        for interpolation in ("nearest", "linear"):
+            env = self.make_env(interpolation, seed=1)
+            agent = Agent(env, alpha=0.1, gamma=1.0, epsilon_start=0.5, epsilon_end=0.01, decay_rate=0.005,
+                          INITIAL_WEALTH=100, q_layout="packed")
+            Trainer(agent, num_episodes=50, callbacks=[]).train()
+            agent.warm_start(BackwardInductionSolver(env, q_layout="packed").solve())
+
+            evaluator = PolicyEvaluator(env, n_paths=1000, rng=0)
+            dist = evaluator.exact_distribution(agent)
+            self.assertAlmostEqual(dist @ env.utility_table, evaluator.optimum(100)["expected_utility"], places=10)
+
+            policy = agent.export_policy()
+            w = env.wealth_grid[7]
+            self.assertAlmostEqual(policy(1, w * 1.01)[()], agent.choose_action(1, w, eps=0.0))
+            with tempfile.TemporaryDirectory() as out_dir:
+                path = os.path.join(out_dir, "policy.npz")
+                policy.save(path)
+                np.testing.assert_array_equal(GreedyPolicy.load(path).wealth_grid, env.wealth_grid)
+
+
+class TestMultiAssetEnvironment(unittest.TestCase):
+
+    def make_env(self, seed=None):
+        """ Create a small environment with two correlated risky assets. """
+        return MultiAssetEnvironment(
+            T=3, returns=[[0.4, 0.2], [0.4, -0.1], [-0.2, 0.2], [-0.2, -0.1]], probs=[0.5, 0.2, 0.1, 0.2],
+            riskless_ret=0.01, alpha=0.001, W_MAX=300, W_STEP=50, ACTION_STEP=50, rng=seed
+        )
+
+    def test_simplex_encoding(self):
+        """ Ensure allocations within a budget are encoded as 0 .. count - 1, ordered by their total. """
+        allocations = np.array([a for a in np.ndindex(6, 6, 6) if sum(a) <= 5])
+        codes = simplex_rank(allocations)
+        np.testing.assert_array_equal(np.sort(codes), np.arange(simplex_count(5, 3)))
+        np.testing.assert_array_equal(simplex_unrank(codes, 3), allocations)
+        self.assertTrue(np.all(np.diff(allocations[np.argsort(codes)].sum(axis=1)) >= 0))
+        np.testing.assert_array_equal(simplex_unrank(np.arange(4), 1)[:, 0], np.arange(4))  # One asset: units
+
+    def test_single_asset_matches_environment(self):
+        """ Ensure one risky asset reproduces the Environment. """
+        env = Environment(T=3, p=0.7, a_ret=0.4, b_ret=-0.2, riskless_ret=0.01, alpha=0.001,
+                          W_MAX=300, W_STEP=50, ACTION_STEP=50)
+        multi = MultiAssetEnvironment(T=3, returns=[[0.4], [-0.2]], probs=[0.7, 1 - 0.7], riskless_ret=0.01,
+                                      alpha=0.001, W_MAX=300, W_STEP=50, ACTION_STEP=50)
+        np.testing.assert_array_equal(multi.action_counts, env.action_counts)
+        np.testing.assert_array_equal(multi.next_index, [env.next_index_up, env.next_index_down])
+        np.testing.assert_array_equal(BackwardInductionSolver(multi).solve(), BackwardInductionSolver(env).solve())
+
+    def test_transitions(self):
+        """ Ensure allocations decode lazily and transitions follow the joint outcome table. """
+        env = self.make_env(seed=0)
+        self.assertEqual(list(env.action_candidates[100]), [(0, 0), (0, 50), (50, 0), (0, 100), (50, 50), (100, 0)])
+        self.assertEqual(env.action_counts[env.wealth_to_index[300]], simplex_count(6, 2))
+        # 50 * 1.4 + 50 * 0.9 + 100 * 1.01 = 216 -> 200
+        self.assertEqual(env.get_next_state(200, (50, 50)), 200)
+        for x in [(100, 150), (50, 25), (-50, 100), (50,)]:  # Over the wealth, off-grid, negative, wrong length
+            with self.assertRaises(KeyError):
+                env.action_index(env.wealth_to_index[200], x)
+        lazy = MultiAssetEnvironment(T=3, returns=env.returns, probs=env.probs, riskless_ret=0.01, alpha=0.001,
+                                     W_MAX=300, W_STEP=50, ACTION_STEP=50, lazy=True)
+        pair_w = np.repeat(np.arange(len(env.all_wealth_levels)), env.action_counts)
+        pair_a = np.arange(env.n_pairs) - env.action_offsets[pair_w]
+        for outcome in range(4):
+            np.testing.assert_array_equal(lazy.next_wealth_index(pair_w, pair_a, outcome), env.next_index[outcome])
+
+        w_idx, a_idx = env.wealth_to_index[200], env.action_index(4, (50, 100))
+        expected = np.zeros(len(env.all_wealth_levels))
+        for prob, next_idx in env.transition_outcomes():
+            expected[next_idx[env.pair_index(w_idx, a_idx)]] += prob
+        n = 100_000
+        sampled = env.sample_next_index(np.full(n, w_idx), np.full(n, a_idx), env.rng.random_array(n))
+        np.testing.assert_allclose(np.bincount(sampled, minlength=len(expected)) / n, expected, atol=0.01)
+        stepped = [lazy.step_index(w_idx, a_idx) for _ in range(10_000)]
+        np.testing.assert_allclose(np.bincount(stepped, minlength=len(expected)) / 10_000, expected, atol=0.02)
+
+    def test_solver_trainer_and_policy(self):
+        """ Ensure full-backup training reaches the exact optimum and the policy decodes allocations. """
+        env = self.make_env(seed=1)
+        solver = BackwardInductionSolver(env, q_layout="packed")
+        solver.solve()
+        w0_idx = env.wealth_to_index[100]
+        agent = Agent(env, alpha=1.0, gamma=1.0, epsilon_start=1.0, epsilon_end=1.0, decay_rate=0.0,
+                      INITIAL_WEALTH=100, q_layout="packed")
+        Trainer(agent, num_episodes=2000, callbacks=[], update_mode="expected").train()
+        self.assertAlmostEqual(agent.q_table.row(0, w0_idx).max(), solver.V[0, w0_idx], places=10)
+        BatchTrainer(agent, num_episodes=64, batch_size=16, callbacks=[]).train()
+
+        policy = GreedyPolicy.from_q_table(solver.q_table, env)
+        dist = PolicyEvaluator(env, n_paths=1000, rng=0).exact_distribution(policy, initial_wealth=100)
+        self.assertAlmostEqual(dist @ env.utility_table, solver.V[0, w0_idx], places=10)
+        best = env.action_candidates[100][int(np.argmax(solver.q_table.row(0, w0_idx)))]
+        np.testing.assert_array_equal(policy(0, [100, 100]), [best, best])
+        with tempfile.TemporaryDirectory() as out_dir:
+            path = os.path.join(out_dir, "policy.npz")
+            policy.save(path)
+            np.testing.assert_array_equal(GreedyPolicy.load(path)(0, 100), best)
+
+
 class TestAgent(unittest.TestCase):
 
     def setUp(self):
@@ -66,6 +299,217 @@ class TestAgent(unittest.TestCase):
 
         self.assertTrue(np.any(Q_after != Q_before))  # Ensure Q-table actually updates
 
+    def test_update_q_table_rejects_invalid_actions(self):
+        """ Ensure infeasible and off-grid actions raise instead of updating other cells. """
+        agent = Agent(self.env, alpha=0.5, gamma=1.0, epsilon_start=0.1, epsilon_end=0.01, decay_rate=0.01,
+                      INITIAL_WEALTH=100, q_layout="packed")
+        Q_before = agent.Q.copy()
+        with self.assertRaises(KeyError):
+            agent.update_q_table(0, 100, 200, -1.0, 100)  # More than the wealth
+        with self.assertRaises(KeyError):
+            agent.update_q_table(0, 100, 75, -1.0, 100)  # Not a multiple of ACTION_STEP
+        with self.assertRaises(KeyError):
+            agent.update_q_table(0, 100, -50, -1.0, 100)
+        np.testing.assert_array_equal(agent.Q, Q_before)
+
+class TestQTable(unittest.TestCase):
+
+    def setUp(self):
+        """ Initialize a small environment. """
+        self.env = self.make_env()
+
+    def make_env(self, seed=None):
+        """ Create the small environment with a seeded random stream. """
+        return Environment(
+            T=4, p=0.8, a_ret=0.6, b_ret=-0.3, riskless_ret=0.02, alpha=0.001,
+            W_MAX=1000, W_STEP=50, ACTION_STEP=50, rng=seed
+        )
+
+    def make_agent(self, env=None, **kwargs):
+        """ Create an agent for the small environment. """
+        return Agent(env or self.env, alpha=0.1, gamma=1.0, epsilon_start=0.5, epsilon_end=0.01, decay_rate=0.005,
+                     INITIAL_WEALTH=500, **kwargs)
+
+    def test_packed_layout_matches_dense(self):
+        """ Ensure the packed layout learns exactly what the dense layout learns. """
+        dense = self.make_agent(self.make_env(seed=3))
+        packed = self.make_agent(self.make_env(seed=3), q_layout="packed")
+        for agent in (dense, packed):
+            Trainer(agent, num_episodes=200).train()
+
+        np.testing.assert_array_equal(packed.q_table.to_dense(), dense.Q)
+        self.assertLess(packed.q_table.nbytes, 0.6 * dense.q_table.nbytes)
+
+    def test_float32_and_greedy(self):
+        """ Ensure float32 storage works and batch greedy lookups agree with choose_action. """
+        agent = self.make_agent(q_layout="packed", q_dtype=np.float32)
+        agent.warm_start(BackwardInductionSolver(self.env, q_layout="packed", q_dtype=np.float32).solve())
+        self.assertEqual(agent.Q.dtype, np.float32)
+
+        w_idx = np.arange(len(self.env.all_wealth_levels))
+        best_idx, best_q = agent.q_table.greedy(1, w_idx)
+        for i in w_idx:
+            self.assertEqual(best_idx[i], agent.choose_action_index(1, i, eps=0.0))
+            self.assertEqual(best_q[i], agent.q_table.row(1, i).max())
+
+    def test_sparse_layout_matches_dense(self):
+        """ Ensure the sparse layout on a lazy environment learns exactly what the dense layout learns. """
+        dense = self.make_agent(self.make_env(seed=3))
+        lazy_env = Environment(
+            T=4, p=0.8, a_ret=0.6, b_ret=-0.3, riskless_ret=0.02, alpha=0.001,
+            W_MAX=1000, W_STEP=50, ACTION_STEP=50, rng=3, lazy=True
+        )
+        sparse = self.make_agent(lazy_env, q_layout="sparse")
+        for agent in (dense, sparse):
+            Trainer(agent, num_episodes=200).train()
+
+        np.testing.assert_array_equal(sparse.q_table.to_dense(), dense.Q)
+        np.testing.assert_array_equal(sparse.q_table.greedy_actions(), dense.q_table.greedy_actions())
+        occupancy = sparse.q_table.occupancy()
+        self.assertLess(occupancy["rows_allocated"], occupancy["rows_total"])
+        self.assertEqual(sparse.q_table.row(0, 0).tolist(), [0.0])  # Unwritten rows read as zero
+        self.assertIsNone(sparse.Q)
+        with self.assertRaises(ValueError):
+            BatchTrainer(sparse, num_episodes=10)
+
+    def test_lazy_environment_matches_tables(self):
+        """ Ensure the arithmetic transitions and mappings of a lazy environment match the tables. """
+        lazy_env = Environment(
+            T=4, p=0.8, a_ret=0.6, b_ret=-0.3, riskless_ret=0.02, alpha=0.001,
+            W_MAX=1000, W_STEP=50, ACTION_STEP=50, lazy=True
+        )
+        pair_w = np.repeat(np.arange(len(self.env.all_wealth_levels)), self.env.action_counts)
+        pair_a = np.arange(self.env.n_pairs) - self.env.action_offsets[pair_w]
+        for u in (0.0, 0.99):
+            u_all = np.full(len(pair_w), u)
+            np.testing.assert_array_equal(lazy_env.sample_next_index(pair_w, pair_a, u_all),
+                                          self.env.sample_next_index(pair_w, pair_a, u_all))
+        self.assertEqual(dict(lazy_env.wealth_to_index), self.env.wealth_to_index)
+        self.assertEqual(lazy_env.action_candidates[300], self.env.action_candidates[300])
+        self.assertNotIn(75, lazy_env.wealth_to_index)
+        with self.assertRaises(ValueError):
+            lazy_env.transition_outcomes()
+
+class TestBackwardInductionSolver(unittest.TestCase):
+
+    def setUp(self):
+        """ Initialize a small environment that can be solved by brute force. """
+        self.env = Environment(
+            T=3, p=0.7, a_ret=0.4, b_ret=-0.2, riskless_ret=0.01, alpha=0.001,
+            W_MAX=500, W_STEP=50, ACTION_STEP=50
+        )
+        self.solver = BackwardInductionSolver(self.env, gamma=1.0)
+
+    def brute_force_q(self, t, w, x):
+        """ Expected optimal value of investing x at wealth w and stage t, by recursion. """
+        value = 0.0
+        for prob, ret in ((self.env.p, self.env.a_ret), (1 - self.env.p, self.env.b_ret)):
+            w_float = x * (1.0 + ret) + (w - x) * (1.0 + self.env.riskless_ret)
+            w_next = max(0, min(int(round(w_float / self.env.W_STEP)) * self.env.W_STEP, self.env.W_MAX))
+            if t == self.env.T - 1:
+                value += prob * self.env.utility(w_next)
+            else:
+                value += prob * max(self.brute_force_q(t + 1, w_next, x_next)
+                                    for x_next in self.env.action_candidates[w_next])
+        return value
+
+    def test_solve_matches_brute_force(self):
+        """ Ensure the backward induction matches a direct recursion. """
+        Q = self.solver.solve()
+        for t in range(self.env.T):
+            for w in (0, 100, 350):
+                w_idx = self.env.wealth_to_index[w]
+                for a_idx, x in enumerate(self.env.action_candidates[w]):
+                    self.assertAlmostEqual(Q[t, w_idx, a_idx], self.brute_force_q(t, w, x), places=10)
+
+    def test_warm_start_agent(self):
+        """ Ensure the solution has the layout of Agent.Q and can seed an agent. """
+        agent = Agent(self.env, alpha=0.01, gamma=1.0, epsilon_start=0.2, epsilon_end=0.01, decay_rate=0.005, INITIAL_WEALTH=100)
+        Q = self.solver.solve()
+        agent.warm_start(Q)
+
+        self.assertEqual(agent.compute_q_diff(Q), 0.0)
+        best_x = self.env.action_candidates[100][np.argmax(Q[0, 2, :3])]
+        self.assertEqual(agent.choose_action(0, 100, eps=0.0), best_x)
+
+class TestGreedyPolicy(unittest.TestCase):
+
+    def setUp(self):
+        """ Initialize an agent warm-started from the optimal Q-values. """
+        self.env = Environment(
+            T=3, p=0.7, a_ret=0.4, b_ret=-0.2, riskless_ret=0.01, alpha=0.001,
+            W_MAX=500, W_STEP=50, ACTION_STEP=50
+        )
+        solver = BackwardInductionSolver(self.env, q_layout="packed")
+        self.agent = Agent(self.env, alpha=0.01, gamma=1.0, epsilon_start=0.2, epsilon_end=0.01, decay_rate=0.005,
+                           INITIAL_WEALTH=100, q_layout="packed")
+        self.agent.warm_start(solver.solve())
+
+    def test_matches_agent_choices(self):
+        """ Ensure vectorized queries match the greedy choices of the agent. """
+        policy = self.agent.export_policy()
+        self.assertEqual(policy.actions.dtype, np.int16)
+        t, w = np.meshgrid(np.arange(self.env.T), self.env.all_wealth_levels, indexing="ij")
+        expected = [[self.agent.choose_action(ti, wi, eps=0.0) for wi in self.env.all_wealth_levels]
+                    for ti in range(self.env.T)]
+        np.testing.assert_array_equal(policy(t, w), expected)
+        # Off-grid and out-of-range wealth values are snapped onto the grid
+        np.testing.assert_array_equal(policy(1, [-10.0, 74.0, 76.0, 10 ** 6]), policy(1, [0, 50, 100, 500]))
+
+    def test_save_and_load(self):
+        """ Ensure a saved policy loads and is queried without Agent or matplotlib. """
+        with tempfile.TemporaryDirectory() as out_dir:
+            path = os.path.join(out_dir, "policy.npz")
+            policy = self.agent.export_policy(path)
+            code = (
+                "import sys, msbd6000m_assignment1 as m\n"
+                "policy = m.GreedyPolicy.load(sys.argv[1])\n"
+                "print(policy(0, 100))\n"
+                "assert 'matplotlib' not in sys.modules\n"
+            )
+            result = subprocess.run([sys.executable, "-c", code, path], check=True, capture_output=True, text=True,
+                                    cwd=os.path.dirname(os.path.abspath(__file__)))
+            loaded = GreedyPolicy.load(path)
+        self.assertEqual(int(result.stdout), policy(0, 100))
+        np.testing.assert_array_equal(loaded.actions, policy.actions)
+        self.assertEqual((loaded.W_STEP, loaded.ACTION_STEP), (50, 50))
+
+class TestPolicyEvaluator(unittest.TestCase):
+
+    def setUp(self):
+        """ Initialize an environment with its optimal agent. """
+        self.env = Environment(
+            T=4, p=0.7, a_ret=0.4, b_ret=-0.2, riskless_ret=0.01, alpha=0.001,
+            W_MAX=500, W_STEP=50, ACTION_STEP=50
+        )
+        self.agent = Agent(self.env, alpha=0.01, gamma=1.0, epsilon_start=0.2, epsilon_end=0.01, decay_rate=0.005,
+                           INITIAL_WEALTH=100)
+        self.agent.warm_start(BackwardInductionSolver(self.env).solve())
+
+    def test_optimal_policy_reaches_optimum(self):
+        """ Ensure the exact distribution of the optimal policy attains the solver value. """
+        evaluator = PolicyEvaluator(self.env, n_paths=1000, rng=0)
+        dist = evaluator.exact_distribution(self.agent)
+        self.assertAlmostEqual(dist.sum(), 1.0)
+        self.assertAlmostEqual(dist @ self.env.utility_table, evaluator.optimum(100)["expected_utility"], places=10)
+
+    def test_simulation_matches_exact_distribution(self):
+        """ Ensure the Monte Carlo estimate covers the exact value and reports its statistics. """
+        evaluator = PolicyEvaluator(self.env, n_paths=200_000, chunk_size=30_000, rng=0)
+        policy = self.agent.export_policy()
+        result = evaluator.evaluate(policy, initial_wealth=100)
+        exact = evaluator.exact_distribution(policy, initial_wealth=100)
+
+        self.assertEqual(result["n_paths"], 200_000)
+        low, high = result["expected_utility_ci"]
+        self.assertLess(low, exact @ self.env.utility_table)
+        self.assertGreater(high, exact @ self.env.utility_table)
+        np.testing.assert_allclose(result["wealth_distribution"], exact, atol=0.01)
+        self.assertAlmostEqual(self.env.utility(result["certainty_equivalent"]), result["expected_utility"])
+        self.assertLess(abs(result["certainty_equivalent_gap"]), high - low)
+        with self.assertRaises(ValueError):
+            evaluator.evaluate(policy)  # A GreedyPolicy needs the initial wealth
+
 class TestTrainer(unittest.TestCase):
 
     def setUp(self):
@@ -77,6 +521,15 @@ class TestTrainer(unittest.TestCase):
         self.agent = Agent(self.env, alpha=0.01, gamma=1.0, epsilon_start=0.2, epsilon_end=0.01, decay_rate=0.005, INITIAL_WEALTH=1000)
         self.trainer = Trainer(self.agent, num_episodes=10)  # Small training episodes for quick tests
 
+    def make_agent(self, seed=None, **kwargs):
+        """ Create a fresh agent whose environment has a seeded random stream. """
+        env = Environment(
+            T=10, p=0.8, a_ret=0.6, b_ret=-0.3, riskless_ret=0.02, alpha=0.001,
+            W_MAX=3000, W_STEP=50, ACTION_STEP=50, rng=seed
+        )
+        return Agent(env, alpha=0.01, gamma=1.0, epsilon_start=0.2, epsilon_end=0.01, decay_rate=0.005, INITIAL_WEALTH=1000,
+                     **kwargs)
+
     def test_training_updates_q_table(self):
         """ Ensure training updates the Q-table. """
         Q_before = self.agent.Q.copy()
@@ -85,6 +538,299 @@ class TestTrainer(unittest.TestCase):
 
         self.assertTrue(np.any(Q_after != Q_before))  # Ensure Q-table is modified after training
 
+    def test_incremental_q_diff_matches_full_diff(self):
+        """ Ensure the incremental error equals the full Q-table diff. """
+        agent, verified_agent = self.make_agent(seed=0), self.make_agent(seed=0)
+        trainer = Trainer(agent, num_episodes=10)
+        verified = Trainer(verified_agent, num_episodes=10, verify_q_diff=True)
+        trainer.train()
+        verified.train()
+
+        np.testing.assert_allclose(trainer.errors, verified.errors, rtol=1e-9)
+        np.testing.assert_array_equal(agent.Q, verified_agent.Q)
+
+    def test_seeded_runs_are_reproducible(self):
+        """ Ensure runs with the same seed give identical results. """
+        agents = [self.make_agent(seed=42), self.make_agent(seed=42), self.make_agent(seed=43)]
+        trainers = [Trainer(agent, num_episodes=20) for agent in agents]
+        for trainer in trainers:
+            trainer.train()
+
+        np.testing.assert_array_equal(agents[0].Q, agents[1].Q)
+        self.assertTrue(np.any(agents[0].Q != agents[2].Q))
+
+    def test_batch_trainer_records_every_episode(self):
+        """ Ensure the batch trainer produces one error and final wealth per episode. """
+        trainer = BatchTrainer(self.agent, num_episodes=50, batch_size=16, rng=0)
+        trainer.train()
+
+        self.assertEqual(len(trainer.errors), 50)
+        self.assertEqual(len(trainer.final_wealths), 50)
+        self.assertTrue(all(w in self.env.wealth_to_index for w in trainer.final_wealths))
+        # Padding slots beyond the valid actions of a wealth level must never be updated
+        valid = np.arange(self.agent.max_act_count) < self.env.action_counts[:, None]
+        self.assertFalse(np.any(self.agent.Q[:, ~valid]))
+
+    def test_checkpoint_resume_is_bit_for_bit(self):
+        """ Ensure a run resumed from a checkpoint continues exactly as an uninterrupted run. """
+        full_agent = self.make_agent(seed=5)
+        full = Trainer(full_agent, num_episodes=20)
+        full.train()
+
+        with tempfile.TemporaryDirectory() as out_dir:
+            path = os.path.join(out_dir, "ckpt")
+            Trainer(self.make_agent(seed=5), num_episodes=12, checkpoint_dir=path, checkpoint_every=4).train()
+
+            # The resumed run takes its random state from the checkpoint, not from its seed
+            resumed_agent = self.make_agent(seed=123)
+            resumed = Trainer(resumed_agent, num_episodes=20)
+            resumed.resume(path)
+
+            self.assertEqual(load_checkpoint_q(path).shape, full_agent.Q.shape)
+        np.testing.assert_array_equal(resumed_agent.Q, full_agent.Q)
+        np.testing.assert_array_equal(resumed.final_wealths, full.final_wealths)
+        np.testing.assert_array_equal(resumed.errors, full.errors)
+        self.assertEqual(resumed.episode, 20)
+
+    def test_sparse_checkpoint_resume(self):
+        """ Ensure a sparse Q-table is saved and restored by checkpoints. """
+        full_agent = self.make_agent(seed=2, q_layout="sparse")
+        Trainer(full_agent, num_episodes=20).train()
+
+        with tempfile.TemporaryDirectory() as out_dir:
+            path = os.path.join(out_dir, "ckpt")
+            Trainer(self.make_agent(seed=2, q_layout="sparse"), num_episodes=10, checkpoint_dir=path).train()
+            resumed_agent = self.make_agent(seed=9, q_layout="sparse")
+            Trainer(resumed_agent, num_episodes=20).resume(path)
+        np.testing.assert_array_equal(resumed_agent.q_table.to_dense(), full_agent.q_table.to_dense())
+
+    def test_batch_checkpoint_resume(self):
+        """ Ensure the batch trainer resumes exactly from a checkpoint. """
+        full_agent = self.make_agent(seed=1)
+        full = BatchTrainer(full_agent, num_episodes=64, batch_size=16)
+        full.train()
+
+        with tempfile.TemporaryDirectory() as out_dir:
+            path = os.path.join(out_dir, "ckpt")
+            BatchTrainer(self.make_agent(seed=1), num_episodes=32, batch_size=16, checkpoint_dir=path).train()
+
+            resumed_agent = self.make_agent()
+            resumed = BatchTrainer(resumed_agent, num_episodes=64, batch_size=16)
+            resumed.resume(path)
+        np.testing.assert_array_equal(resumed_agent.Q, full_agent.Q)
+        np.testing.assert_array_equal(resumed.final_wealths, full.final_wealths)
+
+    def test_batch_checkpoint_resume_with_own_stream(self):
+        """ Ensure a batch stream separate from the agent's is saved and restored. """
+        full_agent = self.make_agent(seed=1)
+        full = BatchTrainer(full_agent, num_episodes=64, batch_size=16, rng=7)
+        full.train()
+
+        with tempfile.TemporaryDirectory() as out_dir:
+            path = os.path.join(out_dir, "ckpt")
+            BatchTrainer(self.make_agent(seed=1), num_episodes=32, batch_size=16, rng=7, checkpoint_dir=path).train()
+
+            resumed_agent = self.make_agent()
+            resumed = BatchTrainer(resumed_agent, num_episodes=64, batch_size=16, rng=99)
+            resumed.resume(path)
+        np.testing.assert_array_equal(resumed_agent.Q, full_agent.Q)
+        np.testing.assert_array_equal(resumed.final_wealths, full.final_wealths)
+
+    def test_callbacks_and_timers(self):
+        """ Ensure callbacks see every episode and instrumentation times every phase. """
+        class Recorder(TrainerCallback):
+            def __init__(self):
+                self.events = []
+
+            def on_train_start(self, trainer):
+                self.events.append("start")
+
+            def on_step(self, trainer, episode, t, w_idx, a_idx, reward, w_next_idx):
+                self.events.append("step")
+
+            def on_episode_end(self, trainer, episode, epsilon, error, final_wealth):
+                self.events.append(episode)
+
+            def on_train_end(self, trainer):
+                self.events.append("end")
+
+        recorder = Recorder()
+        trainer = Trainer(self.make_agent(seed=0), num_episodes=5, callbacks=[recorder], instrument=True)
+        trainer.train()
+        self.assertEqual(recorder.events[0], "start")
+        self.assertEqual(recorder.events[-1], "end")
+        self.assertEqual([e for e in recorder.events if isinstance(e, int)], list(range(5)))
+        self.assertEqual(recorder.events.count("step"), 5 * self.env.T)
+        self.assertEqual(trainer.timers.counts["update_q"], 5 * self.env.T)
+
+        # Instrumentation and callbacks must not change the result
+        plain = Trainer(self.make_agent(seed=0), num_episodes=5, callbacks=[])
+        plain.train()
+        np.testing.assert_array_equal(plain.agent.Q, trainer.agent.Q)
+        self.assertIsNone(plain.timers)
+
+        # Batch hooks fall back to the per-episode hooks
+        recorder = Recorder()
+        batch = BatchTrainer(self.make_agent(seed=0), num_episodes=20, batch_size=8, callbacks=[recorder], instrument=True)
+        batch.train()
+        self.assertEqual([e for e in recorder.events if isinstance(e, int)], list(range(20)))
+        self.assertIn("update_q", batch.timers.summary())
+
+    def test_stopping_rules(self):
+        """ Ensure stopping rules end training at a check and report why. """
+        trainer = Trainer(self.make_agent(seed=0), num_episodes=100,
+                          callbacks=[QDiffThreshold(threshold=np.inf, window=10, check_every=20)])
+        trainer.train()
+        self.assertEqual((trainer.episode, trainer.stopped_episode), (20, 20))
+        self.assertEqual(len(trainer.errors), 20)
+        self.assertIn("Q-diff", trainer.stop_reason)
+
+        # The batch trainer stops at the end of the batch that crossed a check
+        plateau = PolicyPlateau(tolerance=1.0, patience=2, check_every=10)
+        batch = BatchTrainer(self.make_agent(seed=0), num_episodes=100, batch_size=8, callbacks=[plateau])
+        batch.train()
+        self.assertEqual(batch.episode, 24)
+        self.assertEqual(len(plateau.changes), 2)
+
+        # Only states reachable from the initial wealth count as changes
+        plateau = PolicyPlateau(check_every=10)
+        trainer = Trainer(self.make_agent(seed=0), num_episodes=10, callbacks=[])
+        plateau.on_train_start(trainer)
+        unreachable = np.argwhere(~trainer.agent.env.reachable_states(trainer.agent.INITIAL_WEALTH))
+        t, w_idx = unreachable[np.argmax(trainer.agent.env.action_counts[unreachable[:, 1]])]
+        trainer.agent.q_table.write_row(t, w_idx)[-1] = 1.0  # Change the greedy action of an unreachable state
+        plateau.check(trainer)
+        self.assertEqual(plateau.changes, [0.0])
+
+        # Held-out evaluation is deterministic and leaves the training streams untouched
+        evaluation = GreedyEvaluation(n_episodes=200, patience=1, min_delta=np.inf, check_every=10, min_episodes=20)
+        agent = self.make_agent(seed=0)
+        state = agent.rng.get_state()
+        self.assertEqual(evaluation.evaluate(agent), evaluation.evaluate(agent))
+        self.assertEqual(agent.rng.get_state(), state)
+        trainer = Trainer(agent, num_episodes=100, callbacks=[evaluation])
+        trainer.train()
+        self.assertEqual(trainer.stopped_episode, 30)
+        self.assertEqual(len(evaluation.scores), 2)
+
+        # Without a stopping rule all episodes run
+        trainer = Trainer(self.make_agent(seed=0), num_episodes=30, callbacks=[])
+        trainer.train()
+        self.assertIsNone(trainer.stop_reason)
+        self.assertEqual(trainer.episode, 30)
+
+    def test_expected_updates_reach_exact_values(self):
+        """ Ensure full backups with alpha=1 and full exploration recover the exact optimum. """
+        env = Environment(
+            T=3, p=0.7, a_ret=0.4, b_ret=-0.2, riskless_ret=0.01, alpha=0.001,
+            W_MAX=300, W_STEP=50, ACTION_STEP=50, rng=0
+        )
+        solver = BackwardInductionSolver(env)
+        solver.solve()
+        w0_idx = env.wealth_to_index[100]
+
+        agent = Agent(env, alpha=1.0, gamma=1.0, epsilon_start=1.0, epsilon_end=1.0, decay_rate=0.0, INITIAL_WEALTH=100)
+        Trainer(agent, num_episodes=500, callbacks=[], update_mode="expected").train()
+        self.assertAlmostEqual(agent.q_table.row(0, w0_idx).max(), solver.V[0, w0_idx], places=10)
+        visited = agent.Q != 0
+        np.testing.assert_allclose(agent.Q[visited], solver.Q[visited], rtol=1e-12)
+
+        batch_agent = Agent(env, alpha=0.2, gamma=1.0, epsilon_start=1.0, epsilon_end=1.0, decay_rate=0.0,
+                            INITIAL_WEALTH=100)
+        BatchTrainer(batch_agent, num_episodes=4000, batch_size=4, callbacks=[], update_mode="expected").train()
+        self.assertAlmostEqual(batch_agent.q_table.row(0, w0_idx).max(), solver.V[0, w0_idx], places=3)
+        with self.assertRaises(ValueError):
+            Trainer(agent, num_episodes=1, update_mode="exact")
+
+    def test_replay_buffer_and_batch_updates(self):
+        """ Ensure the ring buffer keeps the latest transitions and batch updates use per-cell mean errors. """
+        buffer = ReplayBuffer(4, rng=0)
+        for i in range(3):
+            buffer.add(0, i, 0, float(i), i)
+        buffer.add_batch(1, np.array([3, 4, 5]), np.zeros(3, dtype=int), 1.0, np.array([3, 4, 5]))
+        self.assertEqual(len(buffer), 4)
+        self.assertEqual(sorted(buffer.w_idx.tolist()), [2, 3, 4, 5])  # The two oldest were overwritten
+        buffer.priorities[:] = [0.5, 3.0, 2.0, 1.0]
+        np.testing.assert_array_equal(buffer.top(2), [1, 2])
+        np.testing.assert_array_equal(np.sort(buffer.predecessors(np.array([2]), np.array([4]))), [0])  # Slot of w_next=4 at t=1
+
+        agent = self.make_agent(seed=0)
+        w0 = agent.env.wealth_to_index[1000]
+        agent.Q[1, 5, 0] = 2.0
+        t = np.array([0, 0, 9])
+        w_idx = np.array([w0, w0, 3])
+        a_idx = np.array([1, 1, 2])
+        reward = np.array([0.0, 0.0, -0.5])
+        w_next = np.array([5, 6, 4])
+        td = agent.update_q_batch(t, w_idx, a_idx, reward, w_next)
+        np.testing.assert_allclose(td, [2.0, 0.0, -0.5])
+        self.assertAlmostEqual(agent.Q[0, w0, 1], agent.alpha * 1.0)  # Mean of the two errors of the cell
+        self.assertAlmostEqual(agent.Q[9, 3, 2], agent.alpha * -0.5)
+
+    def test_experience_replay(self):
+        """ Ensure uniform and prioritized replay run in both trainers and update from the buffer. """
+        for prioritized in (False, True):
+            agent = self.make_agent(seed=0)
+            replay = ExperienceReplay(capacity=500, batch_size=32, updates=2, prioritized=prioritized)
+            Trainer(agent, num_episodes=100, callbacks=[replay]).train()
+            self.assertEqual(len(replay.buffer), 500)
+            self.assertGreater(replay.replayed, 0)
+            if prioritized:  # Priorities are the current TD errors
+                slots = np.arange(len(replay.buffer))
+                self.assertTrue(np.all(replay.buffer.priorities >= 0))
+                self.assertGreater(np.abs(agent.td_error(*replay.buffer.get(slots))[0]).max(), 0)
+
+            batch_agent = self.make_agent(seed=0)
+            batch_replay = ExperienceReplay(capacity=1000, batch_size=32, prioritized=prioritized)
+            BatchTrainer(batch_agent, num_episodes=64, batch_size=16, callbacks=[batch_replay]).train()
+            self.assertEqual(len(batch_replay.buffer), 640)
+            self.assertGreater(batch_replay.replayed, 0)
+
+        with self.assertRaises(ValueError):
+            Trainer(self.make_agent(q_layout="sparse"), num_episodes=1, callbacks=[ExperienceReplay()]).train()
+
+    def test_parallel_trainer_matches_single_process(self):
+        """ Ensure both parallel modes learn the policy of the single-process trainer. """
+        env = Environment(
+            T=3, p=0.7, a_ret=0.4, b_ret=-0.2, riskless_ret=0.01, alpha=0.001,
+            W_MAX=300, W_STEP=50, ACTION_STEP=50, rng=0
+        )
+        params = dict(alpha=1.0, gamma=1.0, epsilon_start=1.0, epsilon_end=1.0, decay_rate=0.0, INITIAL_WEALTH=100)
+        single = Agent(env, **params)
+        Trainer(single, num_episodes=500, callbacks=[], update_mode="expected").train()
+        w0_idx = env.wealth_to_index[100]
+
+        for mode in ("hogwild", "average"):
+            agent = Agent(env, **params)
+            trainer = ParallelTrainer(agent, num_episodes=500, n_workers=2, mode=mode, sync_every=25, callbacks=[],
+                                      update_mode="expected")
+            trainer.train()
+            self.assertEqual(len(trainer.errors), 500)
+            self.assertEqual(trainer.episode, 500)
+            visited = (agent.Q != 0).any(axis=2) & (single.Q != 0).any(axis=2)
+            self.assertTrue(visited[0, w0_idx])
+            np.testing.assert_array_equal(agent.q_table.greedy_actions()[visited], single.q_table.greedy_actions()[visited])
+            self.assertAlmostEqual(agent.q_table.row(0, w0_idx).max(), single.q_table.row(0, w0_idx).max(), places=10)
+
+        # Sampled updates in rounds, with a stopping rule evaluated between rounds
+        agent = self.make_agent(seed=0)
+        trainer = ParallelTrainer(agent, num_episodes=400, n_workers=2, sync_every=50, callbacks=[
+            QDiffThreshold(threshold=1e9, window=10, check_every=100)])
+        trainer.train()
+        self.assertEqual(trainer.stopped_episode, 100)
+        self.assertEqual(len(trainer.final_wealths), 100)
+        self.assertGreater(np.abs(agent.Q).sum(), 0)
+        with self.assertRaises(ValueError):
+            ParallelTrainer(self.make_agent(q_layout="sparse"), num_episodes=1)
+
+    def test_profile_training(self):
+        """ Ensure the profiler writes a readable profile. """
+        with tempfile.TemporaryDirectory() as out_dir:
+            path = os.path.join(out_dir, "train.prof")
+            stats = profile_training(Trainer(self.make_agent(seed=0), num_episodes=5, callbacks=[]), path)
+            self.assertTrue(os.path.exists(path))
+        self.assertGreater(stats.total_calls, 0)
+
     def test_plot_results(self):
         """ Ensure plotting function runs without errors. """
         try:
@@ -92,5 +838,208 @@ class TestTrainer(unittest.TestCase):
         except Exception as e:
             self.fail(f"plot_results() raised an error: {e}")
 
+
+class TestMetrics(unittest.TestCase):
+
+    def test_rolling_means_and_moving_average(self):
+        """ Ensure rolling statistics and smoothing match direct averages. """
+        rng = np.random.default_rng(0)
+        errors, wealths = rng.random(1000), rng.random(1000) * 1000
+        metrics = MetricsRecorder(capacity=10, window=100)
+        for e, w in zip(errors[:500], wealths[:500]):
+            metrics.record(e, w)
+        metrics.record_batch(errors[500:], wealths[500:])
+
+        np.testing.assert_array_equal(metrics.errors, errors)
+        np.testing.assert_allclose(metrics.rolling_means(), (errors[-100:].mean(), wealths[-100:].mean()))
+        np.testing.assert_allclose(metrics.rolling_means(250), (errors[151:251].mean(), wealths[151:251].mean()))
+
+        expected = [np.mean(errors[max(0, i - 49):i + 1]) for i in range(len(errors))]
+        np.testing.assert_allclose(moving_average(errors, 50), expected)
+
+    def test_plot_to_file_without_pyplot(self):
+        """ Ensure training and saving plots do not load pyplot. """
+        code = (
+            "import sys, msbd6000m_assignment1 as m\n"
+            "assert 'matplotlib' not in sys.modules\n"
+            "env = m.Environment(T=3, p=0.8, a_ret=0.6, b_ret=-0.3, riskless_ret=0.02, alpha=0.001,"
+            " W_MAX=300, W_STEP=50, ACTION_STEP=50)\n"
+            "trainer = m.BatchTrainer(m.Agent(env, 0.01, 1.0, 0.2, 0.01, 0.005, 100), num_episodes=1000)\n"
+            "trainer.train()\n"
+            "trainer.plot_results(sys.argv[1])\n"
+            "assert 'matplotlib.pyplot' not in sys.modules\n"
+        )
+        with tempfile.TemporaryDirectory() as out_dir:
+            path = os.path.join(out_dir, "plot.png")
+            subprocess.run([sys.executable, "-c", code, path], check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+            self.assertGreater(os.path.getsize(path), 0)
+
+class TestSweep(unittest.TestCase):
+
+    def test_run_sweep(self):
+        """ Ensure a sweep runs every grid point and writes its results and Q-tables. """
+        from sweep import expand_grid, run_sweep
+
+        grid = {
+            "env": [
+                {"name": "A", "p": 0.8, "a_ret": 0.6, "b_ret": -0.3, "riskless_ret": 0.02},
+                {"name": "B", "p": 0.6, "a_ret": 0.35, "b_ret": -0.05, "riskless_ret": 0.015},
+            ],
+            "agent": {"alpha": [0.01, 0.1], "gamma": 1.0, "epsilon_start": 0.2, "epsilon_end": 0.01,
+                      "decay_rate": 0.005, "INITIAL_WEALTH": 100},
+            "trainer": {"type": "BatchTrainer", "num_episodes": 200, "batch_size": 50},
+        }
+        for env_params in grid["env"]:
+            env_params.update(T=3, alpha=0.001, W_MAX=300, W_STEP=50, ACTION_STEP=50)
+        self.assertEqual(len(expand_grid(grid)), 4)
+
+        with tempfile.TemporaryDirectory() as out_dir:
+            rows = run_sweep(grid, out_dir, max_workers=2, seed=0)
+            self.assertEqual([row["run_id"] for row in rows], [0, 1, 2, 3])
+            self.assertEqual(len(set(row["seed"] for row in rows)), 4)  # Independent streams
+            self.assertTrue(os.path.exists(os.path.join(out_dir, "results.csv")))
+            self.assertTrue(all(np.isfinite(row["certainty_equivalent_gap"]) for row in rows))
+            Q = np.load(rows[0]["q_path"], mmap_mode="r")
+            self.assertEqual(Q.shape, (3, 7, 7))
+
+    def test_run_sweep_lazy_environment(self):
+        """ Ensure lazy environments, which have no exact optimum, are evaluated without the gap columns. """
+        from sweep import run_sweep
+
+        grid = {
+            "env": {"p": 0.8, "a_ret": 0.6, "b_ret": -0.3, "riskless_ret": 0.02, "T": 3, "alpha": 0.001,
+                    "W_MAX": 300, "W_STEP": 50, "ACTION_STEP": 50, "lazy": [False, True]},
+            "agent": {"alpha": 0.1, "gamma": 1.0, "epsilon_start": 0.2, "epsilon_end": 0.01, "decay_rate": 0.005,
+                      "INITIAL_WEALTH": 100, "q_layout": "sparse"},
+            "trainer": {"type": "Trainer", "num_episodes": 100},
+        }
+        with tempfile.TemporaryDirectory() as out_dir:
+            eager, lazy = run_sweep(grid, out_dir, max_workers=2, seed=0)
+            self.assertTrue(np.isfinite(eager["certainty_equivalent_gap"]))
+            self.assertNotIn("certainty_equivalent_gap", lazy)
+            self.assertTrue(np.isfinite(lazy["eval_certainty_equivalent"]))
+            self.assertTrue(os.path.exists(os.path.join(out_dir, "results.csv")))
+
+
+def cached_run(root, max_bytes, config, seed):
+    """ Run a configuration through a ResultCache (executed in a worker process). """
+    from result_cache import ResultCache
+
+    return ResultCache(root, max_bytes=max_bytes).run(config, seed)[1]
+
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        """ Define a small run configuration. """
+        self.config = {
+            "env": {"name": "A", "T": 3, "p": 0.8, "a_ret": 0.6, "b_ret": -0.3, "riskless_ret": 0.02, "alpha": 0.001,
+                    "W_MAX": 300, "W_STEP": 50, "ACTION_STEP": 50},
+            "agent": {"alpha": 0.1, "gamma": 1.0, "epsilon_start": 0.2, "epsilon_end": 0.01, "decay_rate": 0.005,
+                      "INITIAL_WEALTH": 100},
+            "trainer": {"type": "Trainer", "num_episodes": 200, "callbacks": []},
+        }
+
+    def with_episodes(self, num_episodes):
+        return {**self.config, "trainer": {**self.config["trainer"], "num_episodes": num_episodes}}
+
+    def test_hit_and_prefix_resume(self):
+        """ Ensure identical runs are loaded and longer runs resume bit for bit from the cached prefix. """
+        from result_cache import ResultCache, build_trainer
+
+        fresh = build_trainer(self.with_episodes(300), seed=3)
+        fresh.train()
+        with tempfile.TemporaryDirectory() as root:
+            cache = ResultCache(root)
+            trainer, source = cache.run(self.config, seed=3)
+            self.assertEqual(source, "trained")
+            loaded, source = cache.run(self.config, seed=3)
+            self.assertEqual(source, "hit")
+            np.testing.assert_array_equal(loaded.agent.Q, trainer.agent.Q)
+            np.testing.assert_array_equal(loaded.errors, trainer.errors)
+            policy = cache.policy(self.config, seed=3)
+            np.testing.assert_array_equal(policy.actions, trainer.agent.export_policy().actions)
+
+            resumed, source = cache.run(self.with_episodes(300), seed=3)
+            self.assertEqual(source, "resumed")
+            np.testing.assert_array_equal(resumed.agent.Q, fresh.agent.Q)
+            np.testing.assert_array_equal(resumed.final_wealths, fresh.final_wealths)
+
+            # A different seed or code version is a different key
+            self.assertEqual(cache.run(self.config, seed=4)[1], "trained")
+            self.assertIsNone(ResultCache(root, version="other").policy(self.config, seed=3))
+
+    def test_batch_trainer_resumes_on_batch_boundaries(self):
+        """ Ensure BatchTrainer runs only resume from prefixes made of full batches. """
+        from result_cache import ResultCache, build_trainer
+
+        config = {**self.config, "trainer": {"num_episodes": 200, "batch_size": 64, "callbacks": []}}
+        with_episodes = lambda n: {**config, "trainer": {**config["trainer"], "num_episodes": n}}
+        fresh = build_trainer(with_episodes(256), seed=3)
+        fresh.train()
+        with tempfile.TemporaryDirectory() as root:
+            cache = ResultCache(root)
+            self.assertEqual(cache.run(config, seed=3)[1], "trained")
+            self.assertEqual(cache.run(with_episodes(300), seed=3)[1], "trained")  # 200 ends in a partial batch
+            self.assertEqual(cache.run(with_episodes(128), seed=3)[1], "trained")
+            resumed, source = cache.run(with_episodes(256), seed=3)
+            self.assertEqual(source, "resumed")
+            np.testing.assert_array_equal(resumed.agent.Q, fresh.agent.Q)
+            np.testing.assert_array_equal(resumed.final_wealths, fresh.final_wealths)
+
+    def test_concurrent_runs(self):
+        """ Ensure processes sharing a cache never read partial entries or lose entries being loaded. """
+        from concurrent.futures import ProcessPoolExecutor
+        from result_cache import ResultCache, build_trainer
+
+        with tempfile.TemporaryDirectory() as root:
+            cache = ResultCache(root)
+            cache.run(self.config, seed=0)
+            max_bytes = 3 * cache.nbytes  # Every store evicts
+            seeds = list(range(8)) * 4
+            with ProcessPoolExecutor(max_workers=8) as pool:
+                sources = list(pool.map(cached_run, [root] * len(seeds), [max_bytes] * len(seeds),
+                                        [self.config] * len(seeds), seeds))
+            self.assertTrue(set(sources) <= {"hit", "trained"})
+            self.assertLessEqual(cache.nbytes, max_bytes)
+
+            fresh = build_trainer(self.config, seed=5)
+            fresh.train()
+            np.testing.assert_array_equal(ResultCache(root, max_bytes=max_bytes).run(self.config, seed=5)[0].agent.Q,
+                                          fresh.agent.Q)
+
+    def test_lru_eviction(self):
+        """ Ensure the least recently used entries are evicted beyond the size limit. """
+        from result_cache import ResultCache
+
+        with tempfile.TemporaryDirectory() as root:
+            cache = ResultCache(root)
+            cache.run(self.config, seed=0)
+            entry_size = cache.nbytes
+            cache.max_bytes = int(2.5 * entry_size)
+            cache.run(self.config, seed=1)
+            cache.run(self.config, seed=0)  # Seed 0 is now more recent than seed 1
+            cache.run(self.config, seed=2)
+            self.assertEqual(len(cache.entries()), 2)
+            self.assertLessEqual(cache.nbytes, cache.max_bytes)
+            self.assertEqual(cache.run(self.config, seed=0)[1], "hit")
+            self.assertEqual(cache.run(self.config, seed=1)[1], "trained")
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_compare_flags_regressions(self):
+        """ Ensure regressions are detected in the worse direction only. """
+        from benchmark import compare, metric
+
+        baseline = {"results": {"a": metric(100, "episodes/s", "higher"), "b": metric(1.0, "s", "lower")}}
+        better = {"results": {"a": metric(150, "episodes/s", "higher"), "b": metric(0.5, "s", "lower")}}
+        worse = {"results": {"a": metric(70, "episodes/s", "higher"), "b": metric(1.5, "s", "lower"),
+                             "new": metric(1.0, "s", "lower")}}
+
+        self.assertEqual(compare(better, baseline, tolerance=0.2), [])
+        regressions = compare(worse, baseline, tolerance=0.2)
+        self.assertEqual([r.split(":")[0] for r in regressions], ["a", "b"])
+
 if __name__ == "__main__":
     unittest.main()